@@ -3,11 +3,21 @@ from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
     Configuration, ApiClient, MessagingApi,
-    ReplyMessageRequest, PushMessageRequest, TextMessage
+    ReplyMessageRequest, PushMessageRequest, MulticastRequest, TextMessage
 )
-from linebot.v3.webhooks import MessageEvent, TextMessageContent
-import os, random, json, logging, threading, time, re, requests
-from datetime import datetime, date
+from linebot.v3.messaging.exceptions import ApiException
+from linebot.v3.webhooks import (
+    MessageEvent, TextMessageContent, FollowEvent, UnfollowEvent, JoinEvent, LeaveEvent
+)
+from concurrent.futures import ThreadPoolExecutor
+import os, sys, random, json, logging, threading, time, re, requests, sqlite3, hmac, atexit, socket, functools, queue, zlib, heapq, base64, uuid, hashlib
+from math import gcd
+from bisect import bisect_left
+from array import array
+from urllib3.connection import HTTPConnection
+from datetime import datetime, date, timezone
+from zoneinfo import ZoneInfo
+from collections import OrderedDict, deque
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -18,18 +28,99 @@ ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 SECRET = os.getenv("LINE_CHANNEL_SECRET")
 PORT = int(os.getenv("PORT", 5000))
 HEROKU_URL = os.getenv("HEROKU_URL", "")  # جديد
-
-configuration = Configuration(access_token=ACCESS_TOKEN)
+LINE_API_HOST = os.getenv("LINE_API_HOST")  # لتوجيه الطلبات إلى خادم تجريبي
+
+# عميل LINE مشترك: حجم مجمع الاتصالات و TCP keep-alive
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", 20))
+LINE_TCP_KEEPALIVE = os.getenv("LINE_TCP_KEEPALIVE", "true").lower() == "true"
+
+configuration = Configuration(access_token=ACCESS_TOKEN, host=LINE_API_HOST)
+configuration.connection_pool_maxsize = LINE_POOL_SIZE
+if LINE_TCP_KEEPALIVE:
+    configuration.socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ]
 handler = WebhookHandler(SECRET)
 
 DATA_FILE = "data.json"
 CONTENT_FILE = "content.json"
-
-# Lock لمنع مشاكل الكتابة المتزامنة
-data_lock = threading.Lock()
-
-# تخزين الروابط لكل مستخدم
-user_links = {}
+FADL_FILE = "fadl.json"
+CONTENT_RELOAD_SECONDS = 30  # فحص تعديل ملفات المحتوى لإعادة تحميلها بدون إعادة تشغيل
+DB_FILE = os.getenv("DB_FILE", "data.db")
+
+# نوع التخزين: sqlite (افتراضي) أو json (إعادة كتابة الملف بالكامل)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+
+# قراءة القاعدة عبر mmap (بايت) - صفحات الملف مشتركة بين العمال في ذاكرة النظام
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", 256 * 1024 * 1024))
+
+# مع gunicorn --preload: الاستيراد مرة واحدة في العملية الرئيسية والخيوط تبدأ في كل عامل بعد fork
+# (يضبطه gunicorn.conf.py) - بدونه تبدأ الخيوط عند الاستيراد
+DEFER_BACKGROUND_SERVICES = os.getenv("DEFER_BACKGROUND_SERVICES", "false").lower() == "true"
+
+# ذاكرة مؤقتة لأسماء المستخدمين (TTL + LRU)
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 10000))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 3600))
+PROFILE_NEGATIVE_TTL = int(os.getenv("PROFILE_NEGATIVE_TTL", 300))  # للطلبات الفاشلة
+PROFILE_FETCH_CONCURRENCY = 8  # جلب الأسماء غير المخزنة بالتوازي (لوحة الترتيب)
+
+# لوحة ترتيب المجموعة: عدد الأعضاء المعروضين في الأمر، والحد الأعلى لـ limit في /groups/<id>/leaderboard
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", 10))
+LEADERBOARD_MAX = 100
+# /groups/<id>/leaderboard يتطلب "Authorization: Bearer <token>" - معطل إن لم يحدد
+LEADERBOARD_TOKEN = os.getenv("LEADERBOARD_TOKEN")
+
+# المعرفات المسجلة مسبقا في كل عملية (لتجنب كتابة مكررة مع كل رسالة) - الأقدم استخداما يحذف
+KNOWN_IDS_CACHE_SIZE = int(os.getenv("KNOWN_IDS_CACHE_SIZE", 20000))
+
+# طابور المهام الخلفية (الإرسال الجماعي) في نفس قاعدة SQLite
+JOB_POLL_SECONDS = 2
+JOB_HEARTBEAT_SECONDS = 30  # تجديد نبض المهمة قيد التنفيذ
+JOB_STALE_SECONDS = 120  # مهمة قيد التنفيذ لم يتجدد نبضها منذ ذلك (توقفت عمليتها) تعاد للطابور
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+
+# منع معالجة نفس حدث webhook مرتين (إعادة الإرسال من LINE)
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", 24 * 3600))
+DEDUP_MAX_EVENTS = int(os.getenv("DEDUP_MAX_EVENTS", 100000))
+DEDUP_PRUNE_EVERY = 1000
+
+# خط معالجة الأحداث: /callback يتحقق ويضع الأحداث في طابور ويرد فورا
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", 4))  # 0 = المعالجة داخل الطلب كما في السابق
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 1000))
+EVENT_QUEUE_TIMEOUT = 2  # ثوان انتظار مكان في طابور ممتلئ قبل الرد بـ 503
+LATENCY_SAMPLES = 2048
+
+# إيقاف الإرسال تلقائيا لمستلم بعد عدد من الأخطاء الدائمة المتتالية (حظر البوت أو مغادرة المجموعة)
+DELIVERY_MAX_FAILURES = int(os.getenv("DELIVERY_MAX_FAILURES", 3))
+# نسخة المعرفات الموقوفة في كل عملية تعاد قراءتها كل هذه المدة (لما أوقفته العمليات الأخرى)
+INACTIVE_SYNC_SECONDS = 30
+
+# المجدول: عملية واحدة فقط (القائد) تشغل المهام الدورية
+LEADER_LEASE_SECONDS = 30
+SCHEDULER_TICK_SECONDS = 5
+SCHEDULER_HISTORY = 50
+
+# مواعيد التذكير لكل مستلم: أوقات ثابتة وساعات هدوء، والإرسال الجماعي يوزع على نافذة زمنية
+REMINDER_SPREAD_SECONDS = int(os.getenv("REMINDER_SPREAD_SECONDS", 600))
+REMINDER_QUIET_HOURS = os.getenv("REMINDER_QUIET_HOURS", "")  # افتراضي لمن لم يحدد، مثال: 23:00-06:00
+REMINDER_TICK_SECONDS = 1
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", 500))  # حد الإرسالات في كل دورة
+REMINDER_MAX_TIMES = 6
+
+# المنطقة الزمنية لبداية اليوم الجديد (تصفير التسبيح)
+TASBIH_TIMEZONE = os.getenv("TASBIH_TIMEZONE", "UTC")
+
+# الحفظ المؤجل لعدادات التسبيح: يجمع التغييرات ويحفظها دفعة واحدة في الخلفية
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+FLUSH_INTERVAL_SECONDS = float(os.getenv("FLUSH_INTERVAL_SECONDS", 2))
+FLUSH_THRESHOLD = int(os.getenv("FLUSH_THRESHOLD", 200))
+
+# منع تكرار الروابط في المجموعات: نافذة زمنية وحد أقصى للذاكرة
+# مع sqlite الفهرس في القاعدة مشترك بين العمال، ومع json في ذاكرة العملية الوحيدة
+LINK_WINDOW_SECONDS = int(os.getenv("LINK_WINDOW_SECONDS", 24 * 3600))
+LINK_BUCKETS = 24
+LINK_MAX_ENTRIES = int(os.getenv("LINK_MAX_ENTRIES", 200000))
+LINK_PRUNE_EVERY = 1000
 
 # كلمات السلام المعتمدة
 SALAM_WORDS = [
@@ -50,146 +141,2203 @@ def load_json(file, default):
         logger.error(f"خطأ في تحميل {file}: {e}")
         return default
 
-def save_data():
-    """حفظ البيانات إلى ملف JSON مع Thread Safety"""
+TASBIH_LIMITS = 33
+TASBIH_KEYS = ["استغفر الله", "سبحان الله", "الحمد لله", "الله أكبر"]
+TASBIH_COMPLETE_SCORE = TASBIH_LIMITS * len(TASBIH_KEYS)  # مجموع العدادات عند إكمال الأذكار الأربعة
+
+DEFAULT_DATA = {
+    "users": [],
+    "groups": [],
+    "tasbih": {},
+    "tasbih_day": {},
+    "notifications_off": [],
+    "delivery": {},
+    "inactive": [],
+    "last_active": {}
+}
+
+# ========================================
+# اليوم الحالي حسب المنطقة الزمنية
+# ========================================
+EPOCH = date(1970, 1, 1)
+
+try:
+    tasbih_tz = ZoneInfo(TASBIH_TIMEZONE)
+except Exception:
+    logger.warning(f"✗ منطقة زمنية غير معروفة: {TASBIH_TIMEZONE} - سيتم استخدام UTC")
+    tasbih_tz = timezone.utc
+
+def today_epoch_day():
+    """رقم اليوم منذ 1970 حسب TASBIH_TIMEZONE - العدادات من يوم سابق تقرأ كصفر"""
+    return (datetime.now(tasbih_tz).date() - EPOCH).days
+
+def epoch_day_from_str(value):
+    """تحويل تاريخ نصي قديم (YYYY-MM-DD) إلى رقم اليوم"""
     try:
+        return (date.fromisoformat(value) - EPOCH).days
+    except (TypeError, ValueError):
+        return 0
+
+# ========================================
+# المقاييس (صيغة Prometheus)
+# ========================================
+# حدود الأزمنة بالثواني
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+THROUGHPUT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+BROADCAST_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+METRICS = []
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class HistogramSeries:
+    """سلسلة واحدة من المدرج - مصفوفة عدادات ثابتة تحدث تحت قفل"""
+
+    __slots__ = ("buckets", "counts", "total", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += value
+
+class Histogram:
+    """مدرج تكراري بحدود ثابتة - السلاسل تنشأ مرة واحدة لكل قيم تسميات"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def labels(self, *values):
+        series = self.series.get(values)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(values, HistogramSeries(self.buckets))
+        return series
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for values, series in list(self.series.items()):
+            with series.lock:
+                counts, total = list(series.counts), series.total
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.label_names, values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Counter:
+    """عداد تراكمي بتسميات"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount=1, *values):
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = list(self.values.items())
+        for values, value in items:
+            lines.append(f"{self.name}{format_labels(self.label_names, values)} {value}")
+        return lines
+
+def render_metrics():
+    """كل المقاييس بصيغة Prometheus النصية - لكل عملية gunicorn قيمها الخاصة"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+handler_seconds = Histogram("bot_handler_seconds", "Webhook event handling time by command", ("command",))
+store_op_seconds = Histogram("bot_store_op_seconds", "Storage operation duration", ("backend", "op"))
+store_write_bytes = Histogram("bot_store_write_bytes", "Bytes written per JSON save", buckets=BYTES_BUCKETS)
+line_api_seconds = Histogram("bot_line_api_seconds", "LINE API call latency by type", ("kind",))
+broadcast_seconds = Histogram("bot_broadcast_seconds", "Broadcast duration", buckets=BROADCAST_BUCKETS)
+broadcast_throughput = Histogram(
+    "bot_broadcast_messages_per_second", "Broadcast throughput", buckets=THROUGHPUT_BUCKETS
+)
+broadcast_messages = Counter("bot_broadcast_messages_total", "Broadcast deliveries by result", ("result",))
+lock_wait_seconds = Histogram("bot_data_lock_wait_seconds", "Time spent waiting for data_lock")
+reminder_lateness_seconds = Histogram(
+    "bot_reminder_lateness_seconds", "Delay between a reminder's scheduled time and its delivery"
+)
+
+class TimedLock:
+    """Lock يقيس زمن الانتظار - بدون قياس وقت عند عدم وجود تنافس"""
+
+    def __init__(self, histogram):
+        self._lock = threading.Lock()
+        self.wait = histogram.labels()
+
+    def __enter__(self):
+        if not self._lock.acquire(blocking=False):
+            started = time.perf_counter()
+            self._lock.acquire()
+            self.wait.observe(time.perf_counter() - started)
+        else:
+            self.wait.observe(0)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+# Lock لمنع مشاكل الكتابة المتزامنة
+data_lock = TimedLock(lock_wait_seconds)
+
+# ========================================
+# طبقة التخزين
+# ========================================
+def open_db(path):
+    """فتح اتصال SQLite بوضع WAL يمكن مشاركته بين الخيوط
+    القراءة عبر mmap من ذاكرة الملفات المشتركة بين العمال بدلا من نسخة لكل اتصال"""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+    return conn
+
+class QueryResult:
+    """نتيجة جملة SQLite مقروءة بالكامل داخل القفل - استعلام غير منته على اتصال مشترك
+    يبقي لقطة قراءة قديمة مفتوحة فتفشل كتابات الخيوط الأخرى بـ SQLITE_BUSY_SNAPSHOT"""
+
+    __slots__ = ("rows", "rowcount", "lastrowid")
+
+    def __init__(self, cursor):
+        self.rows = cursor.fetchall()
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+def execute_write(conn, sql, params=(), attempts=5):
+    """تنفيذ جملة مستقلة وقراءة نتيجتها بالكامل مع إعادتها عند SQLITE_BUSY_SNAPSHOT
+    (عملية أخرى كتبت بين بداية القراءة وطلب قفل الكتابة، ولا ينتظر busy timeout هذه الحالة)"""
+    for attempt in range(attempts):
+        try:
+            return QueryResult(conn.execute(sql, params))
+        except sqlite3.OperationalError as e:
+            if getattr(e, "sqlite_errorcode", None) != sqlite3.SQLITE_BUSY_SNAPSHOT or attempt == attempts - 1:
+                raise
+
+class TasbihTable:
+    """عدادات التسبيح لكل المستخدمين في مصفوفة واحدة متصلة بدلا من قاموس لكل مستخدم
+    لكل مستخدم صف من أعداد صغيرة: عدادات TASBIH_KEYS ثم رقم اليوم، والقاموس يحفظ رقم الصف فقط"""
+
+    DAY = len(TASBIH_KEYS)
+    WIDTH = DAY + 1
+    MAX_VALUE = 65535  # نوع المصفوفة H
+
+    def __init__(self):
+        self.rows = {}  # user_id -> رقم الصف (الصفوف لا تحذف فترتيب القاموس هو ترتيب الصفوف)
+        self.data = array("H")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def day(self, user_id):
+        """رقم يوم العدادات - None لمستخدم بلا صف"""
+        row = self.rows.get(user_id)
+        return None if row is None else self.data[row * self.WIDTH + self.DAY]
+
+    def counts(self, user_id):
+        """العدادات كقائمة بترتيب TASBIH_KEYS - None لمستخدم بلا صف"""
+        row = self.rows.get(user_id)
+        if row is None:
+            return None
+        start = row * self.WIDTH
+        return self.data[start:start + self.DAY].tolist()
+
+    def reset(self, user_id, day):
+        """تصفير صف المستخدم (أو إضافته) ليوم جديد"""
+        row = self.rows.get(user_id)
+        if row is None:
+            self.rows[user_id] = len(self.rows)
+            self.data.extend([0] * self.DAY + [day])
+            return
+        start = row * self.WIDTH
+        self.data[start:start + self.WIDTH] = array("H", [0] * self.DAY + [day])
+
+    def add(self, user_id, index):
+        """زيادة عداد واحد - يعيد القيمة الجديدة"""
+        position = self.rows[user_id] * self.WIDTH + index
+        self.data[position] += 1
+        return self.data[position]
+
+    def items(self):
+        """(المعرف، العدادات، اليوم) لكل مستخدم"""
+        columns = zip(*(self.data[i::self.WIDTH] for i in range(self.WIDTH)))
+        for user_id, row in zip(self.rows, columns):
+            yield user_id, row[:self.DAY], row[self.DAY]
+
+    def totals(self):
+        return [sum(self.data[i::self.WIDTH]) for i in range(self.DAY)]
+
+    def to_json(self):
+        """الصفوف كما هي في الذاكرة: المعرفات بترتيب الصفوف والمصفوفة (little-endian) بترميز base64"""
+        data = self.data
+        if sys.byteorder == "big":
+            data = array("H", data)
+            data.byteswap()
+        return {"keys": TASBIH_KEYS, "ids": list(self.rows), "rows": base64.b64encode(data.tobytes()).decode()}
+
+    @classmethod
+    def from_json(cls, value):
+        table = cls()
+        table.data.frombytes(base64.b64decode(value["rows"]))
+        if sys.byteorder == "big":
+            table.data.byteswap()
+        ids = value["ids"]
+        if value.get("keys") != TASBIH_KEYS or len(table.data) != len(ids) * cls.WIDTH:
+            raise ValueError("tasbih_rows لا يطابق TASBIH_KEYS")
+        table.rows = dict(zip(map(sys.intern, ids), range(len(ids))))
+        return table
+
+    @classmethod
+    def from_dicts(cls, tasbih, days):
+        """من الصيغة القديمة: user_id -> {الذكر: العدد} و user_id -> رقم اليوم"""
+        table = cls()
+        for user_id, counts in tasbih.items():
+            table.rows[user_id] = len(table.rows)
+            table.data.extend([min(counts.get(key, 0), cls.MAX_VALUE) for key in TASBIH_KEYS]
+                              + [days.get(user_id, 0)])
+        return table
+
+def load_tasbih_table(data):
+    """عدادات data.json: الصيغة المضغوطة tasbih_rows أو القديمة (tasbih مع tasbih_day أو last_reset)"""
+    if data.get("tasbih_rows"):
+        return TasbihTable.from_json(data["tasbih_rows"])
+    days = data.get("tasbih_day") or {
+        uid: epoch_day_from_str(value) for uid, value in data.get("last_reset", {}).items()
+    }
+    return TasbihTable.from_dicts(data.get("tasbih", {}), days)
+
+class GroupRanking:
+    """ترتيب أعضاء كل مجموعة اليوم حسب مجموع تسبيحهم - المجموع محدود (0 إلى TASBIH_COMPLETE_SCORE)
+    فلكل مجموعة سلة لكل قيمة: التحديث نقل بين سلتين، وأعلى N من السلال العليا بدون ترتيب"""
+
+    def __init__(self):
+        self.day = None
+        self.boards = {}  # group_id -> {المجموع: {user_id: None}} - ترتيب القاموس هو ترتيب الوصول
+        self.scores = {}  # (group_id, user_id) -> المجموع الحالي
+        self.totals = {}  # group_id -> [من سبح اليوم، مجموع التسبيح، من أكمل]
+
+    def update(self, group_ids, user_id, score, day):
+        """تحديث مجموع المستخدم في كل مجموعاته - اليوم الجديد يبدأ ترتيبا فارغا"""
+        if day != self.day:
+            if self.day is not None and day < self.day:
+                return
+            self.day, self.boards, self.scores, self.totals = day, {}, {}, {}
+        for group_id in group_ids:
+            board = self.boards.setdefault(group_id, {})
+            totals = self.totals.setdefault(group_id, [0, 0, 0])
+            old = self.scores.pop((group_id, user_id), 0)
+            if old:
+                bucket = board[old]
+                del bucket[user_id]
+                if not bucket:
+                    del board[old]
+                totals[0] -= 1
+                totals[1] -= old
+                totals[2] -= old >= TASBIH_COMPLETE_SCORE
+            if score:
+                # عند التساوي يتقدم من وصل إلى المجموع أولا
+                board.setdefault(score, {})[user_id] = None
+                self.scores[(group_id, user_id)] = score
+                totals[0] += 1
+                totals[1] += score
+                totals[2] += score >= TASBIH_COMPLETE_SCORE
+
+    def top(self, group_id, day, limit):
+        """[(user_id، المجموع)] للأعلى أولا"""
+        board = self.boards.get(group_id) if day == self.day else None
+        result = []
+        if not board:
+            return result
+        for score in range(TASBIH_COMPLETE_SCORE, 0, -1):
+            for user_id in board.get(score, ()):
+                if len(result) == limit:
+                    return result
+                result.append((user_id, score))
+        return result
+
+    def summary(self, group_id, day):
+        return self.totals.get(group_id, [0, 0, 0]) if day == self.day else [0, 0, 0]
+
+class JsonStore:
+    """تخزين في الذاكرة مع ملف JSON - لعملية واحدة فقط، وكل حفظ يعيد كتابة الملف بالكامل"""
+
+    def __init__(self, path, write_behind=False):
+        self.path = path
+        self.write_behind = write_behind
+        self.pending_changes = 0
+        # آخر نشاط والعضوية تتغير في الذاكرة فقط وتحفظ مع الحفظ التالي (لا حفظ كامل لكل أول رسالة في اليوم)
+        self.dirty = False
+        self.users = set()
+        self.groups = set()
+        self.tasbih = TasbihTable()
+        self.notifications_off = set()
+        # حالة التوصيل: target_id -> [آخر نجاح، آخر فشل، فشل متتال، فشل دائم متتال، نوع الخطأ]
+        self.delivery = {}
+        self.inactive = set()
+        self.dump_seconds = store_op_seconds.labels("json", "dump")
+        self.write_lock = threading.Lock()  # حفظ واحد في كل مرة - data_lock يحرر أثناء الكتابة
+        self.last_active = {}  # المعرف -> آخر يوم نشاط
+        self.members = {}  # group_id -> المستخدمون الذين راسلوا البوت فيها
+        self.user_groups = {}  # user_id -> مجموعاته
+        self.ranking = GroupRanking()
+        # إحصائيات تحدث مع كل تغيير بدلا من المرور على كل المستخدمين
+        self.totals = [0] * len(TASBIH_KEYS)
+        self.completions = {}  # اليوم -> عدد من أكملوا الأذكار الأربعة
+        self.active_receivers = 0
+        self.failing = 0  # مستلمون آخر إرسال لهم فشل
+        self.failing_by_error = {}  # نوع الخطأ -> عددهم
+
+    def load(self):
+        data = load_json(self.path, DEFAULT_DATA)
+        # المعرفات نفسها تتكرر في عدة أقسام من الملف - sys.intern يجعلها نسخة واحدة في الذاكرة
+        self.users = set(map(sys.intern, data.get("users", [])))
+        self.groups = set(map(sys.intern, data.get("groups", [])))
+        self.tasbih = load_tasbih_table(data)
+        self.notifications_off = set(data.get("notifications_off", []))
+        self.delivery = data.get("delivery", {})
+        self.inactive = set(data.get("inactive", []))
+        self.last_active = data.get("last_active") or {uid: day for uid, _, day in self.tasbih.items()}
+        self.members, self.user_groups = {}, {}
+        for group_id, user_ids in data.get("group_members", {}).items():
+            for user_id in user_ids:
+                self._link_member(sys.intern(group_id), sys.intern(user_id))
+        self._rebuild_aggregates()
+
+    def _rebuild_aggregates(self):
+        """حساب الإحصائيات مرة واحدة عند التحميل"""
+        self.totals = self.tasbih.totals()
+        self.completions = {}
+        for _, counts, day in self.tasbih.items():
+            if self._complete(counts):
+                self.completions[day] = self.completions.get(day, 0) + 1
+        self.active_receivers = sum(
+            1 for target_id in self.users | self.groups if self._receives(target_id)
+        )
+        self.failing, self.failing_by_error = 0, {}
+        for entry in self.delivery.values():
+            self._count_failure(entry, 1)
+        self.ranking = GroupRanking()
+        day = today_epoch_day()
+        for user_id, counts, counts_day in self.tasbih.items():
+            if counts_day == day and user_id in self.user_groups:
+                self.ranking.update(self.user_groups[user_id], user_id, sum(counts), day)
+
+    @staticmethod
+    def _complete(counts):
+        return min(counts) >= TASBIH_LIMITS
+
+    def _receives(self, target_id):
+        return target_id not in self.notifications_off and target_id not in self.inactive
+
+    def _is_target(self, target_id):
+        return target_id in self.users or target_id in self.groups
+
+    def _link_member(self, group_id, user_id):
+        self.members.setdefault(group_id, set()).add(user_id)
+        self.user_groups.setdefault(user_id, set()).add(group_id)
+
+    def _rank(self, user_id, counts, day):
+        """تحديث ترتيب المستخدم في مجموعاته بعد تغير عداداته"""
+        groups = self.user_groups.get(user_id)
+        if groups:
+            self.ranking.update(groups, user_id, sum(counts), day)
+
+    def _drop_counts(self, user_id):
+        """طرح عدادات المستخدم الحالية من الإحصائيات قبل تصفيرها"""
+        counts = self.tasbih.counts(user_id)
+        if not counts:
+            return
+        for i, value in enumerate(counts):
+            self.totals[i] -= value
+        if self._complete(counts):
+            self.completions[self.tasbih.day(user_id)] -= 1
+
+    def _count_failure(self, entry, sign):
+        """إضافة حالة التوصيل لملخص الفشل (1) أو طرحها قبل تغييرها (-1)"""
+        if not entry[2]:
+            return
+        self.failing += sign
+        count = self.failing_by_error.get(entry[4], 0) + sign
+        if count:
+            self.failing_by_error[entry[4]] = count
+        else:
+            self.failing_by_error.pop(entry[4], None)
+
+    def _set_excluded(self, target_id, muted=None, inactive=None):
+        """تحديث الكتم أو الإيقاف مع تعديل عدد المستقبلين النشطين"""
+        before = self._receives(target_id)
+        if muted is not None:
+            (self.notifications_off.add if muted else self.notifications_off.discard)(target_id)
+        if inactive is not None:
+            (self.inactive.add if inactive else self.inactive.discard)(target_id)
+        if self._is_target(target_id):
+            self.active_receivers += self._receives(target_id) - before
+
+    def _snapshot(self):
+        """نسخة من البيانات للحفظ - تؤخذ تحت data_lock حتى لا تتغير أثناء الكتابة"""
         with data_lock:
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump({
-                    "users": list(target_users),
-                    "groups": list(target_groups),
-                    "tasbih": tasbih_counts,
-                    "last_reset": last_reset_dates,
-                    "notifications_off": list(notifications_off)
-                }, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"خطأ في الحفظ: {e}")
+            self.dirty = False
+            return {
+                "users": list(self.users),
+                "groups": list(self.groups),
+                "tasbih_rows": self.tasbih.to_json(),
+                "notifications_off": list(self.notifications_off),
+                "delivery": {target_id: list(entry) for target_id, entry in self.delivery.items()},
+                "inactive": list(self.inactive),
+                "last_active": dict(self.last_active),
+                "group_members": {gid: list(uids) for gid, uids in self.members.items()}
+            }
+
+    def _dump(self):
+        """حفظ البيانات إلى ملف JSON - يرفع الخطأ عند الفشل
+        الكتابة إلى ملف مؤقت ثم os.replace: الملف القديم يبقى سليما إن فشلت الكتابة
+        write_lock يرتب الحفظ: لا تكتب نسخة أقدم فوق نسخة أحدث"""
+        with self.write_lock:
+            started = time.perf_counter()
+            snapshot = self._snapshot()
+            temp_path = self.path + ".tmp"
+            try:
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f, ensure_ascii=False, indent=2)
+                    written = f.tell()
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                with data_lock:
+                    self.dirty = True
+                raise
+            self.dump_seconds.observe(time.perf_counter() - started)
+            store_write_bytes.observe(written)
+
+    def _save_now(self):
+        """حفظ فوري - الفشل يسجل ولا يوقف معالجة الرسالة، والتغيير يدخل في الحفظ الناجح التالي"""
+        try:
+            self._dump()
+        except Exception as e:
+            logger.error(f"خطأ في الحفظ: {e}")
+
+    def _save(self):
+        if self.write_behind:
+            with data_lock:
+                self.pending_changes += 1
+        else:
+            self._save_now()
+
+    def flush(self):
+        """كتابة التغييرات المؤجلة - يعيد (عدد التغييرات، عدد الكتابات)
+        عند فشل الكتابة تبقى التغييرات معلقة ويرفع الخطأ"""
+        with data_lock:
+            changes, self.pending_changes = self.pending_changes, 0
+            dirty = self.dirty
+        if not changes and not dirty:
+            return 0, 0
+        try:
+            self._dump()
+        except Exception:
+            with data_lock:
+                self.pending_changes += changes
+            raise
+        return changes, 1
+
+    # كل تعديل يتم تحت data_lock (EVENT_WORKERS خيوط تعدل معا) والحفظ بعد تحريره
+    def add_user(self, user_id):
+        with data_lock:
+            if user_id in self.users:
+                return False
+            self.users.add(user_id)
+            self.active_receivers += self._receives(user_id)
+        self._save_now()
+        return True
+
+    def add_group(self, group_id):
+        with data_lock:
+            if group_id in self.groups:
+                return False
+            self.groups.add(group_id)
+            self.active_receivers += self._receives(group_id)
+        self._save_now()
+        return True
+
+    def set_notifications(self, target_id, off):
+        with data_lock:
+            if (target_id in self.notifications_off) == off:
+                return False
+            self._set_excluded(target_id, muted=off)
+        self._save_now()
+        return True
+
+    def is_stale(self, user_id, day):
+        """هل لدى المستخدم عدادات من يوم سابق"""
+        with data_lock:
+            stored = self.tasbih.day(user_id)
+        return stored is not None and stored != day
+
+    def reset_counts(self, user_id, day):
+        with data_lock:
+            self._drop_counts(user_id)
+            self.tasbih.reset(user_id, day)
+            self._rank(user_id, self.tasbih.counts(user_id), day)
+        self._save()
+
+    def get_counts(self, user_id, day):
+        """العدادات لليوم المحدد - بدون أي كتابة"""
+        with data_lock:
+            if self.tasbih.day(user_id) != day:
+                return {key: 0 for key in TASBIH_KEYS}
+            return dict(zip(TASBIH_KEYS, self.tasbih.counts(user_id)))
+
+    def increment(self, user_id, key, limit, day):
+        """زيادة العداد إن لم يصل للحد - يعيد (العدادات، هل تمت الزيادة)"""
+        with data_lock:
+            if self.tasbih.day(user_id) != day:
+                self._drop_counts(user_id)
+                self.tasbih.reset(user_id, day)
+            index = TASBIH_KEYS.index(key)
+            counts = self.tasbih.counts(user_id)
+            if counts[index] >= limit:
+                return dict(zip(TASBIH_KEYS, counts)), False
+            counts[index] = self.tasbih.add(user_id, index)
+            self.totals[index] += 1
+            if counts[index] == TASBIH_LIMITS and self._complete(counts):
+                self.completions[day] = self.completions.get(day, 0) + 1
+            self._rank(user_id, counts, day)
+        self._save()
+        return dict(zip(TASBIH_KEYS, counts)), True
+
+    def record_deliveries(self, outcomes, now=None):
+        """تسجيل نتائج الإرسال [(target_id, نوع الخطأ أو None)] - يعيد المعرفات التي أوقفت"""
+        now = now or time.time()
+        deactivated = []
+        with data_lock:
+            for target_id, error in outcomes:
+                entry = self.delivery.setdefault(target_id, [None, None, 0, 0, None])
+                self._count_failure(entry, -1)
+                if error is None:
+                    entry[0], entry[2], entry[3], entry[4] = now, 0, 0, None
+                    continue
+                entry[1], entry[4] = now, error
+                entry[2] += 1
+                self._count_failure(entry, 1)
+                if error in PERMANENT_ERRORS:
+                    entry[3] += 1
+                    if entry[3] >= DELIVERY_MAX_FAILURES and target_id not in self.inactive:
+                        self._set_excluded(target_id, inactive=True)
+                        deactivated.append(target_id)
+        if outcomes:
+            self._save()
+        return deactivated
+
+    def deactivate(self, target_id, reason):
+        with data_lock:
+            entry = self.delivery.setdefault(target_id, [None, None, 0, 0, None])
+            self._count_failure(entry, -1)
+            entry[4] = reason
+            self._count_failure(entry, 1)
+            if target_id in self.inactive:
+                return False
+            self._set_excluded(target_id, inactive=True)
+        self._save_now()
+        return True
+
+    def reactivate(self, *target_ids, cached=True):
+        """إعادة تفعيل المعرفات الموقوفة - يعيد ما أعيد تفعيله (cached للتوافق مع SqliteStore)"""
+        with data_lock:
+            revived = [tid for tid in target_ids if tid in self.inactive]
+            for target_id in revived:
+                self._set_excluded(target_id, inactive=False)
+                self._count_failure(self.delivery.get(target_id, [None, None, 0, 0, None]), -1)
+                self.delivery[target_id] = [None, None, 0, 0, None]
+        if revived:
+            self._save_now()
+        return revived
+
+    def inactive_counts(self, exclude_user=None, exclude_group=None):
+        """عدد المستخدمين والمجموعات الموقوفين الذين كانوا سيستلمون الإرسال الجماعي"""
+        with data_lock:
+            skipped = self.inactive - self.notifications_off - {exclude_user, exclude_group}
+            return len(skipped & self.users), len(skipped & self.groups)
+
+    def delivery_summary(self):
+        with data_lock:
+            return {
+                "inactive": len(self.inactive),
+                "failing": self.failing,
+                "by_error": dict(self.failing_by_error)
+            }
+
+    def touch(self, user_id, group_id, day):
+        """تسجيل آخر نشاط في الذاكرة - يحفظ مع الحفظ التالي أو flush"""
+        with data_lock:
+            for target_id in (user_id, group_id):
+                if target_id and self.last_active.get(target_id) != day:
+                    self.last_active[target_id] = day
+                    self.dirty = True
+
+    def recipients(self, exclude_user=None, exclude_group=None, segment="all"):
+        kind, days = parse_segment(segment)
+        day = today_epoch_day()
+        with data_lock:
+            skip = self.notifications_off | self.inactive
+            users = []
+            if kind != "groups":
+                users = [uid for uid in self.users
+                         if uid != exclude_user and uid not in skip]
+            if kind == "active":
+                users = [uid for uid in users if self.last_active.get(uid, 0) > day - days]
+            elif kind == "incomplete":
+                users = [uid for uid in users
+                         if self.tasbih.day(uid) != day or not self._complete(self.tasbih.counts(uid))]
+            groups = []
+            if kind in ("all", "groups"):
+                groups = [gid for gid in self.groups
+                          if gid != exclude_group and gid not in skip]
+        return users, groups
+
+    def filter_receiving(self, target_ids):
+        with data_lock:
+            return [target_id for target_id in target_ids if self._receives(target_id)]
+
+    def add_member(self, group_id, user_id):
+        """تسجيل أن المستخدم عضو في المجموعة - يعيد False إن كان معروفا (يحفظ مثل touch)"""
+        with data_lock:
+            if user_id in self.members.get(group_id, ()):
+                return False
+            self._link_member(group_id, user_id)
+            day = today_epoch_day()
+            if self.tasbih.day(user_id) == day:
+                self.ranking.update((group_id,), user_id, sum(self.tasbih.counts(user_id)), day)
+            self.dirty = True
+        return True
+
+    def group_board(self, group_id, day, limit):
+        with data_lock:
+            return self.ranking.top(group_id, day, limit)
+
+    def group_summary(self, group_id, day):
+        with data_lock:
+            active, total, completed = self.ranking.summary(group_id, day)
+            members = len(self.members.get(group_id, ()))
+        return {
+            "members": members,
+            "active_today": active,
+            "total_today": total,
+            "completed_today": completed
+        }
+
+    def summary(self, day=None):
+        day = today_epoch_day() if day is None else day
+        with data_lock:
+            return {
+                "users": len(self.users),
+                "groups": len(self.groups),
+                "notifications_off": len(self.notifications_off),
+                "total_tasbih": sum(self.totals),
+                "total_per_key": dict(zip(TASBIH_KEYS, self.totals)),
+                "completed_today": self.completions.get(day, 0),
+                "active_users": len(self.tasbih),
+                "active_receivers": self.active_receivers
+            }
+
+class LruCache:
+    """قاموس محدود الحجم يحذف الأقدم استخداما - ما يحذف يعاد التحقق منه في القاعدة فقط"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def add(self, key, value=None):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+class SqliteStore:
+    """تخزين SQLite بوضع WAL مشترك بين عمليات gunicorn - كل تغيير عملية ذرية على سطر واحد"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, last_active INTEGER NOT NULL DEFAULT 0);
+    CREATE TABLE IF NOT EXISTS groups (id TEXT PRIMARY KEY, last_active INTEGER NOT NULL DEFAULT 0);
+    CREATE TABLE IF NOT EXISTS notifications_off (id TEXT PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS tasbih (
+        user_id TEXT PRIMARY KEY,
+        day INTEGER NOT NULL DEFAULT 0,
+        c0 INTEGER NOT NULL DEFAULT 0,
+        c1 INTEGER NOT NULL DEFAULT 0,
+        c2 INTEGER NOT NULL DEFAULT 0,
+        c3 INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS delivery (
+        target_id TEXT PRIMARY KEY,
+        last_success REAL,
+        last_failure REAL,
+        consecutive_failures INTEGER NOT NULL DEFAULT 0,
+        permanent_failures INTEGER NOT NULL DEFAULT 0,
+        error_class TEXT,
+        inactive INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS delivery_inactive ON delivery (inactive) WHERE inactive = 1;
+    """
+
+    # إحصائيات تحدثها triggers داخل نفس معاملة التغيير - صحيحة مع عدة عمليات
+    AGGREGATES_SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS aggregates (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS completions (day INTEGER PRIMARY KEY, users INTEGER NOT NULL);
+
+    CREATE TRIGGER IF NOT EXISTS tasbih_insert_totals AFTER INSERT ON tasbih BEGIN
+        UPDATE aggregates SET value = value + CASE key
+            WHEN 'c0' THEN new.c0 WHEN 'c1' THEN new.c1 WHEN 'c2' THEN new.c2 WHEN 'c3' THEN new.c3
+            WHEN 'active_users' THEN 1 END
+        WHERE key IN ('c0', 'c1', 'c2', 'c3', 'active_users');
+        INSERT INTO completions (day, users) SELECT new.day, 1
+        WHERE MIN(new.c0, new.c1, new.c2, new.c3) >= {TASBIH_LIMITS}
+        ON CONFLICT (day) DO UPDATE SET users = users + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS tasbih_update_totals AFTER UPDATE ON tasbih BEGIN
+        UPDATE aggregates SET value = value + CASE key
+            WHEN 'c0' THEN new.c0 - old.c0 WHEN 'c1' THEN new.c1 - old.c1
+            WHEN 'c2' THEN new.c2 - old.c2 WHEN 'c3' THEN new.c3 - old.c3 END
+        WHERE key IN ('c0', 'c1', 'c2', 'c3');
+        UPDATE completions SET users = users - 1
+        WHERE day = old.day AND MIN(old.c0, old.c1, old.c2, old.c3) >= {TASBIH_LIMITS};
+        INSERT INTO completions (day, users) SELECT new.day, 1
+        WHERE MIN(new.c0, new.c1, new.c2, new.c3) >= {TASBIH_LIMITS}
+        ON CONFLICT (day) DO UPDATE SET users = users + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS users_insert_totals AFTER INSERT ON users BEGIN
+        UPDATE aggregates SET value = value + 1 WHERE key = 'users';
+        UPDATE aggregates SET value = value + 1 WHERE key = 'active_receivers'
+            AND new.id NOT IN (SELECT id FROM notifications_off)
+            AND new.id NOT IN (SELECT target_id FROM delivery WHERE inactive = 1);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS groups_insert_totals AFTER INSERT ON groups BEGIN
+        UPDATE aggregates SET value = value + 1 WHERE key = 'groups';
+        UPDATE aggregates SET value = value + 1 WHERE key = 'active_receivers'
+            AND new.id NOT IN (SELECT id FROM notifications_off)
+            AND new.id NOT IN (SELECT target_id FROM delivery WHERE inactive = 1);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS muted_insert_totals AFTER INSERT ON notifications_off BEGIN
+        UPDATE aggregates SET value = value + 1 WHERE key = 'notifications_off';
+        UPDATE aggregates SET value = value - 1 WHERE key = 'active_receivers'
+            AND (new.id IN (SELECT id FROM users) OR new.id IN (SELECT id FROM groups))
+            AND new.id NOT IN (SELECT target_id FROM delivery WHERE inactive = 1);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS muted_delete_totals AFTER DELETE ON notifications_off BEGIN
+        UPDATE aggregates SET value = value - 1 WHERE key = 'notifications_off';
+        UPDATE aggregates SET value = value + 1 WHERE key = 'active_receivers'
+            AND (old.id IN (SELECT id FROM users) OR old.id IN (SELECT id FROM groups))
+            AND old.id NOT IN (SELECT target_id FROM delivery WHERE inactive = 1);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS delivery_insert_totals AFTER INSERT ON delivery
+    WHEN new.inactive = 1 BEGIN
+        UPDATE aggregates SET value = value - 1 WHERE key = 'active_receivers'
+            AND (new.target_id IN (SELECT id FROM users) OR new.target_id IN (SELECT id FROM groups))
+            AND new.target_id NOT IN (SELECT id FROM notifications_off);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS delivery_update_totals AFTER UPDATE OF inactive ON delivery
+    WHEN new.inactive != old.inactive BEGIN
+        UPDATE aggregates SET value = value + old.inactive - new.inactive WHERE key = 'active_receivers'
+            AND (new.target_id IN (SELECT id FROM users) OR new.target_id IN (SELECT id FROM groups))
+            AND new.target_id NOT IN (SELECT id FROM notifications_off);
+    END;
+
+    -- ملخص التوصيل: الموقوفون، والمستلمون الفاشلون حاليا مع عددهم لكل نوع خطأ ('error:<النوع>')
+    CREATE TRIGGER IF NOT EXISTS delivery_insert_summary AFTER INSERT ON delivery
+    WHEN new.inactive = 1 OR new.consecutive_failures > 0 BEGIN
+        UPDATE aggregates SET value = value + new.inactive WHERE key = 'inactive';
+        UPDATE aggregates SET value = value + 1 WHERE key = 'failing' AND new.consecutive_failures > 0;
+        INSERT INTO aggregates (key, value) SELECT 'error:' || COALESCE(new.error_class, ''), 1
+        WHERE new.consecutive_failures > 0
+        ON CONFLICT (key) DO UPDATE SET value = value + 1;
+    END;
+
+    -- النجاح المتكرر لمستلم سليم (أغلب التحديثات) لا يغير شيئا
+    CREATE TRIGGER IF NOT EXISTS delivery_update_summary AFTER UPDATE ON delivery
+    WHEN new.inactive != old.inactive OR new.consecutive_failures > 0 OR old.consecutive_failures > 0 BEGIN
+        UPDATE aggregates SET value = value + new.inactive - old.inactive
+        WHERE key = 'inactive' AND new.inactive != old.inactive;
+        UPDATE aggregates SET value = value + (new.consecutive_failures > 0) - (old.consecutive_failures > 0)
+        WHERE key = 'failing';
+        UPDATE aggregates SET value = value - 1
+        WHERE key = 'error:' || COALESCE(old.error_class, '') AND old.consecutive_failures > 0;
+        INSERT INTO aggregates (key, value) SELECT 'error:' || COALESCE(new.error_class, ''), 1
+        WHERE new.consecutive_failures > 0
+        ON CONFLICT (key) DO UPDATE SET value = value + 1;
+    END;
+    """
+
+    # عضوية المجموعات وترتيبها: مجموع تسبيح العضو اليوم ينسخ إلى كل مجموعاته مع كل تغيير
+    # فأعلى N في مجموعة قراءة من أول فهرس group_members_rank بدون ترتيب
+    GROUPS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS group_members (
+        group_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        day INTEGER NOT NULL DEFAULT 0,
+        score INTEGER NOT NULL DEFAULT 0,
+        scored_at REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (group_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS group_members_user ON group_members (user_id);
+    CREATE INDEX IF NOT EXISTS group_members_rank ON group_members (group_id, day, score DESC, scored_at);
+
+    CREATE TRIGGER IF NOT EXISTS tasbih_insert_rank AFTER INSERT ON tasbih BEGIN
+        UPDATE group_members SET day = new.day, score = new.c0 + new.c1 + new.c2 + new.c3,
+            scored_at = julianday('now')
+        WHERE user_id = new.user_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS tasbih_update_rank AFTER UPDATE ON tasbih BEGIN
+        UPDATE group_members SET day = new.day, score = new.c0 + new.c1 + new.c2 + new.c3,
+            scored_at = julianday('now')
+        WHERE user_id = new.user_id;
+    END;
+    """
+
+    # القيم الابتدائية تحسب مرة واحدة من البيانات الموجودة
+    AGGREGATES_SEED = (
+        """
+    INSERT INTO aggregates (key, value)
+    SELECT 'users', COUNT(*) FROM users
+    UNION ALL SELECT 'groups', COUNT(*) FROM groups
+    UNION ALL SELECT 'notifications_off', COUNT(*) FROM notifications_off
+    UNION ALL SELECT 'active_users', COUNT(*) FROM tasbih
+    UNION ALL SELECT 'c0', COALESCE(SUM(c0), 0) FROM tasbih
+    UNION ALL SELECT 'c1', COALESCE(SUM(c1), 0) FROM tasbih
+    UNION ALL SELECT 'c2', COALESCE(SUM(c2), 0) FROM tasbih
+    UNION ALL SELECT 'c3', COALESCE(SUM(c3), 0) FROM tasbih
+    UNION ALL SELECT 'active_receivers', COUNT(*) FROM (SELECT id FROM users UNION ALL SELECT id FROM groups)
+        WHERE id NOT IN (SELECT id FROM notifications_off)
+        AND id NOT IN (SELECT target_id FROM delivery WHERE inactive = 1)
+    """,
+        "INSERT OR REPLACE INTO completions (day, users) SELECT day, COUNT(*) FROM tasbih "
+        f"WHERE MIN(c0, c1, c2, c3) >= {TASBIH_LIMITS} GROUP BY day"
+    )
+
+    # ملخص التوصيل أضيف بعد الإحصائيات الأولى - يحسب مرة واحدة لكل قاعدة ليس فيها 'failing'
+    # مفاتيح الأخطاء تحذف أولا: triggers عمليات أخرى قد تكون أنشأتها قبل هذه المعاملة
+    DELIVERY_SEED = (
+        "DELETE FROM aggregates WHERE key >= 'error:' AND key < 'error;'",
+        """
+    INSERT OR REPLACE INTO aggregates (key, value)
+    SELECT 'inactive', COUNT(*) FROM delivery WHERE inactive = 1
+    UNION ALL SELECT 'failing', COUNT(*) FROM delivery WHERE consecutive_failures > 0
+    UNION ALL SELECT 'error:' || COALESCE(error_class, ''), COUNT(*) FROM delivery
+        WHERE consecutive_failures > 0 GROUP BY error_class
+    """
+    )
+
+    def __init__(self, path, write_behind=False):
+        self.path = path
+        self.conn = open_db(path)
+        self.conn.executescript(self.SCHEMA)
+        self._migrate()
+        self._create_aggregates()
+        self.conn.executescript(self.GROUPS_SCHEMA)
+        self.write_behind = write_behind
+        # معرفات سبق تسجيلها في هذه العملية - لتجنب كتابة مكررة مع كل رسالة
+        self.known_users = LruCache(KNOWN_IDS_CACHE_SIZE)
+        self.known_groups = LruCache(KNOWN_IDS_CACHE_SIZE)
+        self.known_members = LruCache(KNOWN_IDS_CACHE_SIZE)
+        self.last_active = LruCache(KNOWN_IDS_CACHE_SIZE)  # آخر يوم سجل نشاطه في هذه العملية
+        # المعرفات الموقوفة: reactivate مع كل رسالة لا يقرأ القاعدة إلا لمعرف موجود هنا
+        self.inactive_ids = set()
+        self.inactive_synced = None
+        # الحفظ المؤجل: user_id -> (اليوم، فروق العدادات الأربعة)
+        self.pending = {}
+        self.pending_changes = 0
+        self.pending_lock = threading.Lock()
+        # من أخذ الدفعة حتى كتابتها - التصفير ينتظره فلا تكتب دفعة أقدم فوق التصفير
+        self.flush_lock = threading.Lock()
+        self.query_seconds = store_op_seconds.labels("sqlite", "query")
+        self.transaction_seconds = store_op_seconds.labels("sqlite", "transaction")
+
+    def _migrate(self):
+        """تحويل عمود last_reset النصي القديم إلى رقم اليوم"""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(tasbih)")]
+        if "day" not in columns:
+            self.conn.execute("ALTER TABLE tasbih ADD COLUMN day INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute(
+                "UPDATE tasbih SET day = CAST(julianday(last_reset) - julianday('1970-01-01') AS INTEGER) "
+                "WHERE last_reset IS NOT NULL"
+            )
+        # آخر نشاط (رقم اليوم) للشرائح - يبدأ من آخر يوم تسبيح للقواعد القديمة
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table in ("users", "groups"):
+                columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+                if "last_active" not in columns:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN last_active INTEGER NOT NULL DEFAULT 0")
+                    if table == "users":
+                        self.conn.execute(
+                            "UPDATE users SET last_active = "
+                            "COALESCE((SELECT day FROM tasbih WHERE user_id = users.id), 0)"
+                        )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS users_last_active ON users (last_active)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS groups_last_active ON groups (last_active)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS tasbih_day ON tasbih (day)")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _create_aggregates(self):
+        """إنشاء جداول الإحصائيات وحساب قيمها الأولى مرة واحدة فقط"""
+        self.conn.executescript(self.AGGREGATES_SCHEMA)
+        # الحساب داخل معاملة حصرية: أي كتابة من عملية أخرى قبله تدخل في الحساب نفسه
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not self.conn.execute("SELECT 1 FROM aggregates LIMIT 1").fetchone():
+                for statement in self.AGGREGATES_SEED:
+                    self.conn.execute(statement)
+            if not self.conn.execute("SELECT 1 FROM aggregates WHERE key = 'failing'").fetchone():
+                for statement in self.DELIVERY_SEED:
+                    self.conn.execute(statement)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _execute(self, sql, params=()):
+        with data_lock:
+            started = time.perf_counter()
+            result = execute_write(self.conn, sql, params)
+            self.query_seconds.observe(time.perf_counter() - started)
+            return result
+
+    def _transaction(self, sql, rows):
+        with data_lock:
+            started = time.perf_counter()
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(sql, rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.transaction_seconds.observe(time.perf_counter() - started)
+
+    def load(self):
+        """استيراد data.json عند أول تشغيل - البيانات تقرأ من القاعدة عند الطلب"""
+        empty = self._execute(
+            "SELECT NOT EXISTS (SELECT 1 FROM users) AND NOT EXISTS (SELECT 1 FROM groups)"
+        ).fetchone()[0]
+        if empty and os.path.exists(DATA_FILE):
+            old = load_json(DATA_FILE, DEFAULT_DATA)
+            if old.get("users") or old.get("groups"):
+                self._import(old)
+
+    def _import(self, old):
+        """نقل البيانات من data.json إلى القاعدة"""
+        tasbih = load_tasbih_table(old)
+        with data_lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany("INSERT OR IGNORE INTO users (id) VALUES (?)",
+                                      [(u,) for u in old.get("users", [])])
+                self.conn.executemany("INSERT OR IGNORE INTO groups (id) VALUES (?)",
+                                      [(g,) for g in old.get("groups", [])])
+                self.conn.executemany("INSERT OR IGNORE INTO notifications_off VALUES (?)",
+                                      [(t,) for t in old.get("notifications_off", [])])
+                # قبل العدادات: triggers الترتيب تنسخ المجاميع إلى العضويات عند إدخال العدادات
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)",
+                    [(gid, uid) for gid, uids in old.get("group_members", {}).items() for uid in uids]
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO tasbih (user_id, day, c0, c1, c2, c3) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(uid, day, *counts) for uid, counts, day in tasbih.items()]
+                )
+                self.conn.execute(
+                    "UPDATE users SET last_active = "
+                    "COALESCE((SELECT day FROM tasbih WHERE user_id = users.id), 0)"
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        logger.info(f"تم نقل البيانات من {DATA_FILE} إلى {self.path}")
+
+    def add_user(self, user_id):
+        if user_id in self.known_users:
+            return False
+        created = self._execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,)).rowcount == 1
+        self.known_users.add(user_id)
+        return created
+
+    def add_group(self, group_id):
+        if group_id in self.known_groups:
+            return False
+        created = self._execute("INSERT OR IGNORE INTO groups (id) VALUES (?)", (group_id,)).rowcount == 1
+        self.known_groups.add(group_id)
+        return created
+
+    def set_notifications(self, target_id, off):
+        if off:
+            cur = self._execute("INSERT OR IGNORE INTO notifications_off VALUES (?)", (target_id,))
+        else:
+            cur = self._execute("DELETE FROM notifications_off WHERE id = ?", (target_id,))
+        return cur.rowcount == 1
+
+    def is_stale(self, user_id, day):
+        """هل لدى المستخدم عدادات من يوم سابق"""
+        row = self._execute("SELECT day FROM tasbih WHERE user_id = ?", (user_id,)).fetchone()
+        return row is not None and row[0] != day
+
+    def reset_counts(self, user_id, day):
+        """تصفير بعد أي حفظ مؤجل جار - دفعة أخذت قبل التصفير تكتب قبله لا بعده"""
+        with self.flush_lock:
+            with self.pending_lock:
+                self.pending.pop(user_id, None)
+            self._execute(
+                "INSERT INTO tasbih (user_id, day) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET c0 = 0, c1 = 0, c2 = 0, c3 = 0, day = excluded.day",
+                (user_id, day)
+            )
+
+    def get_counts(self, user_id, day):
+        """العدادات لليوم المحدد - سطر من يوم سابق يقرأ كصفر بدون أي كتابة"""
+        row = self._execute(
+            "SELECT c0, c1, c2, c3 FROM tasbih WHERE user_id = ? AND day = ?", (user_id, day)
+        ).fetchone()
+        counts = list(row) if row else [0, 0, 0, 0]
+        with self.pending_lock:
+            pending = self.pending.get(user_id)
+            if pending and pending[0] == day:
+                counts = [min(c + d, TASBIH_LIMITS) for c, d in zip(counts, pending[1])]
+        return dict(zip(TASBIH_KEYS, counts))
+
+    def increment(self, user_id, key, limit, day):
+        """زيادة ذرية للعداد إن لم يصل للحد - ينشئ السطر أو يصفره إن كان من يوم سابق"""
+        i = TASBIH_KEYS.index(key)
+        if self.write_behind:
+            counts = self.get_counts(user_id, day)
+            if counts[key] >= limit:
+                return counts, False
+            with self.pending_lock:
+                pending = self.pending.get(user_id)
+                if not pending or pending[0] != day:
+                    pending = self.pending[user_id] = (day, [0, 0, 0, 0])
+                pending[1][i] += 1
+                self.pending_changes += 1
+            counts[key] += 1
+            return counts, True
+
+        # كل العدادات تصفر إن كان السطر من يوم سابق، ثم يزاد العداد المطلوب
+        sets = ", ".join(
+            f"c{j} = CASE WHEN day = excluded.day THEN c{j} ELSE 0 END{' + 1' if j == i else ''}"
+            for j in range(len(TASBIH_KEYS))
+        )
+        row = self._execute(
+            f"INSERT INTO tasbih (user_id, day, c{i}) VALUES (?, ?, 1) "
+            f"ON CONFLICT (user_id) DO UPDATE SET {sets}, day = excluded.day "
+            f"WHERE tasbih.day != excluded.day OR tasbih.c{i} < ? "
+            "RETURNING c0, c1, c2, c3",
+            (user_id, day, limit)
+        ).fetchone()
+        if row is None:
+            return self.get_counts(user_id, day), False
+        return dict(zip(TASBIH_KEYS, row)), True
+
+    def flush(self):
+        """كتابة الزيادات المؤجلة كفروق ذرية - يعيد (عدد التغييرات، عدد الكتابات)
+        flush_lock من أخذ الدفعة حتى كتابتها (أو إعادتها للمعلق عند الفشل)"""
+        with self.flush_lock:
+            with self.pending_lock:
+                batch, self.pending = self.pending, {}
+                changes, self.pending_changes = self.pending_changes, 0
+            if not batch:
+                return 0, 0
+            # شرط اليوم يمنع إضافة زيادات يوم سابق فوق عدادات يوم أحدث
+            sets = ", ".join(
+                f"c{j} = MIN(CASE WHEN day = excluded.day THEN c{j} ELSE 0 END + excluded.c{j}, {TASBIH_LIMITS})"
+                for j in range(len(TASBIH_KEYS))
+            )
+            try:
+                self._transaction(
+                    "INSERT INTO tasbih (user_id, day, c0, c1, c2, c3) VALUES (?, ?, ?, ?, ?, ?) "
+                    f"ON CONFLICT (user_id) DO UPDATE SET {sets}, day = excluded.day "
+                    "WHERE tasbih.day <= excluded.day",
+                    [(uid, day, *delta) for uid, (day, delta) in batch.items()]
+                )
+            except Exception:
+                self._restore_pending(batch, changes)
+                raise
+            return changes, len(batch)
+
+    def _restore_pending(self, batch, changes):
+        """إعادة دفعة فشلت كتابتها إلى المعلق مع ما أضيف بعدها - فروق نفس اليوم تجمع
+        وفروق يوم أقدم من المعلق الجديد تسقط (اليوم الجديد يصفر تلك العدادات على أي حال)"""
+        with self.pending_lock:
+            for user_id, (day, delta) in batch.items():
+                pending = self.pending.get(user_id)
+                if pending is None:
+                    self.pending[user_id] = (day, delta)
+                elif pending[0] == day:
+                    for i, value in enumerate(delta):
+                        pending[1][i] += value
+            self.pending_changes += changes
+
+    def record_deliveries(self, outcomes, now=None):
+        """تسجيل نتائج الإرسال [(target_id, نوع الخطأ أو None)] في معاملة واحدة - يعيد المعرفات التي أوقفت"""
+        now = now or time.time()
+        succeeded = [(tid, now) for tid, error in outcomes if error is None]
+        failed = [(tid, now, error, int(error in PERMANENT_ERRORS))
+                  for tid, error in outcomes if error is not None]
+        with data_lock:
+            started = time.perf_counter()
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    "INSERT INTO delivery (target_id, last_success) VALUES (?, ?) "
+                    "ON CONFLICT (target_id) DO UPDATE SET last_success = excluded.last_success, "
+                    "consecutive_failures = 0, permanent_failures = 0, error_class = NULL",
+                    succeeded
+                )
+                self.conn.executemany(
+                    "INSERT INTO delivery (target_id, last_failure, error_class, consecutive_failures, "
+                    "permanent_failures) VALUES (?1, ?2, ?3, 1, ?4) "
+                    "ON CONFLICT (target_id) DO UPDATE SET last_failure = excluded.last_failure, "
+                    "error_class = excluded.error_class, "
+                    "consecutive_failures = consecutive_failures + 1, "
+                    "permanent_failures = permanent_failures + excluded.permanent_failures",
+                    failed
+                )
+                deactivated = [r[0] for r in self.conn.execute(
+                    "UPDATE delivery SET inactive = 1 WHERE inactive = 0 AND permanent_failures >= ? "
+                    f"AND target_id IN ({','.join('?' * len(failed))}) RETURNING target_id",
+                    (DELIVERY_MAX_FAILURES, *(row[0] for row in failed))
+                )] if failed else []
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.transaction_seconds.observe(time.perf_counter() - started)
+        self.inactive_ids.update(deactivated)
+        return deactivated
+
+    def deactivate(self, target_id, reason):
+        changed = self._execute(
+            "INSERT INTO delivery (target_id, error_class, inactive) VALUES (?, ?, 1) "
+            "ON CONFLICT (target_id) DO UPDATE SET error_class = excluded.error_class, inactive = 1 "
+            "WHERE inactive = 0",
+            (target_id, reason)
+        ).rowcount == 1
+        self.inactive_ids.add(target_id)
+        return changed
+
+    def _known_inactive(self):
+        """المعرفات الموقوفة المعروفة لهذه العملية - تعاد قراءتها من القاعدة كل INACTIVE_SYNC_SECONDS"""
+        now = time.monotonic()
+        if self.inactive_synced is None or now - self.inactive_synced >= INACTIVE_SYNC_SECONDS:
+            self.inactive_synced = now
+            self.inactive_ids = {r[0] for r in self._execute(
+                "SELECT target_id FROM delivery WHERE inactive = 1"
+            )}
+        return self.inactive_ids
+
+    def reactivate(self, *target_ids, cached=True):
+        """إعادة تفعيل المعرفات الموقوفة - يعيد ما أعيد تفعيله
+        cached: القاعدة لا تقرأ إلا لمعرف في نسخة الموقوفين (ما أوقفته عملية أخرى قد يتأخر
+        حتى المزامنة التالية)، و False للمتابعة والانضمام حيث يجب ألا يفوت أي إيقاف"""
+        target_ids = [tid for tid in target_ids if tid]
+        if cached:
+            inactive = self._known_inactive()
+            target_ids = [tid for tid in target_ids if tid in inactive]
+        if not target_ids:
+            return []
+        marks = ",".join("?" * len(target_ids))
+        revived = [r[0] for r in self._execute(
+            f"SELECT target_id FROM delivery WHERE inactive = 1 AND target_id IN ({marks})", target_ids
+        )]
+        if revived:
+            self._execute(
+                "UPDATE delivery SET inactive = 0, consecutive_failures = 0, permanent_failures = 0, "
+                f"error_class = NULL WHERE target_id IN ({','.join('?' * len(revived))})",
+                revived
+            )
+        self.inactive_ids.difference_update(target_ids)
+        return revived
+
+    def inactive_counts(self, exclude_user=None, exclude_group=None):
+        """عدد المستخدمين والمجموعات الموقوفين الذين كانوا سيستلمون الإرسال الجماعي"""
+        return self._execute(
+            "SELECT COUNT(*) FILTER (WHERE target_id IN (SELECT id FROM users)), "
+            "COUNT(*) FILTER (WHERE target_id IN (SELECT id FROM groups)) "
+            "FROM delivery WHERE inactive = 1 AND target_id NOT IN (?, ?) "
+            "AND target_id NOT IN (SELECT id FROM notifications_off)",
+            (exclude_user or "", exclude_group or "")
+        ).fetchone()
+
+    def delivery_summary(self):
+        """من جدول الإحصائيات - بدون المرور على جدول التوصيل"""
+        values = dict(self._execute(
+            "SELECT key, value FROM aggregates WHERE key IN ('inactive', 'failing') "
+            "OR (key >= 'error:' AND key < 'error;')"
+        ).fetchall())
+        return {
+            "inactive": values.pop("inactive", 0),
+            "failing": values.pop("failing", 0),
+            "by_error": {key[len("error:"):] or None: count for key, count in values.items() if count > 0}
+        }
+
+    def touch(self, user_id, group_id, day):
+        """تسجيل آخر نشاط - كتابة واحدة لكل معرف في اليوم"""
+        for table, target_id in (("users", user_id), ("groups", group_id)):
+            if target_id and self.last_active.get(target_id) != day:
+                self._execute(
+                    f"UPDATE {table} SET last_active = ? WHERE id = ? AND last_active < ?",
+                    (day, target_id, day)
+                )
+                self.last_active.add(target_id, day)
+
+    def recipients(self, exclude_user=None, exclude_group=None, segment="all"):
+        """المستلمون حسب الشريحة - شرط النشاط يستخدم فهرس last_active"""
+        kind, days = parse_segment(segment)
+        day = today_epoch_day()
+        skip = ("SELECT id FROM notifications_off UNION ALL "
+                "SELECT target_id FROM delivery WHERE inactive = 1")
+        users_sql, users_params = f"SELECT id FROM users WHERE id NOT IN ({skip})", ()
+        if kind == "active":
+            users_sql, users_params = users_sql + " AND last_active > ?", (day - days,)
+        elif kind == "incomplete":
+            users_sql += (" AND id NOT IN (SELECT user_id FROM tasbih WHERE day = ? "
+                          f"AND MIN(c0, c1, c2, c3) >= {TASBIH_LIMITS})")
+            users_params = (day,)
+        with data_lock:
+            users = [r[0] for r in self.conn.execute(users_sql, users_params)
+                     if r[0] != exclude_user] if kind != "groups" else []
+            groups = [r[0] for r in self.conn.execute(
+                f"SELECT id FROM groups WHERE id NOT IN ({skip})"
+            ) if r[0] != exclude_group] if kind in ("all", "groups") else []
+        return users, groups
+
+    def filter_receiving(self, target_ids):
+        """المعرفات التي ما زالت تستقبل التذكير (غير مكتومة وغير موقوفة)"""
+        blocked = set()
+        with data_lock:
+            for i in range(0, len(target_ids), 500):
+                chunk = target_ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                blocked.update(r[0] for r in self.conn.execute(
+                    f"SELECT id FROM notifications_off WHERE id IN ({marks}) UNION ALL "
+                    f"SELECT target_id FROM delivery WHERE inactive = 1 AND target_id IN ({marks})",
+                    chunk + chunk
+                ))
+        return [target_id for target_id in target_ids if target_id not in blocked]
+
+    def add_member(self, group_id, user_id):
+        """تسجيل العضوية مرة واحدة مع مجموع المستخدم الحالي - كتابة واحدة لكل عضو في العملية"""
+        if (group_id, user_id) in self.known_members:
+            return False
+        created = self._execute(
+            "INSERT OR IGNORE INTO group_members (group_id, user_id, day, score, scored_at) "
+            "SELECT ?1, ?2, COALESCE(MAX(day), 0), COALESCE(MAX(c0 + c1 + c2 + c3), 0), julianday('now') "
+            "FROM tasbih WHERE user_id = ?2",
+            (group_id, user_id)
+        ).rowcount == 1
+        self.known_members.add((group_id, user_id))
+        return created
+
+    def group_board(self, group_id, day, limit):
+        """[(user_id، المجموع)] للأعلى أولا - مع الحفظ المؤجل يظهر التغيير بعد الحفظ التالي"""
+        return self._execute(
+            "SELECT user_id, score FROM group_members WHERE group_id = ? AND day = ? AND score > 0 "
+            "ORDER BY score DESC, scored_at LIMIT ?",
+            (group_id, day, limit)
+        ).fetchall()
+
+    def group_summary(self, group_id, day):
+        members, active, total, completed = self._execute(
+            "SELECT COUNT(*), COUNT(*) FILTER (WHERE day = ?1 AND score > 0), "
+            "COALESCE(SUM(score) FILTER (WHERE day = ?1), 0), "
+            f"COUNT(*) FILTER (WHERE day = ?1 AND score >= {TASBIH_COMPLETE_SCORE}) "
+            "FROM group_members WHERE group_id = ?2",
+            (day, group_id)
+        ).fetchone()
+        return {
+            "members": members,
+            "active_today": active,
+            "total_today": total,
+            "completed_today": completed
+        }
+
+    def summary(self, day=None):
+        day = today_epoch_day() if day is None else day
+        with data_lock:
+            values = dict(self.conn.execute("SELECT key, value FROM aggregates"))
+            completed = self.conn.execute(
+                "SELECT users FROM completions WHERE day = ?", (day,)
+            ).fetchone()
+        totals = [values[f"c{i}"] for i in range(len(TASBIH_KEYS))]
+        return {
+            "users": values["users"],
+            "groups": values["groups"],
+            "notifications_off": values["notifications_off"],
+            "total_tasbih": sum(totals),
+            "total_per_key": dict(zip(TASBIH_KEYS, totals)),
+            "completed_today": completed[0] if completed else 0,
+            "active_users": values["active_users"],
+            "active_receivers": values["active_receivers"]
+        }
+
+def create_store():
+    """إنشاء طبقة التخزين حسب STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "json":
+        return JsonStore(DATA_FILE, write_behind=WRITE_BEHIND_ENABLED)
+    return SqliteStore(DB_FILE, write_behind=WRITE_BEHIND_ENABLED)
 
 # تحميل البيانات
-data = load_json(DATA_FILE, {
-    "users": [], 
-    "groups": [], 
-    "tasbih": {}, 
-    "last_reset": {},
-    "notifications_off": []
-})
-target_users = set(data.get("users", []))
-target_groups = set(data.get("groups", []))
-tasbih_counts = data.get("tasbih", {})
-last_reset_dates = data.get("last_reset", {})
-notifications_off = set(data.get("notifications_off", []))
-
-content = load_json(CONTENT_FILE, {"adhkar": []})
-fadl_content = load_json("fadl.json", {"fadl": []}).get("fadl", [])
+store = create_store()
+store.load()
 
-TASBIH_LIMITS = 33
-TASBIH_KEYS = ["استغفر الله", "سبحان الله", "الحمد لله", "الله أكبر"]
+# ========================================
+# الحفظ المؤجل لعدادات التسبيح
+# ========================================
+flush_event = threading.Event()
+flush_stats = {"flushes": 0, "changes": 0, "rows_written": 0}
+
+def maybe_flush():
+    """طلب الحفظ مبكرا عند تجاوز حد التغييرات المعلقة"""
+    if WRITE_BEHIND_ENABLED and store.pending_changes >= FLUSH_THRESHOLD:
+        flush_event.set()
+
+def flush_counts():
+    """حفظ جميع العدادات المعلقة دفعة واحدة"""
+    changes, rows = store.flush()
+    if not changes:
+        return 0
+
+    flush_stats["flushes"] += 1
+    flush_stats["changes"] += changes
+    flush_stats["rows_written"] += rows
+    logger.info(f"الحفظ المؤجل: {changes} تغيير في {rows} سجل (تم دمج {changes - rows})")
+    return rows
+
+def write_behind_flusher():
+    """حفظ العدادات المعلقة كل فترة أو عند تجاوز الحد"""
+    while True:
+        flush_event.wait(FLUSH_INTERVAL_SECONDS)
+        flush_event.clear()
+        try:
+            flush_counts()
+        except Exception as e:
+            logger.error(f"خطأ في الحفظ المؤجل: {e}")
+
+# ========================================
+# المحتوى وتدويره
+# ========================================
+class ContentLibrary:
+    """مجموعات المحتوى (أذكار، فضل) مع إعادة التحميل عند تعديل الملف"""
+
+    def __init__(self, pools, check_seconds):
+        self.pools = pools  # اسم المجموعة -> (الملف، المفتاح)
+        self.check_seconds = check_seconds
+        self.items_by_pool = {}
+        self.versions = {}
+        self.mtimes = {}
+        self.checked_at = None  # لا تحميل عند الاستيراد - أول استخدام يقرأ الملفات
+        self.reloads = 0
+        self.lock = threading.Lock()
+
+    def reload(self):
+        """تحميل الملفات التي تغير وقت تعديلها - ملف تالف لا يلغي المحتوى الحالي"""
+        with self.lock:
+            self.checked_at = time.monotonic()
+            for pool, (path, key) in self.pools.items():
+                try:
+                    if not os.path.exists(path):
+                        load_json(path, {key: []})  # إنشاء الملف إن لم يكن موجودا
+                    mtime = os.stat(path).st_mtime_ns
+                    if mtime == self.mtimes.get(pool):
+                        continue
+                    with open(path, "r", encoding="utf-8") as f:
+                        # بدون تكرار حتى لا يظهر نفس النص مرتين في دورة واحدة
+                        items = list(dict.fromkeys(item for item in json.load(f).get(key, [])
+                                                   if isinstance(item, str) and item.strip()))
+                except Exception as e:
+                    logger.error(f"خطأ في تحميل {path}: {e}")
+                    continue
+                if pool in self.mtimes:
+                    self.reloads += 1
+                    logger.info(f"تمت إعادة تحميل {path}: {len(items)} عنصر")
+                self.mtimes[pool] = mtime
+                self.items_by_pool[pool] = items
+                self.versions[pool] = zlib.crc32("\0".join(items).encode())
+
+    def _maybe_reload(self):
+        if self.checked_at is None or time.monotonic() - self.checked_at >= self.check_seconds:
+            self.reload()
+
+    def items(self, pool):
+        self._maybe_reload()
+        return self.items_by_pool.get(pool, [])
+
+    def snapshot(self, pool):
+        """(العناصر، رقم النسخة) من نفس التحميل"""
+        self._maybe_reload()
+        with self.lock:
+            return self.items_by_pool.get(pool, []), self.versions.get(pool, 0)
+
+    def summary(self):
+        self._maybe_reload()
+        with self.lock:
+            return {
+                **{f"{pool}_count": len(items) for pool, items in self.items_by_pool.items()},
+                "reloads": self.reloads
+            }
+
+content_library = ContentLibrary(
+    {"adhkar": (CONTENT_FILE, "adhkar"), "fadl": (FADL_FILE, "fadl")}, CONTENT_RELOAD_SECONDS
+)
+
+@functools.lru_cache(maxsize=32)
+def deck_multipliers(size):
+    """المضاعفات الأولية نسبيا مع حجم المجموعة - كل منها يعطي تبديلا (a*i + b) mod size"""
+    multipliers = [a for a in range(2, size) if gcd(a, size) == 1]
+    return multipliers or [1]
+
+def deck_index(seed, position, size):
+    """العنصر في الموضع المطلوب من ترتيب المستلم: نفس الترتيب يتكرر كل size موضع
+    فلا يتكرر عنصر داخل أي size رسالة متتالية - حساب O(1) بدون تخزين الترتيب"""
+    multipliers = deck_multipliers(size)
+    a = multipliers[seed % len(multipliers)]
+    b = (seed >> 20) % size
+    return (a * (position % size) + b) % size
+
+class ContentRotation:
+    """تدوير عادل للمحتوى: لكل مستلم ترتيب خاص محفوظ كبذرة + مؤشر في SQLite
+    ويعاد خلطه عند تغير محتوى المجموعة"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS content_rotation (
+        target_id TEXT NOT NULL,
+        pool TEXT NOT NULL,
+        seed INTEGER NOT NULL,
+        cursor INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (target_id, pool)
+    ) WITHOUT ROWID;
+    """
+
+    CHUNK = 500  # حد المعرفات في استعلام IN واحد
+
+    def __init__(self, path, library):
+        self.path = path
+        self.conn = open_db(path)
+        self.conn.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+        self.library = library
+
+    def pick(self, pool, target_id):
+        """العنصر التالي للمستلم - None إذا كانت المجموعة فارغة"""
+        items, version = self.library.snapshot(pool)
+        if not items:
+            return None
+        # المؤشر يمثل عدد ما أرسل - زيادته ذرية بين العمليات
+        with self.lock:
+            seed, cursor = execute_write(
+                self.conn,
+                "INSERT INTO content_rotation VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (target_id, pool) DO UPDATE SET "
+                "cursor = CASE WHEN version = excluded.version THEN cursor + 1 ELSE 1 END, "
+                "seed = CASE WHEN version = excluded.version THEN seed ELSE excluded.seed END, "
+                "version = excluded.version RETURNING seed, cursor",
+                (target_id, pool, random.getrandbits(62), version)
+            ).fetchone()
+        return items[deck_index(seed, cursor - 1, len(items))]
+
+    def pick_many(self, pool, target_ids):
+        """العنصر التالي لكل مستلم في إرسال جماعي: قراءة ثم كتابة دفعة واحدة - O(1) لكل مستلم"""
+        items, version = self.library.snapshot(pool)
+        if not items or not target_ids:
+            return {}
+        size = len(items)
+        picks, rows = {}, []
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                states = {}
+                for i in range(0, len(target_ids), self.CHUNK):
+                    chunk = target_ids[i:i + self.CHUNK]
+                    states.update((r[0], r[1:]) for r in self.conn.execute(
+                        "SELECT target_id, seed, cursor, version FROM content_rotation "
+                        f"WHERE pool = ? AND target_id IN ({','.join('?' * len(chunk))})",
+                        (pool, *chunk)
+                    ))
+                for target_id in target_ids:
+                    seed, cursor, row_version = states.get(target_id, (None, 0, None))
+                    if row_version != version:
+                        seed, cursor = random.getrandbits(62), 0
+                    picks[target_id] = items[deck_index(seed, cursor, size)]
+                    rows.append((target_id, pool, seed, cursor + 1, version))
+                self.conn.executemany("INSERT OR REPLACE INTO content_rotation VALUES (?, ?, ?, ?, ?)", rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return picks
+
+content_rotation = ContentRotation(DB_FILE, content_library)
 
 # إعدادات التذكير التلقائي
 AUTO_REMINDER_ENABLED = True
 MIN_INTERVAL_HOURS = 1
 MAX_INTERVAL_HOURS = 8
 
+# شريحة التذكير التلقائي (انظر parse_segment)
+AUTO_REMINDER_SEGMENT = os.getenv("AUTO_REMINDER_SEGMENT", "all")
+
+# إعدادات الإرسال الجماعي
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 8))
+# حد القناة كاملة (رسالة في الثانية): كل عامل gunicorn يرسل فيأخذ كل منهم PUSH_RATE_LIMIT / عدد العمال
+# (عدد العمال من post_fork في gunicorn.conf.py أو WEB_CONCURRENCY، انظر start_background_services)
+PUSH_RATE_LIMIT = float(os.getenv("PUSH_RATE_LIMIT", 200))
+SEND_MAX_RETRIES = 3
+SEND_RETRY_BASE_SECONDS = 1
+
+# الإرسال المتعدد: طلب واحد لكل 500 مستخدم بدلا من طلب لكل مستخدم
+MULTICAST_ENABLED = os.getenv("MULTICAST", "false").lower() == "true"
+MULTICAST_CHUNK_SIZE = 500
+
+# شرائح الإرسال الجماعي
+SEGMENTS = ("all", "users", "groups", "active", "incomplete")
+DEFAULT_ACTIVE_DAYS = 7
+
+def parse_segment(segment):
+    """تحليل الشريحة إلى (النوع، عدد الأيام):
+    all | users | groups | active:N (مستخدمون نشطون آخر N يوم) | incomplete (لم يكملوا تسبيح اليوم)"""
+    kind, _, days = (segment or "all").strip().lower().partition(":")
+    if kind not in SEGMENTS or (days and kind != "active"):
+        raise ValueError(f"شريحة غير معروفة: {segment}")
+    days = int(days) if days else DEFAULT_ACTIVE_DAYS
+    if days < 1:
+        raise ValueError(f"عدد أيام غير صالح: {segment}")
+    return kind, days
+
+class TokenBucket:
+    """محدد معدل الإرسال (Token Bucket) مشترك بين الخيوط"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """الانتظار حتى يتوفر رصيد للإرسال"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.capacity = rate
+            self.tokens = min(self.tokens, rate)
+
+push_rate_limiter = TokenBucket(PUSH_RATE_LIMIT)
+
 def extract_links(text):
     """استخراج الروابط من النص"""
     url_pattern = r'(https?://\S+|www\.\S+)'
     return re.findall(url_pattern, text)
 
-def get_next_fadl():
-    """الحصول على فضل عشوائي"""
-    if not fadl_content:
-        return "لا يوجد فضل متاح حاليا"
-    return random.choice(fadl_content)
+def normalize_link(link):
+    """توحيد صيغة الرابط: بدون البروتوكول و www والعلامات في النهاية
+    البروتوكول والنطاق فقط بحروف صغيرة - المسار والاستعلام يفرقان بين الحروف (روابط مختصرة مثلا)"""
+    link = link.split("#", 1)[0].rstrip(".,!?؟،)]}\"'/")
+    scheme, sep, rest = link.partition("://")
+    if sep and scheme.lower() in ("http", "https"):
+        link = rest
+    host_end = re.match(r"[^/?]*", link).end()
+    host = link[:host_end].lower()
+    if host.startswith("www."):
+        host = host[len("www."):]
+    return host + link[host_end:]
+
+class LinkIndex:
+    """فهرس روابط محدود: مجموعات زمنية تحذف كاملة عند خروجها من النافذة"""
+
+    def __init__(self, window_seconds, buckets, max_entries):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = window_seconds / buckets
+        self.num_buckets = buckets
+        self.max_entries = max_entries
+        self.buckets = deque()  # (رقم الفترة، مجموعة بصمات الروابط)
+        self.size = 0
+        self.repeats = 0
+        self.lock = threading.Lock()
+
+    def _rotate(self, now):
+        current = int(now // self.bucket_seconds)
+        while self.buckets and (
+            self.buckets[0][0] <= current - self.num_buckets or self.size > self.max_entries
+        ):
+            self.size -= len(self.buckets.popleft()[1])
+        if not self.buckets or self.buckets[-1][0] != current:
+            self.buckets.append((current, set()))
+
+    def seen_or_add(self, group_id, user_id, link):
+        """True إذا نشر المستخدم الرابط في هذه المجموعة خلال النافذة، وإلا يسجله"""
+        key = hash((group_id, user_id, normalize_link(link)))
+        with self.lock:
+            self._rotate(time.time())
+            for _, bucket in self.buckets:
+                if key in bucket:
+                    self.repeats += 1
+                    return True
+            self.buckets[-1][1].add(key)
+            self.size += 1
+            return False
+
+    def summary(self):
+        with self.lock:
+            memory = sum(sys.getsizeof(bucket) for _, bucket in self.buckets) + self.size * 32
+            return {
+                "entries": self.size,
+                "buckets": len(self.buckets),
+                "window_seconds": self.window_seconds,
+                "max_entries": self.max_entries,
+                "memory_bytes": memory,
+                "repeats_blocked": self.repeats
+            }
+
+class SharedLinkIndex:
+    """فهرس الروابط في SQLite - مشترك بين عمال gunicorn فلا يفوت تكرار وصل إلى عامل آخر
+    محدود بالنافذة و LINK_MAX_ENTRIES مثل EventDeduplicator"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS links (
+        key INTEGER PRIMARY KEY,
+        seen_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS links_seen ON links (seen_at);
+    """
+
+    def __init__(self, path, window_seconds, max_entries):
+        self.path = path
+        self.conn = open_db(path)
+        self.conn.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.added = 0
+        self.repeats = 0
+        self.prunes = 0
+        with self.lock:
+            self._measure(size=True)
+
+    def _measure(self, size):
+        """عدد السطور عند البدء وبعد كل تنظيف، والحجم على القرص كل 10 تنظيفات (dbstat يمر على
+        كل صفحات الجدول) - لا استعلام مع /stats، وما بينهما يزاد مع كل إدراج من هذه العملية"""
+        self.entries = self.conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+        if not size:
+            return
+        try:
+            self.table_bytes = self.conn.execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name IN ('links', 'links_seen')"
+            ).fetchone()[0]
+        except sqlite3.OperationalError:
+            # SQLite بدون SQLITE_ENABLE_DBSTAT_VTAB: تقدير من عدد السطور (مفتاح ووقت في الجدول والفهرس)
+            self.table_bytes = self.entries * 48
+
+    @staticmethod
+    def _key(group_id, user_id, link):
+        """بصمة 64 بت ثابتة بين العمليات (hash في بايثون يختلف مع كل تشغيل)"""
+        digest = hashlib.blake2b(
+            f"{group_id}\0{user_id}\0{normalize_link(link)}".encode(), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+    def seen_or_add(self, group_id, user_id, link):
+        """True إذا نشر المستخدم الرابط في هذه المجموعة خلال النافذة، وإلا يسجله
+        كتابة واحدة ذرية: تدرج البصمة أو تجدد إن كانت أقدم من النافذة، وإلا فهي تكرار"""
+        now = time.time()
+        with self.lock:
+            new = execute_write(
+                self.conn,
+                "INSERT INTO links VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET seen_at = excluded.seen_at WHERE links.seen_at < ?",
+                (self._key(group_id, user_id, link), now, now - self.window_seconds)
+            ).rowcount == 1
+            if not new:
+                self.repeats += 1
+                return True
+            self.added += 1
+            self.entries += 1
+            if self.added % LINK_PRUNE_EVERY == 0:
+                self._prune(now)
+            return False
+
+    def _prune(self, now):
+        self.conn.execute("DELETE FROM links WHERE seen_at < ?", (now - self.window_seconds,))
+        self.conn.execute(
+            "DELETE FROM links WHERE seen_at <= (SELECT seen_at FROM links "
+            "ORDER BY seen_at DESC LIMIT 1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        self.prunes += 1
+        self._measure(size=self.prunes % 10 == 0)
+
+    def summary(self):
+        with self.lock:
+            return {
+                "entries": self.entries,
+                "table_bytes": self.table_bytes,
+                "shared": True,
+                "window_seconds": self.window_seconds,
+                "max_entries": self.max_entries,
+                "repeats_blocked": self.repeats
+            }
+
+if STORAGE_BACKEND == "json":
+    link_index = LinkIndex(LINK_WINDOW_SECONDS, LINK_BUCKETS, LINK_MAX_ENTRIES)
+else:
+    link_index = SharedLinkIndex(DB_FILE, LINK_WINDOW_SECONDS, LINK_MAX_ENTRIES)
+
+def get_next_fadl(target_id):
+    """الفضل التالي في ترتيب المستخدم أو المجموعة"""
+    return content_rotation.pick("fadl", target_id) or "لا يوجد فضل متاح حاليا"
 
-def send_message(target_id, text):
-    """إرسال رسالة إلى مستخدم أو مجموعة"""
+# ========================================
+# عميل LINE المشترك
+# ========================================
+messaging_api = None
+messaging_api_pid = None
+messaging_api_lock = threading.Lock()
+api_latency = {}  # نوع الطلب -> {count, errors, total_ms, max_ms}
+api_latency_lock = threading.Lock()
+
+def get_messaging_api():
+    """عميل Messaging API واحد لكل عملية مع مجمع اتصالات يعاد استخدامه"""
+    global messaging_api, messaging_api_pid
+    # العملية الفرعية (fork) لا تشارك اتصالات العملية الأم
+    if messaging_api is None or messaging_api_pid != os.getpid():
+        with messaging_api_lock:
+            if messaging_api is None or messaging_api_pid != os.getpid():
+                messaging_api = MessagingApi(ApiClient(configuration))
+                messaging_api_pid = os.getpid()
+    return messaging_api
+
+def record_latency(kind, started, ok=True):
+    """تسجيل زمن طلب LINE حسب نوعه"""
+    elapsed = time.perf_counter() - started
+    line_api_seconds.labels(kind).observe(elapsed)
+    elapsed_ms = elapsed * 1000
+    with api_latency_lock:
+        entry = api_latency.setdefault(kind, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        entry["count"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+        if not ok:
+            entry["errors"] += 1
+
+def call_line_api(kind, call):
+    """تنفيذ طلب على العميل المشترك مع قياس الزمن"""
+    started = time.perf_counter()
     try:
-        with ApiClient(configuration) as api_client:
-            api = MessagingApi(api_client)
-            api.push_message(PushMessageRequest(to=target_id, messages=[TextMessage(text=text)]))
-        return True
-    except Exception as e:
-        error_str = str(e)
-        if "400" not in error_str and "403" not in error_str:
-            logger.error(f"فشل الإرسال إلى {target_id}: {e}")
+        result = call(get_messaging_api())
+    except Exception:
+        record_latency(kind, started, ok=False)
+        raise
+    record_latency(kind, started)
+    return result
+
+def api_latency_summary():
+    """ملخص أزمنة طلبات LINE"""
+    with api_latency_lock:
+        return {
+            kind: {
+                "count": entry["count"],
+                "errors": entry["errors"],
+                "avg_ms": round(entry["total_ms"] / entry["count"], 2),
+                "max_ms": round(entry["max_ms"], 2)
+            }
+            for kind, entry in api_latency.items()
+        }
+
+# أخطاء لا يفيد معها التكرار: معرف غير صالح، حظر البوت، أو مغادرة المجموعة
+# (bad_payload - 400 بسبب الرسالة نفسها - ليس منها: يصيب كل المستلمين ولا يدل على معرف معطل)
+PERMANENT_ERRORS = frozenset({"bad_request", "forbidden", "not_found"})
+
+def is_recipient_error(body):
+    """هل خطأ 400 بسبب المستلم (الخاصية to أو to[i]) وليس محتوى الرسالة
+    مثال: {"message": "The property, 'to', in the request body is invalid ..."}
+    أو details: [{"property": "to[3]", ...}] - نص غير مفهوم لا يعد خطأ مستلم"""
+    try:
+        payload = json.loads(body)
+    except (TypeError, ValueError):
+        return False
+    if not isinstance(payload, dict):
         return False
+    properties = [detail.get("property") or "" for detail in payload.get("details") or ()
+                  if isinstance(detail, dict)]
+    if properties:
+        return all(prop == "to" or prop.startswith("to[") for prop in properties)
+    return "'to" in str(payload.get("message", ""))
+
+def classify_error(error):
+    """نوع خطأ الإرسال لتتبع حالة المستلم"""
+    status = getattr(error, "status", None)
+    if status is None:
+        return "network"
+    if status >= 500:
+        return "server"
+    if status == 400:
+        return "bad_request" if is_recipient_error(getattr(error, "body", None)) else "bad_payload"
+    return {403: "forbidden", 404: "not_found", 429: "rate_limited"}.get(status, f"http_{status}")
+
+def is_retryable(status):
+    """الأخطاء المؤقتة التي تستحق إعادة المحاولة"""
+    return status == 429 or (status is not None and status >= 500)
+
+def retry_delay(error, attempt):
+    """مدة الانتظار قبل إعادة المحاولة - Retry-After أو تراجع أسي"""
+    headers = getattr(error, "headers", None)
+    retry_after = headers.get("Retry-After") if headers else None
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return SEND_RETRY_BASE_SECONDS * (2 ** attempt) + random.uniform(0, 0.5)
+
+def push_with_retry(kind, call, target):
+    """تنفيذ طلب إرسال مع إعادة المحاولة عند 429/5xx وأخطاء الشبكة - يعيد None أو نوع الخطأ
+    call(api, retry_key): نفس مفتاح X-Line-Retry-Key في كل المحاولات حتى لا تكرر LINE رسالة
+    قبلتها في محاولة انقطع ردها، وترد على المكرر بـ 409 فيعد نجاحا"""
+    retry_key = str(uuid.uuid4())
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        push_rate_limiter.acquire()
+        try:
+            call_line_api(kind, lambda api: call(api, retry_key))
+            return None
+        except ApiException as e:
+            if e.status == 409:
+                return None
+            if not is_retryable(e.status) or attempt == SEND_MAX_RETRIES:
+                if e.status not in (400, 403, 404):
+                    logger.error(f"فشل الإرسال إلى {target}: {e.status} {e.reason}")
+                return classify_error(e)
+            delay = retry_delay(e, attempt)
+        except Exception as e:
+            # أخطاء الشبكة مؤقتة غالبا
+            if attempt == SEND_MAX_RETRIES:
+                logger.error(f"فشل الإرسال إلى {target}: {e}")
+                return classify_error(e)
+            delay = retry_delay(e, attempt)
+        time.sleep(delay)
+    return "network"
+
+def deliver(target_id, text):
+    """إرسال رسالة إلى مستخدم أو مجموعة - يعيد None عند النجاح أو نوع الخطأ"""
+    return push_with_retry(
+        "push",
+        lambda api, retry_key: api.push_message(
+            PushMessageRequest(to=target_id, messages=[TextMessage(text=text)]), x_line_retry_key=retry_key
+        ),
+        target_id
+    )
+
+def send_message(target_id, text):
+    """إرسال رسالة إلى مستخدم أو مجموعة مع تسجيل حالة التوصيل"""
+    error = deliver(target_id, text)
+    store.record_deliveries([(target_id, error)])
+    return error is None
+
+def multicast_message(user_ids, text):
+    """إرسال رسالة لعدة مستخدمين (حتى 500) بطلب واحد - يعيد None عند النجاح أو نوع الخطأ"""
+    return push_with_retry(
+        "multicast",
+        lambda api, retry_key: api.multicast(
+            MulticastRequest(to=user_ids, messages=[TextMessage(text=text)]), x_line_retry_key=retry_key
+        ),
+        f"{len(user_ids)} مستخدم"
+    )
+
+def send_multicast_chunk(user_ids, text):
+    """إرسال دفعة مستخدمين - يعيد [(user_id, نوع الخطأ أو None)]
+    الإرسال الفردي فقط عند bad_request لتحديد المعرفات المعطلة، أما 429/5xx والشبكة فتفشل
+    الدفعة كاملة بنفس الخطأ: الإرسال الفردي أثناء التقييد أو الانقطاع يضاعف الطلبات 500 مرة"""
+    error = multicast_message(user_ids, text)
+    if error is None:
+        return [(uid, None) for uid in user_ids]
+    if error != "bad_request":
+        logger.warning(f"فشل الإرسال المتعدد لـ {len(user_ids)} مستخدم ({error}) - بدون إرسال فردي")
+        return [(uid, error) for uid in user_ids]
+
+    logger.warning(f"فشل الإرسال المتعدد لـ {len(user_ids)} مستخدم - التحويل إلى الإرسال الفردي")
+    return [(uid, deliver(uid, text)) for uid in user_ids]
 
 def reply_message(reply_token, text):
     """الرد على رسالة"""
     try:
-        with ApiClient(configuration) as api_client:
-            api = MessagingApi(api_client)
-            api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=text)]))
+        call_line_api("reply", lambda api: api.reply_message(
+            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=text)])
+        ))
         return True
     except Exception as e:
         logger.error(f"فشل الرد: {e}")
         return False
 
-def broadcast_text(text, exclude_user=None, exclude_group=None):
-    """إرسال رسالة جماعية لجميع المستخدمين والمجموعات"""
-    sent, failed = 0, 0
-    
-    for uid in list(target_users):
-        if uid != exclude_user and uid not in notifications_off:
-            if send_message(uid, text):
-                sent += 1
-            else:
-                failed += 1
-    
-    for gid in list(target_groups):
-        if gid != exclude_group and gid not in notifications_off:
-            if send_message(gid, text):
-                sent += 1
-            else:
-                failed += 1
-    
-    logger.info(f"الإرسال الجماعي: {sent} نجح، {failed} فشل")
+def delivery_tasks(users, groups, text_for, multicast):
+    """مهام الإرسال - كل مهمة تعيد [(المعرف، نوع الخطأ أو None)] والمجموعات ترسل دائما فرديا"""
+    tasks = []
+    single_targets = groups
+    if multicast:
+        # المستخدمون الذين لهم نفس النص يجمعون في طلبات متعددة الإرسال
+        by_text = {}
+        for uid in users:
+            by_text.setdefault(text_for(uid), []).append(uid)
+        for message, user_ids in by_text.items():
+            for i in range(0, len(user_ids), MULTICAST_CHUNK_SIZE):
+                chunk = user_ids[i:i + MULTICAST_CHUNK_SIZE]
+                tasks.append(lambda chunk=chunk, message=message: send_multicast_chunk(chunk, message))
+    else:
+        single_targets = users + groups
+    for target_id in single_targets:
+        tasks.append(lambda target_id=target_id: [(target_id, deliver(target_id, text_for(target_id)))])
+    return tasks
+
+def run_delivery_tasks(executor, tasks):
+    return [outcome for result in executor.map(lambda task: task(), tasks) for outcome in result]
+
+def is_user_id(target_id):
+    """معرفات LINE: المستخدم يبدأ بـ U (المجموعة C والغرفة R) - الإرسال المتعدد للمستخدمين فقط"""
+    return target_id.startswith("U")
+
+def broadcast_text(text=None, exclude_user=None, exclude_group=None, multicast=None, segment="all", pool=None):
+    """إرسال رسالة جماعية لشريحة من المستخدمين والمجموعات بالتوازي
+    pool: بدلا من نص واحد يأخذ كل مستلم العنصر التالي من ترتيبه في fadl أو adhkar"""
+    if multicast is None:
+        multicast = MULTICAST_ENABLED
+
+    kind, _ = parse_segment(segment)
+    users, groups = store.recipients(exclude_user, exclude_group, segment)
+    # الموقوفون يحسبون للشرائح الكاملة فقط - شرائح النشاط والتسبيح لا تحسبهم
+    skipped = (0, 0)
+    if kind in ("all", "users", "groups"):
+        skipped_users, skipped_groups = store.inactive_counts(exclude_user, exclude_group)
+        skipped = (skipped_users if kind != "groups" else 0, skipped_groups if kind != "users" else 0)
+
+    started = time.monotonic()
+    # نص كل مستلم يحسب مرة واحدة قبل الإرسال
+    if pool:
+        texts = content_rotation.pick_many(pool, users + groups)
+        users = [uid for uid in users if uid in texts]
+        groups = [gid for gid in groups if gid in texts]
+        text_for = texts.__getitem__
+    else:
+        text_for = lambda target_id: text
+
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY) as executor:
+        outcomes = run_delivery_tasks(executor, delivery_tasks(users, groups, text_for, multicast))
+
+    sent = sum(error is None for _, error in outcomes)
+    failed = len(outcomes) - sent
+    deactivated = store.record_deliveries(outcomes)
+    record_pruning(skipped, len(users), multicast, len(deactivated))
+    elapsed = time.monotonic() - started
+    broadcast_seconds.observe(elapsed)
+    broadcast_throughput.observe(len(outcomes) / elapsed if elapsed > 0 else 0)
+    broadcast_messages.inc(sent, "sent")
+    broadcast_messages.inc(failed, "failed")
+    logger.info(f"الإرسال الجماعي ({segment}): {sent} نجح، {failed} فشل خلال {elapsed:.1f} ثانية")
+    if deactivated:
+        logger.info(f"تم إيقاف الإرسال إلى {len(deactivated)} مستلم بعد أخطاء دائمة متكررة")
     return sent, failed
 
+# المستلمون الموقوفون الذين تم تخطيهم في الإرسال الجماعي (لهذه العملية)
+delivery_stats = {"broadcasts": 0, "recipients_skipped": 0, "calls_saved": 0, "deactivated": 0}
+delivery_stats_lock = threading.Lock()
+
+def record_pruning(skipped, active_users, multicast, deactivated):
+    """حساب الطلبات التي تم توفيرها بتخطي المستلمين الموقوفين"""
+    skipped_users, skipped_groups = skipped
+    saved_users = skipped_users
+    if multicast:
+        chunks = lambda count: -(-count // MULTICAST_CHUNK_SIZE)
+        saved_users = chunks(active_users + skipped_users) - chunks(active_users)
+    with delivery_stats_lock:
+        delivery_stats["broadcasts"] += 1
+        delivery_stats["recipients_skipped"] += skipped_users + skipped_groups
+        delivery_stats["calls_saved"] += saved_users + skipped_groups
+        delivery_stats["deactivated"] += deactivated
+
+class ProfileCache:
+    """ذاكرة مؤقتة محدودة الحجم للأسماء مع انتهاء صلاحية وحذف الأقدم استخداما"""
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()  # (group_id, user_id) -> (name أو None, وقت الانتهاء)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """إرجاع (موجود، الاسم) - الاسم None يعني فشل سابق"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, name):
+        ttl = self.ttl if name is not None else self.negative_ttl
+        with self.lock:
+            self.entries[key] = (name, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def summary(self):
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.negative_hits) / lookups, 3) if lookups else 0
+            }
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, PROFILE_NEGATIVE_TTL)
+
+def fetch_display_name(group_id, user_id, fetch):
+    """جلب الاسم من LINE وتخزينه - None عند الفشل"""
+    try:
+        name = call_line_api("profile", fetch).display_name
+    except Exception:
+        name = None
+    profile_cache.put((group_id, user_id), name)
+    return name
+
+def cached_display_name(group_id, user_id, fetch):
+    """جلب الاسم من الذاكرة المؤقتة أو من LINE عند عدم وجوده"""
+    found, name = profile_cache.get((group_id, user_id))
+    if not found:
+        name = fetch_display_name(group_id, user_id, fetch)
+    return name if name is not None else "المستخدم"
+
 def get_user_name(user_id):
     """الحصول على اسم المستخدم"""
-    try:
-        with ApiClient(configuration) as api_client:
-            api = MessagingApi(api_client)
-            profile = api.get_profile(user_id)
-            return profile.display_name
-    except:
-        return "المستخدم"
+    return cached_display_name(None, user_id, lambda api: api.get_profile(user_id))
 
 def get_group_member_name(group_id, user_id):
     """الحصول على اسم عضو في المجموعة"""
-    try:
-        with ApiClient(configuration) as api_client:
-            api = MessagingApi(api_client)
-            profile = api.get_group_member_profile(group_id, user_id)
-            return profile.display_name
-    except:
-        return "المستخدم"
-
-def ensure_user_counts(uid):
-    """التأكد من وجود بيانات التسبيح للمستخدم"""
-    if uid not in tasbih_counts:
-        tasbih_counts[uid] = {key: 0 for key in TASBIH_KEYS}
-        last_reset_dates[uid] = str(date.today())
-        save_data()
-        logger.info(f"تم إنشاء بيانات تسبيح جديدة للمستخدم: {uid}")
-
-def reset_tasbih_if_needed(user_id):
-    """تصفير التسبيح إذا كان يوم جديد"""
-    today = str(date.today())
-    last_reset = last_reset_dates.get(user_id)
-    
-    if last_reset != today:
-        tasbih_counts[user_id] = {key: 0 for key in TASBIH_KEYS}
-        last_reset_dates[user_id] = today
-        save_data()
-        logger.info(f"تم تصفير التسبيح تلقائيًا للمستخدم: {user_id}")
-        return True
-    return False
-
-def get_tasbih_status(user_id, gid=None):
+    return cached_display_name(
+        group_id, user_id, lambda api: api.get_group_member_profile(group_id, user_id)
+    )
+
+def get_group_member_names(group_id, user_ids):
+    """أسماء عدة أعضاء دفعة واحدة: المخزن من الذاكرة المؤقتة والباقي من LINE بالتوازي
+    (LINE لا يوفر جلب عدة أسماء بطلب واحد) - يعيد user_id -> الاسم"""
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        found, name = profile_cache.get((group_id, user_id))
+        if found:
+            names[user_id] = name
+        else:
+            missing.append(user_id)
+    if missing:
+        def fetch(user_id):
+            return fetch_display_name(
+                group_id, user_id, lambda api: api.get_group_member_profile(group_id, user_id)
+            )
+        with ThreadPoolExecutor(max_workers=min(len(missing), PROFILE_FETCH_CONCURRENCY)) as executor:
+            names.update(zip(missing, executor.map(fetch, missing)))
+    return {user_id: name if name is not None else "المستخدم" for user_id, name in names.items()}
+
+def get_tasbih_status(user_id, gid=None, counts=None):
     """عرض حالة التسبيح للمستخدم"""
-    counts = tasbih_counts[user_id]
+    if counts is None:
+        counts = store.get_counts(user_id, today_epoch_day())
     name = get_group_member_name(gid, user_id) if gid else get_user_name(user_id)
     
     status = f"حالة التسبيح\n{name}\n\n"
@@ -204,156 +2352,895 @@ def get_tasbih_status(user_id, gid=None):
     
     return status
 
-def normalize_tasbih(text):
-    """تطبيع نص التسبيح للمقارنة"""
-    text = text.replace(" ", "").replace("ٱ", "ا").replace("أ", "ا").replace("إ", "ا").replace("ة", "ه")
-    
-    mapping = {
-        "استغفرالله": "استغفر الله",
-        "سبحانالله": "سبحان الله",
-        "الحمدلله": "الحمد لله",
-        "اللهأكبر": "الله أكبر",
-        "اللهاكبر": "الله أكبر"
-    }
-    
-    return mapping.get(text)
+def group_leaderboard(group_id, limit):
+    """ترتيب المجموعة اليوم مع الأسماء وإحصائياتها - يعيد (الإحصائيات، [{rank, name, count, completed}])"""
+    day = today_epoch_day()
+    board = store.group_board(group_id, day, limit)
+    names = get_group_member_names(group_id, [user_id for user_id, _ in board])
+    return store.group_summary(group_id, day), [
+        {
+            "rank": rank,
+            "name": names[user_id],
+            "count": score,
+            "completed": score >= TASBIH_COMPLETE_SCORE
+        }
+        for rank, (user_id, score) in enumerate(board, 1)
+    ]
 
 # ========================================
-# خدمة Keep-Alive الجديدة
+# طابور المهام الخلفية
 # ========================================
-def keep_heroku_alive():
-    """إرسال ping للبوت نفسه كل 5 دقائق لمنع النوم"""
-    time.sleep(60)  # انتظر دقيقة قبل البدء
-    
-    if not HEROKU_URL:
-        logger.warning("✗ HEROKU_URL غير موجود - Self-Ping معطل")
-        logger.warning("→ أضف المتغير في Heroku: HEROKU_URL=https://your-bot.herokuapp.com")
-        return
-    
-    logger.info(f"✓ بدء خدمة Keep-Alive للرابط: {HEROKU_URL}")
-    
+class JobQueue:
+    """طابور مهام دائم في SQLite - يتحمل إعادة التشغيل ويعمل مع عدة عمليات"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_at REAL NOT NULL,
+        started_at REAL,
+        heartbeat_at REAL,
+        finished_at REAL,
+        sent INTEGER,
+        failed INTEGER,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = open_db(path)
+        self.conn.executescript(self.SCHEMA)
+        # ترحيل: قواعد بيانات قديمة بدون عمود النبض
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if "heartbeat_at" not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def enqueue(self, kind, payload):
+        """إضافة مهمة وإرجاع رقمها"""
+        with self.lock:
+            cur = self.conn.execute(
+                "INSERT INTO jobs (kind, payload, created_at) VALUES (?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), time.time())
+            )
+        self.wakeup.set()
+        return cur.lastrowid
+
+    def claim(self):
+        """حجز أقدم مهمة معلقة بشكل ذري
+        المهمة قيد التنفيذ تعاد للطابور فقط إن توقف نبضها - مهما طال تنفيذها"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'pending' WHERE status = 'running' "
+                "AND COALESCE(heartbeat_at, started_at) < ?",
+                (now - JOB_STALE_SECONDS,)
+            )
+            row = self.conn.execute(
+                """UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ?
+                   WHERE id = (SELECT id FROM jobs WHERE status = 'pending' ORDER BY id LIMIT 1)
+                   AND status = 'pending'
+                   RETURNING id, kind, payload""",
+                (now, now)
+            ).fetchone()
+        if not row:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def heartbeat(self, job_id):
+        """تجديد نبض مهمة قيد التنفيذ"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'",
+                (time.time(), job_id)
+            )
+
+    def start_heartbeat(self, job_id):
+        """تجديد النبض من خيط منفصل طوال تنفيذ المهمة - يعيد Event يوقفه"""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(JOB_HEARTBEAT_SECONDS):
+                try:
+                    self.heartbeat(job_id)
+                except Exception as e:
+                    logger.error(f"✗ فشل تجديد نبض المهمة {job_id}: {e}")
+
+        threading.Thread(target=beat, daemon=True, name=f"job-heartbeat-{job_id}").start()
+        return stop
+
+    def finish(self, job_id, sent=None, failed=None, error=None):
+        """تسجيل انتهاء المهمة وحذف المهام القديمة"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, sent = ?, failed = ?, error = ? WHERE id = ?",
+                ("failed" if error else "completed", now, sent, failed, error, job_id)
+            )
+            self.conn.execute(
+                "DELETE FROM jobs WHERE finished_at < ?", (now - JOB_RETENTION_SECONDS,)
+            )
+
+    def summary(self, recent=10):
+        """عدد المهام حسب الحالة مع آخر المهام"""
+        with self.lock:
+            counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+            rows = self.conn.execute(
+                "SELECT id, kind, status, created_at, finished_at, sent, failed, error "
+                "FROM jobs ORDER BY id DESC LIMIT ?", (recent,)
+            ).fetchall()
+        return {
+            "pending": counts.get("pending", 0),
+            "in_progress": counts.get("running", 0),
+            "completed": counts.get("completed", 0),
+            "failed": counts.get("failed", 0),
+            "recent": [
+                {
+                    "id": job_id,
+                    "kind": kind,
+                    "status": status,
+                    "created_at": datetime.fromtimestamp(created).isoformat(),
+                    "finished_at": datetime.fromtimestamp(finished).isoformat() if finished else None,
+                    "sent": sent,
+                    "failed": failed,
+                    "error": error
+                }
+                for job_id, kind, status, created, finished, sent, failed, error in rows
+            ]
+        }
+
+job_queue = JobQueue(DB_FILE)
+
+def run_broadcast_job(payload):
+    """تنفيذ مهمة إرسال جماعي"""
+    return broadcast_text(
+        payload.get("text"),
+        pool=payload.get("pool"),
+        exclude_user=payload.get("exclude_user"),
+        exclude_group=payload.get("exclude_group"),
+        segment=payload.get("segment", "all")
+    )
+
+JOB_HANDLERS = {
+    "broadcast": run_broadcast_job
+}
+
+def job_worker():
+    """تنفيذ المهام المعلقة من الطابور بالترتيب"""
     while True:
         try:
-            time.sleep(300)  # كل 5 دقائق
-            
-            response = requests.get(f"{HEROKU_URL}/health", timeout=10)
-            
-            if response.status_code == 200:
-                logger.info("✓ Keep-Alive: البوت نشط")
-            else:
-                logger.warning(f"✗ Keep-Alive: استجابة {response.status_code}")
-                
+            job = job_queue.claim()
+            if not job:
+                job_queue.wakeup.wait(JOB_POLL_SECONDS)
+                job_queue.wakeup.clear()
+                continue
+
+            job_id, kind, payload = job
+            logger.info(f"→ بدء المهمة {job_id} ({kind})")
+            heartbeat = job_queue.start_heartbeat(job_id)
+            try:
+                sent, failed = JOB_HANDLERS[kind](payload)
+                job_queue.finish(job_id, sent=sent, failed=failed)
+                logger.info(f"✓ انتهت المهمة {job_id}: تم الإرسال إلى {sent} - فشل {failed}")
+            except Exception as e:
+                job_queue.finish(job_id, error=str(e))
+                logger.error(f"✗ فشلت المهمة {job_id}: {e}", exc_info=True)
+            finally:
+                heartbeat.set()
         except Exception as e:
-            logger.error(f"✗ خطأ في Keep-Alive: {e}")
-            time.sleep(300)
+            logger.error(f"✗ خطأ في طابور المهام: {e}")
+            time.sleep(JOB_POLL_SECONDS)
 
 # ========================================
-# خدمة التذكير التلقائي المحسّنة
+# المجدول: قائد واحد بين عمليات gunicorn
 # ========================================
-def auto_reminder_service():
-    """خدمة التذكير التلقائي - أوقات متفرقة"""
-    logger.info("✓ بدء خدمة التذكير التلقائي (من ملف الفضل)")
-    
-    while AUTO_REMINDER_ENABLED:
+class Scheduler:
+    """مهام دورية تعمل في عملية واحدة فقط (القائد) عبر عقد إيجار في SQLite"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        name TEXT PRIMARY KEY,
+        next_run REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS job_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job TEXT NOT NULL,
+        holder TEXT NOT NULL,
+        started_at REAL NOT NULL,
+        finished_at REAL,
+        status TEXT,
+        error TEXT
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = open_db(path)
+        self.conn.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+        self.jobs = {}  # الاسم -> (الدالة، دالة المدة حتى التشغيل التالي)
+        self.holder = None
+        self.is_leader = False
+        self.stopped = False
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return execute_write(self.conn, sql, params)
+
+    def add_job(self, name, func, next_delay, first_delay=None):
+        """تسجيل مهمة - وقت التشغيل التالي محفوظ فلا يضيع بإعادة التشغيل"""
+        self.jobs[name] = (func, next_delay)
+        if self._execute("SELECT 1 FROM scheduled_jobs WHERE name = ?", (name,)).fetchone():
+            return
+        delay = next_delay() if first_delay is None else first_delay
+        self._execute(
+            "INSERT OR IGNORE INTO scheduled_jobs VALUES (?, ?)", (name, time.time() + delay)
+        )
+
+    def _renew_lease(self):
+        """الحصول على القيادة أو تجديدها - تنتقل لغير القائد إذا انتهى العقد"""
+        now = time.time()
+        row = self._execute(
+            """INSERT INTO leases VALUES ('scheduler', ?, ?)
+               ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+               WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+               RETURNING holder""",
+            (self.holder, now + LEADER_LEASE_SECONDS, now)
+        ).fetchone()
+        leader = row is not None
+        if leader != self.is_leader:
+            logger.info(f"{'✓ أصبحت' if leader else '✗ لم تعد'} هذه العملية قائد المجدول ({self.holder})")
+        self.is_leader = leader
+
+    def release(self):
+        """التخلي عن القيادة عند الإيقاف لينتقل المجدول فورا"""
+        self.stopped = True
+        if self.is_leader:
+            self._execute("DELETE FROM leases WHERE name = 'scheduler' AND holder = ?", (self.holder,))
+            self.is_leader = False
+
+    def _run_due(self):
+        now = time.time()
+        due = self._execute(
+            "SELECT name, next_run FROM scheduled_jobs WHERE next_run <= ?", (now,)
+        ).fetchall()
+        for name, next_run in due:
+            if name not in self.jobs:
+                continue
+            func, next_delay = self.jobs[name]
+            # حجز التشغيل بتقديم next_run قبل التنفيذ - بشرط أن العقد ما زال لهذه العملية
+            # فلا يشغلها قائد آخر مرة ثانية مهما طال تنفيذها
+            claimed = self._execute(
+                """UPDATE scheduled_jobs SET next_run = ?
+                   WHERE name = ? AND next_run = ? AND EXISTS (
+                       SELECT 1 FROM leases WHERE name = 'scheduler' AND holder = ? AND expires_at >= ?
+                   )
+                   RETURNING name""",
+                (time.time() + next_delay(), name, next_run, self.holder, time.time())
+            ).fetchone()
+            if not claimed:
+                continue
+            run_id = self._execute(
+                "INSERT INTO job_runs (job, holder, started_at) VALUES (?, ?, ?)",
+                (name, self.holder, time.time())
+            ).lastrowid
+            try:
+                func()
+                status, error = "completed", None
+            except Exception as e:
+                status, error = "failed", str(e)
+                logger.error(f"✗ خطأ في المهمة المجدولة {name}: {e}")
+            self._execute(
+                "UPDATE job_runs SET finished_at = ?, status = ?, error = ? WHERE id = ?",
+                (time.time(), status, error, run_id)
+            )
+        self._execute(
+            "DELETE FROM job_runs WHERE id <= (SELECT MAX(id) FROM job_runs) - ?", (SCHEDULER_HISTORY,)
+        )
+
+    def _lease_loop(self):
+        """تجديد القيادة في خيط منفصل - لا يتوقف أثناء تنفيذ مهمة طويلة فلا ينتهي العقد"""
+        while not self.stopped:
+            try:
+                self._renew_lease()
+            except Exception as e:
+                logger.error(f"✗ خطأ في تجديد قيادة المجدول: {e}")
+            time.sleep(SCHEDULER_TICK_SECONDS)
+
+    def loop(self):
+        """تجديد القيادة وتشغيل المهام المستحقة"""
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        threading.Thread(target=self._lease_loop, daemon=True, name="scheduler-lease").start()
+        while not self.stopped:
+            try:
+                if self.is_leader:
+                    self._run_due()
+            except Exception as e:
+                logger.error(f"✗ خطأ في المجدول: {e}")
+            time.sleep(SCHEDULER_TICK_SECONDS)
+
+    def summary(self):
+        now = time.time()
+        lease = self._execute("SELECT holder, expires_at FROM leases WHERE name = 'scheduler'").fetchone()
+        jobs = self._execute("SELECT name, next_run FROM scheduled_jobs ORDER BY next_run").fetchall()
+        runs = self._execute(
+            "SELECT job, holder, started_at, finished_at, status, error FROM job_runs ORDER BY id DESC LIMIT ?",
+            (SCHEDULER_HISTORY,)
+        ).fetchall()
+        return {
+            "leader": lease[0] if lease and lease[1] >= now else None,
+            "this_process": self.holder,
+            "is_leader": self.is_leader,
+            "jobs": [
+                {
+                    "name": name,
+                    "next_run": datetime.fromtimestamp(next_run).isoformat(),
+                    "seconds_until": max(0, round(next_run - now)),
+                    "registered": name in self.jobs
+                }
+                for name, next_run in jobs
+            ],
+            "history": [
+                {
+                    "job": job,
+                    "holder": holder,
+                    "started_at": datetime.fromtimestamp(started).isoformat(),
+                    "duration_seconds": round(finished - started, 3) if finished else None,
+                    "status": status or "running",
+                    "error": error
+                }
+                for job, holder, started, finished, status, error in runs
+            ]
+        }
+
+scheduler = Scheduler(DB_FILE)
+
+# ========================================
+# مواعيد التذكير لكل مستلم
+# ========================================
+def parse_clock(value):
+    """تحويل "HH:MM" إلى دقائق من بداية اليوم - ValueError إذا كان غير صحيح"""
+    hours, _, minutes = value.strip().partition(":")
+    hours, minutes = int(hours), int(minutes or 0)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"وقت غير صحيح: {value}")
+    return hours * 60 + minutes
+
+def parse_quiet_hours(value):
+    """تحويل "23:00-06:00" إلى (بداية، نهاية) بالدقائق - None للقيمة الفارغة"""
+    if not value:
+        return None
+    start, sep, end = value.partition("-")
+    if not sep:
+        raise ValueError(f"ساعات هدوء غير صحيحة: {value}")
+    quiet = (parse_clock(start), parse_clock(end))
+    if quiet[0] == quiet[1]:
+        raise ValueError(f"ساعات هدوء غير صحيحة: {value}")
+    return quiet
+
+def format_clock(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def local_minute(ts):
+    """(الدقيقة من بداية اليوم المحلي، بداية تلك الدقيقة) حسب TASBIH_TIMEZONE"""
+    dt = datetime.fromtimestamp(ts, tasbih_tz)
+    return dt.hour * 60 + dt.minute, int(ts) - dt.second
+
+def quiet_end_after(ts, quiet):
+    """نهاية ساعات الهدوء إذا وقع الموعد داخلها، وإلا None - الفترة قد تعبر منتصف الليل"""
+    start, end = quiet
+    minute, minute_start = local_minute(ts)
+    inside = start <= minute < end if start < end else (minute >= start or minute < end)
+    if not inside:
+        return None
+    return minute_start + ((end - minute) % 1440) * 60
+
+def next_fixed_time(times, ts):
+    """أقرب وقت ثابت بعد ts - times دقائق مرتبة من بداية اليوم المحلي"""
+    minute, minute_start = local_minute(ts)
+    index = bisect_left(times, minute + 1)
+    wait = times[index] - minute if index < len(times) else 1440 - minute + times[0]
+    return minute_start + wait * 60
+
+def spread_schedule(targets, start, window, quiet_for):
+    """موعد كل مستلم موزعا بالتساوي على النافذة بدلا من دفعة واحدة
+    من يقع موعده في ساعات الهدوء يؤجل مع الاحتفاظ بإزاحته فلا يتكدس المؤجلون عند نهايتها"""
+    step = window / len(targets) if targets else 0
+    schedule = []
+    for i, target_id in enumerate(targets):
+        offset = i * step
+        fire_at = start + offset
+        quiet = quiet_for(target_id)
+        if quiet:
+            end = quiet_end_after(fire_at, quiet)
+            if end is not None:
+                fire_at = end + offset
+        schedule.append((target_id, fire_at))
+    return schedule
+
+class ReminderHeap:
+    """كومة المواعيد في الذاكرة مع حذف كسول: entries هو الموعد الحالي لكل مفتاح
+    والمدخلات القديمة في الكومة تتجاهل عند خروجها"""
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}  # (المستلم، النوع) -> موعد الإطلاق
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, items):
+        self.entries = dict(items)
+        self.heap = [(fire_at, key) for key, fire_at in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def push(self, key, fire_at):
+        self.entries[key] = fire_at
+        heapq.heappush(self.heap, (fire_at, key))
+        # إعادة البناء عندما تغلب المدخلات القديمة
+        if len(self.heap) > 2 * len(self.entries) + 1024:
+            self.load(self.entries)
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.heap, self.entries = [], {}
+
+    def next_fire(self):
+        while self.heap and self.entries.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now, limit):
+        """المستحق حتى now بترتيب الموعد - [(المفتاح، الموعد)]"""
+        due = []
+        while self.heap and len(due) < limit and self.heap[0][0] <= now:
+            fire_at, key = heapq.heappop(self.heap)
+            if self.entries.get(key) == fire_at:
+                del self.entries[key]
+                due.append((key, fire_at))
+        return due
+
+class ReminderScheduler:
+    """مواعيد التذكير لكل مستلم: جدول SQLite هو المرجع الدائم للموعد التالي
+    والعملية القائدة تحمله في كومة وتطلق المستحق كل REMINDER_TICK_SECONDS
+
+    الأنواع: fixed (أوقات ثابتة يختارها المستلم) و broadcast (تذكير عشوائي موزع على نافذة)
+    التغييرات من العمليات الأخرى تسجل في reminder_changes وتطبقها القائدة على كومتها"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS reminder_settings (
+        target_id TEXT PRIMARY KEY,
+        times TEXT,
+        quiet_start INTEGER,
+        quiet_end INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS reminder_queue (
+        target_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        fire_at REAL NOT NULL,
+        pool TEXT NOT NULL,
+        PRIMARY KEY (target_id, kind)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS reminder_queue_fire ON reminder_queue (fire_at);
+    CREATE TABLE IF NOT EXISTS reminder_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        target_id TEXT NOT NULL,
+        kind TEXT NOT NULL
+    );
+    """
+
+    CHUNK = 500  # حد المفاتيح في استعلام IN واحد
+
+    def __init__(self, path, is_leader, default_quiet=None):
+        self.path = path
+        self.conn = open_db(path)
+        self.conn.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+        self.is_leader = is_leader
+        self.default_quiet = default_quiet
+        self.heap = ReminderHeap()
+        self.loaded = False
+        self.last_change = 0
+        self.executor = ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY)
+        self.stats = {"fired": 0, "sent": 0, "failed": 0, "skipped": 0, "deferred": 0, "stale": 0}
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return execute_write(self.conn, sql, params)
+
+    def _transaction(self, statements):
+        """[(sql، قائمة المعاملات)] في معاملة واحدة - يستدعى والقفل محجوز"""
+        self.conn.execute("BEGIN IMMEDIATE")
         try:
-            sleep_hours = random.uniform(MIN_INTERVAL_HOURS, MAX_INTERVAL_HOURS)
-            sleep_seconds = sleep_hours * 3600
-            
-            logger.info(f"→ التذكير القادم بعد {sleep_hours:.1f} ساعة")
-            time.sleep(sleep_seconds)
-            
-            if len(target_users) > 0 or len(target_groups) > 0:
-                if fadl_content:
-                    message = random.choice(fadl_content)
-                    sent, failed = broadcast_text(message)
-                    logger.info(f"→ تذكير تلقائي (فضل): تم الإرسال إلى {sent} - فشل {failed}")
+            for sql, rows in statements:
+                self.conn.executemany(sql, rows)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    # ---------- الإعدادات (من أي عملية) ----------
+    def settings(self, target_id):
+        """(الأوقات الثابتة، ساعات الهدوء) للمستلم"""
+        row = self._execute(
+            "SELECT times, quiet_start, quiet_end FROM reminder_settings WHERE target_id = ?", (target_id,)
+        ).fetchone()
+        times = [int(t) for t in row[0].split(",")] if row and row[0] else []
+        quiet = (row[1], row[2]) if row and row[1] is not None else None
+        return times, quiet
+
+    def set_times(self, target_id, times):
+        """أوقات ثابتة يومية بالدقائق - القائمة الفارغة تعيد المستلم للتذكير العشوائي"""
+        times = sorted(set(times))
+        if times:
+            entry = ("INSERT OR REPLACE INTO reminder_queue VALUES (?, 'fixed', ?, 'fadl')",
+                     [(target_id, next_fixed_time(times, time.time()))])
+        else:
+            entry = ("DELETE FROM reminder_queue WHERE target_id = ? AND kind = 'fixed'", [(target_id,)])
+        with self.lock:
+            self._transaction([
+                ("INSERT INTO reminder_settings (target_id, times) VALUES (?, ?) "
+                 "ON CONFLICT (target_id) DO UPDATE SET times = excluded.times",
+                 [(target_id, ",".join(map(str, times)) or None)]),
+                entry,
+                ("INSERT INTO reminder_changes (target_id, kind) VALUES (?, 'fixed')", [(target_id,)])
+            ])
+
+    def set_quiet(self, target_id, quiet):
+        """ساعات الهدوء (بداية، نهاية) بالدقائق - None لإلغائها"""
+        start, end = quiet or (None, None)
+        self._execute(
+            "INSERT INTO reminder_settings (target_id, quiet_start, quiet_end) VALUES (?, ?, ?) "
+            "ON CONFLICT (target_id) DO UPDATE SET quiet_start = excluded.quiet_start, "
+            "quiet_end = excluded.quiet_end",
+            (target_id, start, end)
+        )
+
+    # ---------- الجدولة (العملية القائدة) ----------
+    def spread_broadcast(self, pool, segment="all", window=None):
+        """جدولة تذكير جماعي موزع على نافذة زمنية - يعيد (عدد المستلمين، طول النافذة)
+        أصحاب الأوقات الثابتة لا يدخلونه، والنافذة لا تقل عما يسمح به PUSH_RATE_LIMIT"""
+        users, groups = store.recipients(segment=segment)
+        with self.lock:
+            settings = self.conn.execute(
+                "SELECT target_id, times, quiet_start, quiet_end FROM reminder_settings"
+            ).fetchall()
+        fixed = {target_id for target_id, times, _, _ in settings if times}
+        quiet = {target_id: (start, end) for target_id, _, start, end in settings if start is not None}
+        targets = [target_id for target_id in users + groups if target_id not in fixed]
+        if not targets:
+            return 0, 0
+        random.shuffle(targets)
+        window = max(REMINDER_SPREAD_SECONDS if window is None else window, len(targets) / PUSH_RATE_LIMIT)
+        schedule = spread_schedule(targets, time.time(), window,
+                                   lambda target_id: quiet.get(target_id, self.default_quiet))
+        with self.lock:
+            # موعد سابق لم يطلق بعد يستبدل فلا يصل المستلم تذكيران متتاليان
+            self._transaction([(
+                "INSERT OR REPLACE INTO reminder_queue VALUES (?, 'broadcast', ?, ?)",
+                [(target_id, fire_at, pool) for target_id, fire_at in schedule]
+            )])
+            if self.loaded:
+                for target_id, fire_at in schedule:
+                    self.heap.push((target_id, "broadcast"), fire_at)
+        return len(targets), window
+
+    def _load(self):
+        """تحميل الجدول كاملا إلى الكومة عند تولي القيادة"""
+        with self.lock:
+            # رقم آخر تغيير يقرأ قبل الجدول حتى لا يفوت تغيير بينهما
+            self.last_change = self.conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM reminder_changes"
+            ).fetchone()[0]
+            rows = self.conn.execute("SELECT target_id, kind, fire_at FROM reminder_queue").fetchall()
+            self.heap.load(((target_id, kind), fire_at) for target_id, kind, fire_at in rows)
+            self.loaded = True
+        logger.info(f"✓ تم تحميل {len(rows)} موعد تذكير")
+
+    def unload(self):
+        with self.lock:
+            self.heap.clear()
+            self.loaded = False
+
+    def _apply_changes(self):
+        """تطبيق ما غيرته العمليات الأخرى (أوامر الأوقات الثابتة) على الكومة"""
+        with self.lock:
+            changes = self.conn.execute(
+                "SELECT seq, target_id, kind FROM reminder_changes WHERE seq > ? ORDER BY seq",
+                (self.last_change,)
+            ).fetchall()
+            if not changes:
+                return
+            for _, target_id, kind in changes:
+                row = self.conn.execute(
+                    "SELECT fire_at FROM reminder_queue WHERE target_id = ? AND kind = ?", (target_id, kind)
+                ).fetchone()
+                if row:
+                    self.heap.push((target_id, kind), row[0])
                 else:
-                    logger.warning("✗ لا يوجد فضل متاح للإرسال في fadl.json")
-            else:
-                logger.info("✗ لا يوجد مستخدمين مسجلين")
-                
-        except Exception as e:
-            logger.error(f"✗ خطأ في التذكير التلقائي: {e}")
-            time.sleep(3600)
-
-# تشغيل خدمة Keep-Alive
-keep_alive_thread = threading.Thread(target=keep_heroku_alive, daemon=True)
-keep_alive_thread.start()
-logger.info("✓ تم تشغيل خدمة Keep-Alive")
+                    self.heap.remove((target_id, kind))
+            self.last_change = changes[-1][0]
+            execute_write(self.conn, "DELETE FROM reminder_changes WHERE seq <= ?", (self.last_change,))
+
+    def _claim(self, due, now):
+        """التحقق من المستحق مقابل الجدول ثم حذفه أو نقله لموعده التالي - يعيد [(المستلم، المجموعة)]
+        التذكير العشوائي الذي تأخر حتى دخل ساعات الهدوء يؤجل بدلا من إرساله"""
+        rows, settings = {}, {}
+        with self.lock:
+            for i in range(0, len(due), self.CHUNK):
+                keys = [key for key, _ in due[i:i + self.CHUNK]]
+                rows.update(((target_id, kind), (fire_at, pool)) for target_id, kind, fire_at, pool in
+                            self.conn.execute(
+                                "SELECT target_id, kind, fire_at, pool FROM reminder_queue "
+                                f"WHERE (target_id, kind) IN (VALUES {','.join(['(?, ?)'] * len(keys))})",
+                                [value for key in keys for value in key]
+                            ).fetchall())
+            valid = [(key, fire_at) for key, fire_at in due if rows.get(key, (None,))[0] == fire_at]
+            targets = list({key[0] for key, _ in valid})
+            for i in range(0, len(targets), self.CHUNK):
+                chunk = targets[i:i + self.CHUNK]
+                settings.update((row[0], row[1:]) for row in self.conn.execute(
+                    "SELECT target_id, times, quiet_start, quiet_end FROM reminder_settings "
+                    f"WHERE target_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall())
+            claimed, deletes, updates = [], [], []
+            for (target_id, kind), fire_at in valid:
+                times, quiet_start, quiet_end = settings.get(target_id, (None, None, None))
+                if kind == "fixed" and times:
+                    next_fire = next_fixed_time([int(t) for t in times.split(",")], now)
+                    updates.append((next_fire, target_id, kind, fire_at))
+                    claimed.append((target_id, rows[(target_id, kind)][1]))
+                    continue
+                quiet = (quiet_start, quiet_end) if quiet_start is not None else self.default_quiet
+                end = quiet_end_after(now, quiet) if kind == "broadcast" and quiet else None
+                if end is not None:
+                    updates.append((end + random.uniform(0, REMINDER_SPREAD_SECONDS), target_id, kind, fire_at))
+                    self.stats["deferred"] += 1
+                    continue
+                deletes.append((target_id, kind, fire_at))
+                if kind == "broadcast":
+                    claimed.append((target_id, rows[(target_id, kind)][1]))
+            # الشرط على الموعد يحفظ ما غيرته عملية أخرى في نفس اللحظة
+            self._transaction([
+                ("DELETE FROM reminder_queue WHERE target_id = ? AND kind = ? AND fire_at = ?", deletes),
+                ("UPDATE reminder_queue SET fire_at = ? WHERE target_id = ? AND kind = ? AND fire_at = ?", updates)
+            ])
+            for next_fire, target_id, kind, _ in updates:
+                self.heap.push((target_id, kind), next_fire)
+        self.stats["stale"] += len(due) - len(valid)
+        for _, fire_at in valid:
+            reminder_lateness_seconds.observe(now - fire_at)
+        return claimed
+
+    def tick(self, now):
+        """دورة واحدة: تطبيق التغييرات ثم إرسال المستحق (حتى REMINDER_BATCH)"""
+        if not self.loaded:
+            self._load()
+        self._apply_changes()
+        with self.lock:
+            due = self.heap.pop_due(now, REMINDER_BATCH)
+        if not due:
+            return 0
+        claimed = self._claim(due, now)
+        receiving = set(store.filter_receiving(list({target_id for target_id, _ in claimed})))
+        by_pool = {}
+        for target_id, pool in claimed:
+            if target_id in receiving:
+                by_pool.setdefault(pool, {})[target_id] = None
+
+        # المستخدمون الذين حان تذكيرهم بنفس النص يجمعون في طلب متعدد الإرسال كما في broadcast_text
+        tasks = []
+        for pool, target_ids in by_pool.items():
+            texts = content_rotation.pick_many(pool, list(target_ids))
+            targets = [target_id for target_id in target_ids if target_id in texts]
+            tasks += delivery_tasks(
+                [tid for tid in targets if is_user_id(tid)],
+                [tid for tid in targets if not is_user_id(tid)],
+                texts.__getitem__, MULTICAST_ENABLED
+            )
+        outcomes = run_delivery_tasks(self.executor, tasks)
+        deactivated = store.record_deliveries(outcomes) if outcomes else []
+        sent = sum(error is None for _, error in outcomes)
+        self.stats["fired"] += len(claimed)
+        self.stats["sent"] += sent
+        self.stats["failed"] += len(outcomes) - sent
+        self.stats["skipped"] += len(claimed) - len(outcomes)
+        broadcast_messages.inc(sent, "sent")
+        broadcast_messages.inc(len(outcomes) - sent, "failed")
+        if deactivated:
+            logger.info(f"تم إيقاف الإرسال إلى {len(deactivated)} مستلم بعد أخطاء دائمة متكررة")
+        return len(outcomes)
+
+    def loop(self):
+        """إطلاق المواعيد المستحقة في العملية القائدة فقط"""
+        while True:
+            try:
+                if self.is_leader():
+                    self.tick(time.time())
+                elif self.loaded:
+                    self.unload()
+            except Exception as e:
+                logger.error(f"✗ خطأ في مواعيد التذكير: {e}")
+            time.sleep(REMINDER_TICK_SECONDS)
+
+    def summary(self):
+        now = time.time()
+        with self.lock:
+            pending = dict(self.conn.execute(
+                "SELECT kind, COUNT(*) FROM reminder_queue GROUP BY kind"
+            ).fetchall())
+            next_fire = self.conn.execute("SELECT MIN(fire_at) FROM reminder_queue").fetchone()[0]
+            fixed, quiet = self.conn.execute(
+                "SELECT COUNT(times), COUNT(quiet_start) FROM reminder_settings"
+            ).fetchone()
+            heap_size = len(self.heap) if self.loaded else None
+        return {
+            "pending": pending,
+            "next_fire_in_seconds": max(0, round(next_fire - now)) if next_fire else None,
+            "fixed_schedules": fixed,
+            "quiet_hours": quiet,
+            "default_quiet_hours": REMINDER_QUIET_HOURS or None,
+            "spread_seconds": REMINDER_SPREAD_SECONDS,
+            "heap_size": heap_size,
+            **self.stats
+        }
+
+try:
+    default_quiet_hours = parse_quiet_hours(REMINDER_QUIET_HOURS)
+except ValueError:
+    logger.warning(f"✗ REMINDER_QUIET_HOURS غير صحيح: {REMINDER_QUIET_HOURS} - بدون ساعات هدوء افتراضية")
+    default_quiet_hours = None
+
+reminders = ReminderScheduler(DB_FILE, lambda: scheduler.is_leader, default_quiet_hours)
 
-# تشغيل خدمة التذكير التلقائي
-if AUTO_REMINDER_ENABLED:
-    reminder_thread = threading.Thread(target=auto_reminder_service, daemon=True)
-    reminder_thread.start()
-    logger.info("✓ تم تشغيل خدمة التذكير التلقائي")
-
-def is_valid_command(text):
-    """التحقق من صحة الأمر"""
-    valid_commands = ["مساعدة", "فضل", "تسبيح", "ذكرني", "إعادة", "إيقاف", "تشغيل", "احصائيات"]
-    txt = text.lower().strip()
+# ========================================
+# خدمة Keep-Alive الجديدة
+# ========================================
+def keep_heroku_alive():
+    """إرسال ping للبوت نفسه لمنع النوم"""
+    response = requests.get(f"{HEROKU_URL}/health", timeout=10)
     
-    if txt in [c.lower() for c in valid_commands]:
-        return True
-    if normalize_tasbih(text):
-        return True
-    return False
-
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event):
-    """معالج الرسائل الرئيسي"""
-    try:
-        user_text = event.message.text.strip()
-        user_id = event.source.user_id
-        gid = getattr(event.source, "group_id", None)
+    if response.status_code == 200:
+        logger.info("✓ Keep-Alive: البوت نشط")
+    else:
+        logger.warning(f"✗ Keep-Alive: استجابة {response.status_code}")
 
-        # الرد على السلام
-        if user_text in SALAM_WORDS:
-            reply_message(event.reply_token, "وعليكم السلام ورحمة الله وبركاته")
-            return
+# ========================================
+# خدمة التذكير التلقائي المحسّنة
+# ========================================
+def next_reminder_delay():
+    """أوقات متفرقة بين MIN_INTERVAL_HOURS و MAX_INTERVAL_HOURS"""
+    sleep_hours = random.uniform(MIN_INTERVAL_HOURS, MAX_INTERVAL_HOURS)
+    logger.info(f"→ التذكير القادم بعد {sleep_hours:.1f} ساعة")
+    return sleep_hours * 3600
 
-        # تسجيل المستخدم الجديد
-        if user_id not in target_users:
-            target_users.add(user_id)
-            save_data()
-            logger.info(f"مستخدم جديد: {user_id}")
+def auto_reminder_service():
+    """التذكير التلقائي - جدولة فضل لكل مستلم موزعا على REMINDER_SPREAD_SECONDS"""
+    summary = store.summary()
+    if summary["users"] == 0 and summary["groups"] == 0:
+        logger.info("✗ لا يوجد مستخدمين مسجلين")
+        return
+    if not content_library.items("fadl"):
+        logger.warning("✗ لا يوجد فضل متاح للإرسال في fadl.json")
+        return
 
-        # تسجيل المجموعة الجديدة
-        if gid and gid not in target_groups:
-            target_groups.add(gid)
-            save_data()
-            logger.info(f"مجموعة جديدة: {gid}")
+    count, window = reminders.spread_broadcast("fadl", AUTO_REMINDER_SEGMENT)
+    logger.info(f"→ تذكير تلقائي (فضل): {count} مستلم موزعين على {window / 60:.1f} دقيقة")
 
-        # تحذير من تكرار الروابط (فقط في المجموعات)
-        if gid:
-            links = extract_links(user_text)
-            
-            if links:
-                if user_id not in user_links:
-                    user_links[user_id] = set()
-                
-                for link in links:
-                    if link in user_links[user_id]:
-                        reply_message(
-                            event.reply_token,
-                            "تنبيه:\nممنوع تكرار نفس الرابط أكثر من مرة"
-                        )
-                        return
-                    else:
-                        user_links[user_id].add(link)
+# تسجيل خدمة Keep-Alive (كل 5 دقائق بعد دقيقة من البدء)
+if HEROKU_URL:
+    scheduler.add_job("keep_alive", keep_heroku_alive, lambda: 300, first_delay=60)
+    logger.info(f"✓ تم تسجيل خدمة Keep-Alive للرابط: {HEROKU_URL}")
+else:
+    logger.warning("✗ HEROKU_URL غير موجود - Self-Ping معطل")
+    logger.warning("→ أضف المتغير في Heroku: HEROKU_URL=https://your-bot.herokuapp.com")
 
-        # التأكد من وجود بيانات التسبيح
-        ensure_user_counts(user_id)
-        was_reset = reset_tasbih_if_needed(user_id)
+# تسجيل خدمة التذكير التلقائي
+if AUTO_REMINDER_ENABLED:
+    scheduler.add_job("auto_reminder", auto_reminder_service, next_reminder_delay)
+    logger.info("✓ تم تسجيل خدمة التذكير التلقائي (من ملف الفضل)")
 
-        # تجاهل الرسائل غير الصحيحة - البوت صامت
-        if not is_valid_command(user_text):
+# ========================================
+# منع تكرار معالجة الأحداث
+# ========================================
+class EventDeduplicator:
+    """سجل معرفات الأحداث المعالجة في SQLite - مشترك بين العمليات ومحدود بمدة وعدد"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS webhook_events (
+        id TEXT PRIMARY KEY,
+        seen_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS webhook_events_seen ON webhook_events (seen_at);
+    """
+
+    def __init__(self, path, ttl_seconds, max_events):
+        self.path = path
+        self.conn = open_db(path)
+        self.conn.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+        self.ttl_seconds = ttl_seconds
+        self.max_events = max_events
+        self.checked = 0
+        self.duplicates = 0
+        self.redeliveries = 0
+
+    def claim(self, event_id, is_redelivery=False):
+        """True إذا لم يعالج الحدث من قبل - ويسجله كمعالج"""
+        now = time.time()
+        with self.lock:
+            new = execute_write(
+                self.conn,
+                "INSERT OR IGNORE INTO webhook_events VALUES (?, ?)", (event_id, now)
+            ).rowcount == 1
+            self.checked += 1
+            self.redeliveries += bool(is_redelivery)
+            self.duplicates += not new
+            if self.checked % DEDUP_PRUNE_EVERY == 0:
+                self._prune(now)
+        return new
+
+    def _prune(self, now):
+        self.conn.execute("DELETE FROM webhook_events WHERE seen_at < ?", (now - self.ttl_seconds,))
+        self.conn.execute(
+            "DELETE FROM webhook_events WHERE seen_at <= (SELECT seen_at FROM webhook_events "
+            "ORDER BY seen_at DESC LIMIT 1 OFFSET ?)",
+            (self.max_events,)
+        )
+
+    def summary(self):
+        with self.lock:
+            return {
+                "checked": self.checked,
+                "duplicates_skipped": self.duplicates,
+                "redeliveries": self.redeliveries,
+                "hit_rate": round(self.duplicates / self.checked, 4) if self.checked else 0,
+                "ttl_seconds": self.ttl_seconds
+            }
+
+event_dedup = EventDeduplicator(DB_FILE, DEDUP_TTL_SECONDS, DEDUP_MAX_EVENTS)
+
+def idempotent(func):
+    """تجاهل الأحداث التي سبقت معالجتها عند إعادة إرسالها من LINE"""
+    @functools.wraps(func)
+    def wrapper(event):
+        event_id = getattr(event, "webhook_event_id", None)
+        context = getattr(event, "delivery_context", None)
+        is_redelivery = bool(context and context.is_redelivery)
+        if event_id and not event_dedup.claim(event_id, is_redelivery):
+            logger.info(f"تم تجاهل حدث مكرر: {event_id}")
             return
+        return func(event)
+    return wrapper
 
-        text_lower = user_text.lower()
+# ========================================
+# توجيه الأوامر
+# ========================================
+def normalize_command(text):
+    """تطبيع النص: حذف المسافات وتوحيد الألف والتاء المربوطة
+    سلسلة replace أسرع بعدة مرات من translate بجدول للنص العربي وهي تمر على كل رسالة"""
+    return text.replace(" ", "").replace("ٱ", "ا").replace("أ", "ا").replace("إ", "ا").replace("ة", "ه")
+
+# النص بعد التطبيع -> المعالج
+COMMAND_HANDLERS = {}
 
-        # أمر المساعدة
-        if text_lower == "مساعدة":
-            help_text = """بوت85 - الأوامر المتاحة
+# أوامر لها قيم بعد أول كلمتين: أول كلمتين بعد التطبيع -> المعالج
+ARG_COMMAND_HANDLERS = {}
+
+HELP_TEXT = """بوت85 - الأوامر المتاحة
 
 ذكرني
 ارسال ذكر لجميع المستخدمين والمجموعات
@@ -373,146 +3260,535 @@ def handle_message(event):
 تشغيل
 تشغيل التذكير التلقائي
 
+وقت التذكير 07:00 21:00
+تذكير يومي في أوقات ثابتة بدلا من الأوقات العشوائية
+(وقت التذكير إلغاء: العودة للأوقات العشوائية)
+
+ساعات الهدوء 23:00-06:00
+تأجيل التذكير التلقائي إلى ما بعد هذه الساعات
+(ساعات الهدوء إلغاء)
+
+ترتيب المجموعة
+أكثر الأعضاء تسبيحا في المجموعة اليوم
+
 ملاحظة:
 - يتم تصفير العداد تلقائيا كل يوم
 - التذكير اليدوي (ذكرني): أذكار قصيرة
 - التذكير التلقائي: فضائل العبادات
 
 تم إنشاء هذا البوت بواسطة عبير الدوسري"""
-            reply_message(event.reply_token, help_text)
-            return
 
-        # أمر إيقاف التذكير
-        if text_lower == "إيقاف":
-            target_id = gid if gid else user_id
-            if target_id not in notifications_off:
-                notifications_off.add(target_id)
-                save_data()
-                msg = "تم إيقاف التذكير التلقائي لهذه المجموعة" if gid else "تم إيقاف التذكير التلقائي لك"
-                reply_message(event.reply_token, msg)
-                logger.info(f"إيقاف التذكير: {target_id}")
-            else:
-                reply_message(event.reply_token, "التذكير موقف مسبقا")
-            return
+def command(*names, metric=None):
+    """تسجيل معالج لأمر أو أكثر في جدول التوجيه مع سلسلة قياس زمنه"""
+    def register(func):
+        func.metric = handler_seconds.labels(metric or func.__name__.removeprefix("cmd_"))
+        for name in names:
+            COMMAND_HANDLERS[normalize_command(name)] = func
+        return func
+    return register
+
+def arg_command(name, metric=None):
+    """تسجيل أمر من كلمتين تليهما قيم - المعالج يستقبل القيم كقائمة كلمات"""
+    def register(func):
+        func.metric = handler_seconds.labels(metric or func.__name__.removeprefix("cmd_"))
+        ARG_COMMAND_HANDLERS[normalize_command(name)] = func
+        return func
+    return register
+
+# فروع handle_message التي لا تمر بجدول الأوامر
+SALAM_METRIC = handler_seconds.labels("salam")
+LINK_METRIC = handler_seconds.labels("duplicate_link")
+IGNORED_METRIC = handler_seconds.labels("ignored")
+
+@command("مساعدة")
+def cmd_help(event, user_id, gid):
+    """أمر المساعدة"""
+    reply_message(event.reply_token, HELP_TEXT)
+
+@command("إيقاف")
+def cmd_notifications_off(event, user_id, gid):
+    """أمر إيقاف التذكير"""
+    target_id = gid if gid else user_id
+    if store.set_notifications(target_id, True):
+        msg = "تم إيقاف التذكير التلقائي لهذه المجموعة" if gid else "تم إيقاف التذكير التلقائي لك"
+        reply_message(event.reply_token, msg)
+        logger.info(f"إيقاف التذكير: {target_id}")
+    else:
+        reply_message(event.reply_token, "التذكير موقف مسبقا")
+
+@command("تشغيل")
+def cmd_notifications_on(event, user_id, gid):
+    """أمر تشغيل التذكير"""
+    target_id = gid if gid else user_id
+    if store.set_notifications(target_id, False):
+        msg = "تم تشغيل التذكير التلقائي لهذه المجموعة" if gid else "تم تشغيل التذكير التلقائي لك"
+        reply_message(event.reply_token, msg)
+        logger.info(f"تشغيل التذكير: {target_id}")
+    else:
+        reply_message(event.reply_token, "التذكير يعمل مسبقا")
+
+def is_cancel(args):
+    return len(args) == 1 and normalize_command(args[0]) == "الغاء"
+
+@arg_command("وقت التذكير")
+def cmd_reminder_times(event, user_id, gid, args):
+    """أمر الأوقات الثابتة: وقت التذكير 07:00 21:00"""
+    target_id = gid if gid else user_id
+    if not args:
+        times, _ = reminders.settings(target_id)
+        current = " ".join(map(format_clock, times)) if times else "أوقات عشوائية"
+        reply_message(event.reply_token, f"وقت التذكير الحالي: {current}\nمثال: وقت التذكير 07:00 21:00")
+        return
+    if is_cancel(args):
+        reminders.set_times(target_id, [])
+        reply_message(event.reply_token, "تمت العودة إلى التذكير في أوقات عشوائية")
+        logger.info(f"إلغاء الأوقات الثابتة: {target_id}")
+        return
+    try:
+        times = sorted({parse_clock(value) for value in args})
+    except ValueError:
+        reply_message(event.reply_token, "صيغة الوقت غير صحيحة\nمثال: وقت التذكير 07:00 21:00")
+        return
+    if len(times) > REMINDER_MAX_TIMES:
+        reply_message(event.reply_token, f"الحد الأقصى {REMINDER_MAX_TIMES} أوقات في اليوم")
+        return
+    reminders.set_times(target_id, times)
+    reply_message(event.reply_token, f"سيصلك التذكير يوميا في: {' '.join(map(format_clock, times))}")
+    logger.info(f"أوقات ثابتة: {target_id} {times}")
+
+@arg_command("ساعات الهدوء")
+def cmd_quiet_hours(event, user_id, gid, args):
+    """أمر ساعات الهدوء: ساعات الهدوء 23:00-06:00"""
+    target_id = gid if gid else user_id
+    if not args:
+        _, quiet = reminders.settings(target_id)
+        current = "-".join(map(format_clock, quiet)) if quiet else "غير محددة"
+        reply_message(event.reply_token, f"ساعات الهدوء الحالية: {current}\nمثال: ساعات الهدوء 23:00-06:00")
+        return
+    if is_cancel(args):
+        reminders.set_quiet(target_id, None)
+        reply_message(event.reply_token, "تم إلغاء ساعات الهدوء")
+        return
+    try:
+        quiet = parse_quiet_hours("".join(args))
+    except ValueError:
+        reply_message(event.reply_token, "صيغة غير صحيحة\nمثال: ساعات الهدوء 23:00-06:00")
+        return
+    reminders.set_quiet(target_id, quiet)
+    reply_message(event.reply_token, f"لن يصلك التذكير التلقائي بين {format_clock(quiet[0])} و {format_clock(quiet[1])}")
+    logger.info(f"ساعات الهدوء: {target_id} {quiet}")
+
+@command("فضل")
+def cmd_fadl(event, user_id, gid):
+    """أمر الفضل"""
+    reply_message(event.reply_token, get_next_fadl(gid or user_id))
+
+@command("تسبيح")
+def cmd_tasbih_status(event, user_id, gid):
+    """أمر التسبيح"""
+    status = get_tasbih_status(user_id, gid)
+    # عدادات يوم سابق تقرأ كصفر - تصفر هنا فعليا (كتابة واحدة بطلب المستخدم) فيظهر التنبيه مرة واحدة
+    day = today_epoch_day()
+    if store.is_stale(user_id, day):
+        store.reset_counts(user_id, day)
+        maybe_flush()
+        status = "تم تصفير العداد ليوم جديد\n\n" + status
+    reply_message(event.reply_token, status)
+
+@command("إعادة")
+def cmd_reset(event, user_id, gid):
+    """أمر الإعادة"""
+    store.reset_counts(user_id, today_epoch_day())
+    maybe_flush()
+    reply_message(event.reply_token, "تم تصفير عداد التسبيح بنجاح\nيمكنك البدء من جديد")
+    logger.info(f"تم تصفير التسبيح يدويا: {user_id}")
+
+@command("احصائيات")
+def cmd_stats(event, user_id, gid):
+    """أمر الإحصائيات"""
+    summary = store.summary()
+    
+    stats_text = f"""احصائيات بوت85
+
+إجمالي المستخدمين: {summary["users"]}
+إجمالي المجموعات: {summary["groups"]}
+إجمالي التسبيحات: {summary["total_tasbih"]}
+المستخدمون النشطون: {summary["active_users"]}
+المستقبلون النشطون: {summary["active_receivers"]}
+أكملوا الأذكار اليوم: {summary["completed_today"]}
+التذكير موقف: {summary["notifications_off"]}
+التذكير التلقائي: {'مفعل' if AUTO_REMINDER_ENABLED else 'معطل'}
+Keep-Alive: {'مفعل' if HEROKU_URL else 'معطل'}
+فترة التذكير: {MIN_INTERVAL_HOURS}-{MAX_INTERVAL_HOURS} ساعة (أوقات متفرقة)
 
-        # أمر تشغيل التذكير
-        if text_lower == "تشغيل":
-            target_id = gid if gid else user_id
-            if target_id in notifications_off:
-                notifications_off.remove(target_id)
-                save_data()
-                msg = "تم تشغيل التذكير التلقائي لهذه المجموعة" if gid else "تم تشغيل التذكير التلقائي لك"
-                reply_message(event.reply_token, msg)
-                logger.info(f"تشغيل التذكير: {target_id}")
-            else:
-                reply_message(event.reply_token, "التذكير يعمل مسبقا")
-            return
+تم إنشاء هذا البوت بواسطة عبير الدوسري"""
+    reply_message(event.reply_token, stats_text)
 
-        # أمر الفضل
-        if text_lower == "فضل":
-            reply_message(event.reply_token, get_next_fadl())
-            return
+@command("ترتيب المجموعة", "المتصدرين", metric="leaderboard")
+def cmd_leaderboard(event, user_id, gid):
+    """أمر ترتيب المجموعة"""
+    if not gid:
+        reply_message(event.reply_token, "هذا الأمر متاح في المجموعات فقط")
+        return
 
-        # أمر التسبيح
-        if text_lower == "تسبيح":
-            status = get_tasbih_status(user_id, gid)
-            if was_reset:
-                status = "تم تصفير العداد ليوم جديد\n\n" + status
-            reply_message(event.reply_token, status)
-            return
+    summary, board = group_leaderboard(gid, LEADERBOARD_SIZE)
+    if not board:
+        reply_message(event.reply_token, "لا يوجد تسبيح في هذه المجموعة اليوم")
+        return
 
-        # أمر الإعادة
-        if text_lower == "إعادة":
-            tasbih_counts[user_id] = {key: 0 for key in TASBIH_KEYS}
-            last_reset_dates[user_id] = str(date.today())
-            save_data()
-            reply_message(event.reply_token, "تم تصفير عداد التسبيح بنجاح\nيمكنك البدء من جديد")
-            logger.info(f"تم تصفير التسبيح يدويا: {user_id}")
-            return
+    lines = ["ترتيب المجموعة اليوم\n"]
+    for entry in board:
+        done = " (أكمل)" if entry["completed"] else ""
+        lines.append(f"{entry['rank']}. {entry['name']}: {entry['count']}{done}")
+    lines.append(f"""
+سبحوا اليوم: {summary["active_today"]} من {summary["members"]}
+أكملوا الأذكار: {summary["completed_today"]}
+مجموع تسبيح المجموعة: {summary["total_today"]}""")
+    reply_message(event.reply_token, "\n".join(lines))
+
+def handle_tasbih(key, event, user_id, gid):
+    """زيادة عداد التسبيح"""
+    counts, incremented = store.increment(user_id, key, TASBIH_LIMITS, today_epoch_day())
+    maybe_flush()
+    
+    if not incremented:
+        reply_message(event.reply_token, f"تم اكتمال {key} مسبقا\nاستخدم أمر: إعادة\nلتصفير العداد")
+        return
 
-        # أمر الإحصائيات
-        if text_lower == "احصائيات":
-            total_tasbih = sum(sum(counts.values()) for counts in tasbih_counts.values())
-            active_receivers = len(target_users) + len(target_groups) - len(notifications_off)
-            
-            stats_text = f"""احصائيات بوت85
-
-إجمالي المستخدمين: {len(target_users)}
-إجمالي المجموعات: {len(target_groups)}
-إجمالي التسبيحات: {total_tasbih}
-المستخدمون النشطون: {len(tasbih_counts)}
-المستقبلون النشطون: {active_receivers}
-التذكير موقف: {len(notifications_off)}
-التذكير التلقائي: {'مفعل' if AUTO_REMINDER_ENABLED else 'معطل'}
-Keep-Alive: {'مفعل' if HEROKU_URL else 'معطل'}
-فترة التذكير: {MIN_INTERVAL_HOURS}-{MAX_INTERVAL_HOURS} ساعة (أوقات متفرقة)
+    if counts[key] == TASBIH_LIMITS:
+        reply_message(event.reply_token, f"تم اكتمال {key}")
+        
+        if all(counts[k] >= TASBIH_LIMITS for k in TASBIH_KEYS):
+            time.sleep(1)
+            send_message(user_id, "تم اكتمال جميع التسبيحات الأربعة\nجزاك الله خيرا")
+        return
+    
+    reply_message(event.reply_token, get_tasbih_status(user_id, gid, counts))
 
-تم إنشاء هذا البوت بواسطة عبير الدوسري"""
-            reply_message(event.reply_token, stats_text)
+# كل صيغ التسبيح تسجل بعد التطبيع (مثل "سبحان الله" و"سبحانالله" و"الله اكبر")
+for _key in TASBIH_KEYS:
+    command(_key, metric="tasbih")(
+        lambda event, user_id, gid, key=_key: handle_tasbih(key, event, user_id, gid)
+    )
+
+@command("ذكرني")
+def cmd_remind(event, user_id, gid):
+    """أمر ذكرني"""
+    try:
+        message = content_rotation.pick("adhkar", gid or user_id)
+        
+        if not message:
+            reply_message(event.reply_token, "لا يوجد أذكار متاحة")
+            logger.warning("لا يوجد أذكار في content.json")
             return
+        
+        logger.info(f"تم اختيار ذكر: {message[:50]}...")
+        
+        # كل مستلم يأخذ الذكر التالي في ترتيبه الخاص
+        reply_message(event.reply_token, message)
+        job_id = job_queue.enqueue("broadcast", {
+            "pool": "adhkar",
+            "exclude_user": user_id,
+            "exclude_group": gid
+        })
+        
+        logger.info(f"تم تنفيذ أمر ذكرني من {user_id} - المهمة {job_id}")
+        
+    except Exception as e:
+        logger.error(f"خطأ في أمر ذكرني: {e}", exc_info=True)
+        reply_message(event.reply_token, "حدث خطأ، حاول مرة أخرى")
 
-        # معالجة التسبيح
-        normalized = normalize_tasbih(user_text)
-        if normalized:
-            counts = tasbih_counts[user_id]
-            
-            if counts[normalized] >= TASBIH_LIMITS:
-                reply_message(event.reply_token, f"تم اكتمال {normalized} مسبقا\nاستخدم أمر: إعادة\nلتصفير العداد")
-                return
-            
-            counts[normalized] += 1
-            save_data()
-
-            if counts[normalized] == TASBIH_LIMITS:
-                reply_message(event.reply_token, f"تم اكتمال {normalized}")
-                
-                if all(counts[k] >= TASBIH_LIMITS for k in TASBIH_KEYS):
-                    time.sleep(1)
-                    send_message(user_id, "تم اكتمال جميع التسبيحات الأربعة\nجزاك الله خيرا")
-                return
-            
-            reply_message(event.reply_token, get_tasbih_status(user_id, gid))
+SALAM_SET = frozenset(SALAM_WORDS)
+
+@handler.add(MessageEvent, message=TextMessageContent)
+@idempotent
+def handle_message(event):
+    """معالج الرسائل الرئيسي"""
+    started = time.perf_counter()
+    metric = IGNORED_METRIC
+    try:
+        user_text = event.message.text.strip()
+        user_id = event.source.user_id
+        gid = getattr(event.source, "group_id", None)
+
+        # الرد على السلام
+        if user_text in SALAM_SET:
+            metric = SALAM_METRIC
+            reply_message(event.reply_token, "وعليكم السلام ورحمة الله وبركاته")
             return
 
-        # أمر ذكرني
-        if text_lower == "ذكرني":
-            try:
-                adhkar_list = content.get("adhkar", [])
-                
-                if not adhkar_list:
-                    reply_message(event.reply_token, "لا يوجد أذكار متاحة")
-                    logger.warning("لا يوجد أذكار في content.json")
+        # تسجيل المستخدم والمجموعة (بدون كتابة إن كانا معروفين مسبقا)
+        if store.add_user(user_id):
+            logger.info(f"مستخدم جديد: {user_id}")
+        if gid and store.add_group(gid):
+            logger.info(f"مجموعة جديدة: {gid}")
+        if gid and user_id:
+            store.add_member(gid, user_id)
+        store.touch(user_id, gid, today_epoch_day())
+        # من يراسل البوت مجددا يعود لقائمة الإرسال
+        for target_id in store.reactivate(user_id, gid):
+            logger.info(f"تمت إعادة تفعيل الإرسال إلى {target_id}")
+
+        # تحذير من تكرار الروابط (فقط في المجموعات)
+        if gid and ("http" in user_text or "www." in user_text):
+            for link in extract_links(user_text):
+                if link_index.seen_or_add(gid, user_id, link):
+                    metric = LINK_METRIC
+                    reply_message(
+                        event.reply_token,
+                        "تنبيه:\nممنوع تكرار نفس الرابط أكثر من مرة"
+                    )
                     return
-                
-                message = random.choice(adhkar_list)
-                
-                logger.info(f"تم اختيار ذكر: {message[:50]}...")
-                
-                reply_message(event.reply_token, message)
-                sent, failed = broadcast_text(message, exclude_user=user_id, exclude_group=gid)
-                
-                logger.info(f"تم تنفيذ أمر ذكرني من {user_id}")
-                logger.info(f"تم الإرسال إلى: {sent} - فشل: {failed}")
-                
-            except Exception as e:
-                logger.error(f"خطأ في أمر ذكرني: {e}", exc_info=True)
-                reply_message(event.reply_token, "حدث خطأ، حاول مرة أخرى")
+
+        # تجاهل الرسائل غير الصحيحة - البوت صامت
+        command_handler = COMMAND_HANDLERS.get(normalize_command(user_text))
+        if command_handler is None:
+            words = user_text.split()
+            command_handler = ARG_COMMAND_HANDLERS.get(normalize_command("".join(words[:2])))
+            if command_handler is None:
+                return
+            metric = command_handler.metric
+            command_handler(event, user_id, gid, words[2:])
             return
 
+        metric = command_handler.metric
+        command_handler(event, user_id, gid)
+
     except Exception as e:
         logger.error(f"خطأ في معالجة الرسالة: {e}", exc_info=True)
+    finally:
+        metric.observe(time.perf_counter() - started)
+
+@handler.add(FollowEvent)
+@idempotent
+def handle_follow(event):
+    """إضافة البوت كصديق أو إلغاء الحظر"""
+    user_id = event.source.user_id
+    store.add_user(user_id)
+    store.reactivate(user_id, cached=False)
+    logger.info(f"متابعة من: {user_id}")
+
+@handler.add(UnfollowEvent)
+@idempotent
+def handle_unfollow(event):
+    """حظر البوت - إيقاف الإرسال للمستخدم فورا"""
+    if store.deactivate(event.source.user_id, "unfollow"):
+        logger.info(f"تم إيقاف الإرسال إلى {event.source.user_id} (حظر)")
+
+@handler.add(JoinEvent)
+@idempotent
+def handle_join(event):
+    """انضمام البوت لمجموعة"""
+    gid = getattr(event.source, "group_id", None)
+    if gid:
+        store.add_group(gid)
+        store.reactivate(gid, cached=False)
+        logger.info(f"انضمام إلى مجموعة: {gid}")
+
+@handler.add(LeaveEvent)
+@idempotent
+def handle_leave(event):
+    """خروج البوت من مجموعة - إيقاف الإرسال لها فورا"""
+    gid = getattr(event.source, "group_id", None)
+    if gid and store.deactivate(gid, "leave"):
+        logger.info(f"تم إيقاف الإرسال إلى {gid} (مغادرة)")
+
+# ========================================
+# خط معالجة الأحداث (رد فوري ثم معالجة)
+# ========================================
+def percentile(samples, pct):
+    """القيمة عند النسبة المئوية المطلوبة من عينة"""
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 2)
+
+def event_source_id(event):
+    """المصدر الذي يجب الحفاظ على ترتيب أحداثه: المجموعة أو الغرفة أو المستخدم"""
+    source = getattr(event, "source", None)
+    return (
+        getattr(source, "group_id", None)
+        or getattr(source, "room_id", None)
+        or getattr(source, "user_id", None)
+        or ""
+    )
+
+def dispatch_event(event):
+    """استدعاء المعالج المسجل في handler لنوع الحدث - بنفس ترتيب WebhookHandler.handle"""
+    keys = []
+    if isinstance(event, MessageEvent):
+        keys.append(f"{type(event).__name__}_{type(event.message).__name__}")
+    keys.append(type(event).__name__)
+    for key in keys:
+        func = handler._handlers.get(key)
+        if func is not None:
+            func(event)
+            return
+
+class EventPipeline:
+    """طابور لكل عامل: أحداث المصدر الواحد تذهب دائما لنفس العامل فتعالج بالترتيب
+    والمصادر المختلفة تعالج بالتوازي"""
+
+    def __init__(self, workers, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.ack_ms = deque(maxlen=LATENCY_SAMPLES)
+        self.lag_ms = deque(maxlen=LATENCY_SAMPLES)
+        self.processed = [0] * workers
+        self.errors = 0
+        self.rejected = 0
+        self.started_at = time.time()
+        self.threads = []
+
+    def start(self):
+        self.started_at = time.time()
+        for index, events in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(index, events), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, event):
+        """وضع الحدث في طابور مصدره - يرفع queue.Full إذا بقي الطابور ممتلئا"""
+        events = self.queues[hash(event_source_id(event)) % len(self.queues)]
+        try:
+            events.put((time.monotonic(), event), timeout=EVENT_QUEUE_TIMEOUT)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise
+
+    def record_ack(self, elapsed_ms):
+        with self.lock:
+            self.ack_ms.append(elapsed_ms)
+
+    def _worker(self, index, events):
+        while True:
+            item = events.get()
+            if item is None:
+                events.task_done()
+                return
+            enqueued_at, event = item
+            started = time.monotonic()
+            try:
+                dispatch_event(event)
+            except Exception as e:
+                logger.error(f"خطأ في معالجة حدث: {e}", exc_info=True)
+                with self.lock:
+                    self.errors += 1
+            finally:
+                with self.lock:
+                    self.processed[index] += 1
+                    self.lag_ms.append((started - enqueued_at) * 1000)
+                events.task_done()
+
+    def stop(self, timeout=10):
+        """إنهاء العمال بعد معالجة ما في الطوابير"""
+        for events in self.queues:
+            try:
+                events.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def summary(self):
+        uptime = max(time.time() - self.started_at, 1e-9)
+        with self.lock:
+            ack = list(self.ack_ms)
+            lag = list(self.lag_ms)
+            processed = list(self.processed)
+            errors, rejected = self.errors, self.rejected
+        return {
+            "workers": len(self.queues),
+            "queued": sum(events.qsize() for events in self.queues),
+            "processed": sum(processed),
+            "errors": errors,
+            "rejected": rejected,
+            "ack_ms": {"p50": percentile(ack, 50), "p99": percentile(ack, 99)},
+            "queue_lag_ms": {"p50": percentile(lag, 50), "p99": percentile(lag, 99)},
+            "events_per_sec": round(sum(processed) / uptime, 3),
+            "events_per_sec_per_worker": [round(count / uptime, 3) for count in processed]
+        }
+
+event_pipeline = EventPipeline(EVENT_WORKERS, EVENT_QUEUE_SIZE) if EVENT_WORKERS > 0 else None
+
+# ========================================
+# تشغيل الخدمات الخلفية
+# ========================================
+IMPORT_PID = os.getpid()
+services_pid = None
+
+# اتصالات SQLite الموروثة من العملية الرئيسية - تبقى مرجعة في العامل حتى لا يغلقها جامع الكائنات
+inherited_connections = []
+
+def reopen_databases():
+    """اتصالات SQLite المفتوحة قبل fork لا تستخدم في العامل - يفتح كل كائن اتصاله من جديد
+    الاتصال القديم لا يغلق ولا يترك ليغلقه CPython: الإغلاق في العامل قد يكتب أو يحرر أقفال
+    ملف القاعدة و WAL التي تخص العملية الرئيسية، فيحفظ في inherited_connections حتى نهاية العامل"""
+    owners = [content_rotation, job_queue, scheduler, reminders, event_dedup]
+    if isinstance(store, SqliteStore):
+        owners.append(store)
+    if isinstance(link_index, SharedLinkIndex):
+        owners.append(link_index)
+    for owner in owners:
+        inherited_connections.append(owner.conn)
+        owner.conn = open_db(owner.path)
+
+def start_background_services(workers=None):
+    """تشغيل الخيوط الخلفية مرة واحدة لكل عملية - الخيوط لا تنتقل عبر fork
+    فمع gunicorn --preload يستدعيها post_fork في كل عامل
+    workers: عدد عمليات الإرسال - حد الإرسال لكل عملية هو PUSH_RATE_LIMIT مقسوما عليه"""
+    global services_pid
+    if services_pid == os.getpid():
+        return
+    if os.getpid() != IMPORT_PID:
+        reopen_databases()
+    services_pid = os.getpid()
+
+    # مهام الإرسال والتذكير تعمل في كل عامل والحد لكل القناة
+    workers = workers or int(os.getenv("WEB_CONCURRENCY", 1))
+    if workers > 1:
+        push_rate_limiter.set_rate(PUSH_RATE_LIMIT / workers)
+        logger.info(f"✓ حد الإرسال لهذا العامل {PUSH_RATE_LIMIT / workers:g} رسالة/ث ({workers} عمال)")
+
+    # الحفظ المؤجل مع حفظ نهائي عند الإيقاف
+    if WRITE_BEHIND_ENABLED:
+        threading.Thread(target=write_behind_flusher, daemon=True).start()
+        atexit.register(flush_counts)
+        logger.info(f"✓ تم تشغيل الحفظ المؤجل (كل {FLUSH_INTERVAL_SECONDS} ثانية أو {FLUSH_THRESHOLD} تغيير)")
+    elif isinstance(store, JsonStore):
+        # آخر نشاط والعضوية بدون حفظ فوري - ما لم يدخل في حفظ سابق يكتب عند الإيقاف
+        atexit.register(flush_counts)
+
+    threading.Thread(target=job_worker, daemon=True).start()
+    logger.info("✓ تم تشغيل طابور المهام الخلفية")
+
+    # المجدول ومواعيد التذكير يعملان فعليا في العملية القائدة فقط
+    threading.Thread(target=scheduler.loop, daemon=True).start()
+    atexit.register(scheduler.release)
+    threading.Thread(target=reminders.loop, daemon=True).start()
+    logger.info("✓ تم تشغيل المجدول")
+
+    if event_pipeline:
+        event_pipeline.start()
+        atexit.register(event_pipeline.stop)
+
+if not DEFER_BACKGROUND_SERVICES:
+    start_background_services()
 
 @app.route("/", methods=["GET"])
 def home():
     """الصفحة الرئيسية"""
+    summary = store.summary()
     return jsonify({
         "status": "running",
         "bot": "بوت85",
         "creator": "عبير الدوسري",
         "version": "2.2",
-        "users": len(target_users),
-        "groups": len(target_groups),
-        "notifications_disabled": len(notifications_off),
+        "users": summary["users"],
+        "groups": summary["groups"],
+        "notifications_disabled": summary["notifications_off"],
         "auto_reminder": AUTO_REMINDER_ENABLED,
         "keep_alive": bool(HEROKU_URL)
     }), 200
@@ -520,24 +3796,37 @@ def home():
 @app.route("/health", methods=["GET"])
 def health():
     """فحص صحة البوت"""
+    summary = store.summary()
     return jsonify({
         "status": "healthy",
-        "users": len(target_users),
-        "groups": len(target_groups),
+        "users": summary["users"],
+        "groups": summary["groups"],
         "timestamp": datetime.now().isoformat()
     }), 200
 
 @app.route("/callback", methods=["POST"])
 def callback():
     """معالج webhook من LINE"""
+    started = time.monotonic()
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
     
     try:
-        handler.handle(body, signature)
+        if event_pipeline is None:
+            handler.handle(body, signature)
+        else:
+            # التحقق من التوقيع فقط ثم الرد - المعالجة في عمال الخلفية
+            payload = handler.parser.parse(body, signature, as_payload=True)
+            for event in payload.events:
+                event_pipeline.submit(event)
+            event_pipeline.record_ack((time.monotonic() - started) * 1000)
     except InvalidSignatureError:
         logger.warning("توقيع غير صالح")
         return "Invalid signature", 400
+    except queue.Full:
+        # LINE يعيد الإرسال لاحقا - والأحداث المعالجة مسبقا يتجاهلها منع التكرار
+        logger.warning("طابور الأحداث ممتلئ")
+        return "Busy", 503
     except Exception as e:
         logger.error(f"خطأ في webhook: {e}", exc_info=True)
     
@@ -546,38 +3835,84 @@ def callback():
 @app.route("/stats", methods=["GET"])
 def stats():
     """عرض الإحصائيات"""
-    total_tasbih = sum(sum(counts.values()) for counts in tasbih_counts.values())
-    active_receivers = len(target_users) + len(target_groups) - len(notifications_off)
+    summary = store.summary()
     
     return jsonify({
         "bot_name": "بوت85",
         "creator": "عبير الدوسري",
-        "total_users": len(target_users),
-        "total_groups": len(target_groups),
-        "total_tasbih_count": total_tasbih,
-        "active_users": len(tasbih_counts),
-        "notifications_disabled": len(notifications_off),
-        "active_receivers": active_receivers,
+        "total_users": summary["users"],
+        "total_groups": summary["groups"],
+        "total_tasbih_count": summary["total_tasbih"],
+        "total_tasbih_per_key": summary["total_per_key"],
+        "completed_today": summary["completed_today"],
+        "active_users": summary["active_users"],
+        "notifications_disabled": summary["notifications_off"],
+        "active_receivers": summary["active_receivers"],
         "auto_reminder_enabled": AUTO_REMINDER_ENABLED,
         "keep_alive_enabled": bool(HEROKU_URL),
         "reminder_interval": f"{MIN_INTERVAL_HOURS}-{MAX_INTERVAL_HOURS} hours",
-        "adhkar_count": len(content.get("adhkar", [])),
-        "fadl_count": len(fadl_content)
+        "adhkar_count": len(content_library.items("adhkar")),
+        "fadl_count": len(content_library.items("fadl")),
+        "content": content_library.summary(),
+        "write_behind": {
+            "enabled": WRITE_BEHIND_ENABLED,
+            "pending": store.pending_changes,
+            **flush_stats
+        },
+        "jobs": job_queue.summary(),
+        "line_api": api_latency_summary(),
+        "profile_cache": profile_cache.summary(),
+        "link_index": link_index.summary(),
+        "webhook_dedup": event_dedup.summary(),
+        "event_pipeline": event_pipeline.summary() if event_pipeline else None,
+        "delivery": {**store.delivery_summary(), **delivery_stats}
     }), 200
 
+@app.route("/groups/<group_id>/leaderboard", methods=["GET"])
+def group_leaderboard_endpoint(group_id):
+    """ترتيب أعضاء المجموعة اليوم - ?limit=عدد مع Authorization: Bearer <LEADERBOARD_TOKEN>"""
+    if not LEADERBOARD_TOKEN:
+        return jsonify({"error": "leaderboard endpoint disabled"}), 403
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").encode()
+    if not hmac.compare_digest(supplied, LEADERBOARD_TOKEN.encode()):
+        return jsonify({"error": "unauthorized"}), 401
+    limit = max(1, min(request.args.get("limit", LEADERBOARD_SIZE, type=int), LEADERBOARD_MAX))
+    summary, board = group_leaderboard(group_id, limit)
+    return jsonify({
+        "group_id": group_id,
+        "day": today_epoch_day(),
+        **summary,
+        "leaderboard": board
+    }), 200
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """المقاييس بصيغة Prometheus"""
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/scheduler", methods=["GET"])
+def scheduler_status():
+    """حالة المجدول: القائد، موعد التشغيل التالي، وسجل التشغيل"""
+    return jsonify({**scheduler.summary(), "reminders": reminders.summary()}), 200
+
 @app.route("/test_reminder", methods=["GET"])
 def test_reminder():
-    """اختبار التذكير اليدوي"""
+    """اختبار التذكير اليدوي - ?segment=users|groups|active:7|incomplete"""
+    segment = request.args.get("segment", "all")
+    try:
+        parse_segment(segment)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     try:
-        if fadl_content:
-            message = random.choice(fadl_content)
-            sent, failed = broadcast_text(message)
+        if content_library.items("fadl"):
+            sent, failed = broadcast_text(pool="fadl", segment=segment)
             return jsonify({
                 "status": "success",
-                "message": message[:100] + "..." if len(message) > 100 else message,
+                "segment": segment,
+                "pool": "fadl",
                 "sent": sent,
                 "failed": failed,
-                "disabled_count": len(notifications_off)
+                "disabled_count": store.summary()["notifications_off"]
             }), 200
         else:
             return jsonify({"status": "error", "message": "no fadl available in fadl.json"}), 400
@@ -589,16 +3924,18 @@ if __name__ == "__main__":
     logger.info("=" * 50)
     logger.info("بوت85 - تم إنشاؤه بواسطة عبير الدوسري")
     logger.info("=" * 50)
+    summary = store.summary()
     logger.info(f"المنفذ: {PORT}")
-    logger.info(f"المستخدمون: {len(target_users)}")
-    logger.info(f"المجموعات: {len(target_groups)}")
-    logger.info(f"التذكير موقف لـ: {len(notifications_off)}")
-    logger.info(f"محتوى الأذكار: {len(content.get('adhkar', []))}")
-    logger.info(f"محتوى الفضل: {len(fadl_content)}")
+    logger.info(f"المستخدمون: {summary['users']}")
+    logger.info(f"المجموعات: {summary['groups']}")
+    logger.info(f"التذكير موقف لـ: {summary['notifications_off']}")
+    logger.info(f"محتوى الأذكار: {len(content_library.items('adhkar'))}")
+    logger.info(f"محتوى الفضل: {len(content_library.items('fadl'))}")
     logger.info(f"التذكير التلقائي: {'مفعل' if AUTO_REMINDER_ENABLED else 'معطل'}")
     logger.info(f"Keep-Alive: {'مفعل ✓' if HEROKU_URL else 'معطل ✗'}")
     logger.info(f"فترة التذكير: {MIN_INTERVAL_HOURS}-{MAX_INTERVAL_HOURS} ساعة (أوقات متفرقة)")
     logger.info("مصدر التذكير اليدوي (ذكرني): content.json (أذكار)")
     logger.info("مصدر التذكير التلقائي: fadl.json (فضائل)")
     logger.info("=" * 50)
+    start_background_services()
     app.run(host="0.0.0.0", port=PORT)
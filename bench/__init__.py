@@ -0,0 +1,5 @@
+"""
+سكربتات القياس والمحاكاة - تشغل من جذر المستودع كوحدات:
+    python -m bench.loadtest --events 5000
+    python -m bench.write_bench --users 1000 10000
+"""
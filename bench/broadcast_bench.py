@@ -0,0 +1,59 @@
+"""
+قياس سرعة الإرسال الجماعي (رسالة في الثانية) عند عدة مستويات توازي مقابل خادم LINE وهمي
+
+الاستخدام:
+    python -m bench.broadcast_bench --recipients 2000 --concurrency 1 4 16 32
+    python -m bench.broadcast_bench --multicast   # الإرسال المتعدد (500 مستخدم لكل طلب)
+
+الخادم الوهمي هو MockLineApi من bench/loadtest.py (زمن استجابة حول --latency-ms ونسبة 429)
+ومحدد المعدل PUSH_RATE_LIMIT يرفع حتى يقاس التوازي وحده - كل مستوى يرسل لنفس المستلمين
+ويعد الطلبات الصادرة وردود 429 والمكررات التي رفضها الخادم بمفتاح X-Line-Retry-Key
+"""
+import os, time, sqlite3, argparse
+
+from bench.common import import_app
+from bench.loadtest import MockLineApi
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="سرعة الإرسال الجماعي حسب التوازي")
+    parser.add_argument("--recipients", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--rate-limited", type=float, default=0.02, help="نسبة ردود 429")
+    parser.add_argument("--retry-after", type=int, default=None, help="قيمة Retry-After مع 429 (افتراضيا تراجع أسي)")
+    parser.add_argument("--multicast", action="store_true")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    mock = MockLineApi(0, args.latency_ms, args.rate_limited, args.retry_after)
+    mock.start()
+
+    os.environ.setdefault("PUSH_RATE_LIMIT", "1000000")
+    app = import_app("broadcast_bench_", env={"LINE_API_HOST": f"http://127.0.0.1:{mock.port}"})
+
+    conn = sqlite3.connect(app.DB_FILE)
+    with conn:
+        conn.executemany("INSERT INTO users (id) VALUES (?)", ((f"U{i:032x}",) for i in range(args.recipients)))
+    conn.close()
+
+    print(f"{'concurrency':>11} {'sent':>6} {'failed':>6} {'seconds':>8} {'msg/s':>9} {'calls':>6} {'429':>5} {'409':>5}")
+    for concurrency in args.concurrency:
+        app.BROADCAST_CONCURRENCY = concurrency
+        with mock.lock:
+            mock.calls.clear()
+            mock.throttled.clear()
+            mock.duplicates = 0
+        started = time.perf_counter()
+        sent, failed = app.broadcast_text("سبحان الله وبحمده", segment="users", multicast=args.multicast)
+        elapsed = time.perf_counter() - started
+        with mock.lock:
+            calls = sum(mock.calls.values())
+            throttled = sum(mock.throttled.values())
+            duplicates = mock.duplicates
+        print(f"{concurrency:>11} {sent:>6} {failed:>6} {elapsed:>8.2f} {sent / elapsed:>9.1f} "
+              f"{calls:>6} {throttled:>5} {duplicates:>5}", flush=True)
+    mock.stop()
+
+if __name__ == "__main__":
+    main()
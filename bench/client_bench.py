@@ -0,0 +1,80 @@
+"""
+قياس قبل/بعد لعميل LINE المشترك: عميل جديد لكل طلب مقابل call_line_api مع مجمع الاتصالات
+
+الاستخدام:
+    python -m bench.client_bench --calls 200
+    python -m bench.client_bench --latency 20   # زمن استجابة للخادم الوهمي (مللي ثانية)
+
+الخادم الوهمي هو MockLineApi من bench/loadtest.py عبر HTTPS بشهادة موقعة ذاتيا (تنشأ بـ openssl)
+العميل الجديد لكل طلب يدفع اتصال TCP ومصافحة TLS في كل مرة، والمشترك يعيد استخدام الاتصال
+"""
+import os, ssl, time, argparse, tempfile, subprocess, statistics
+
+from bench.common import import_app
+from bench.loadtest import MockLineApi
+
+def make_certificate(directory):
+    """شهادة موقعة ذاتيا لـ 127.0.0.1 - تعيد (الشهادة، المفتاح)"""
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+        "-keyout", key, "-out", cert, "-subj", "/CN=127.0.0.1",
+        "-addext", "subjectAltName=IP:127.0.0.1"
+    ], check=True, capture_output=True)
+    return cert, key
+
+def start_https_mock(latency_ms, cert, key):
+    """MockLineApi مع تغليف مقبس الاستماع بـ TLS"""
+    mock = MockLineApi(0, latency_ms=latency_ms, rate_limited=0)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    mock.server.socket = context.wrap_socket(mock.server.socket, server_side=True)
+    # الرأس والجسم يكتبان منفصلين: بدون TCP_NODELAY ينتظر الرد 40ms (Nagle مع ACK المؤجل) على الاتصال المعاد استخدامه
+    mock.server.RequestHandlerClass.disable_nagle_algorithm = True
+    mock.start()
+    return mock
+
+def measure(label, call, calls):
+    timings = []
+    for i in range(calls):
+        started = time.perf_counter()
+        call(f"Uclientbench{i:08d}")
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{label:<28} {statistics.mean(timings):>8.2f} {timings[len(timings) // 2]:>8.2f} "
+          f"{timings[int(len(timings) * 0.95)]:>8.2f} {sum(timings) / 1000:>8.2f}")
+    return statistics.mean(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="عميل جديد لكل طلب مقابل العميل المشترك عبر HTTPS")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0, help="زمن استجابة الخادم الوهمي (مللي ثانية)")
+    args = parser.parse_args()
+
+    cert, key = make_certificate(tempfile.mkdtemp(prefix="client_bench_cert_"))
+    mock = start_https_mock(args.latency, cert, key)
+
+    app = import_app("client_bench_", env={"LINE_API_HOST": f"https://127.0.0.1:{mock.port}"})
+    from linebot.v3.messaging import ApiClient, MessagingApi
+
+    app.configuration.ssl_ca_cert = cert
+
+    def per_call_client(user_id):
+        # الطريقة القديمة: عميل ومجمع اتصالات جديدان لكل طلب
+        with ApiClient(app.configuration) as api_client:
+            return MessagingApi(api_client).get_profile(user_id)
+
+    def shared_client(user_id):
+        return app.call_line_api("profile", lambda api: api.get_profile(user_id))
+
+    shared_client("Uclientbenchwarmup")  # إنشاء العميل المشترك وفتح أول اتصال خارج القياس
+    print(f"{args.calls} طلب get_profile متتالي عبر HTTPS، زمن الخادم {args.latency:g} مللي ثانية")
+    print(f"{'':<28} {'avg ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'total s':>8}")
+    before = measure("عميل جديد لكل طلب", per_call_client, args.calls)
+    after = measure("call_line_api (مشترك)", shared_client, args.calls)
+    print(f"التحسن: {before / after:.1f}x لكل طلب")
+    mock.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+أدوات مشتركة لسكربتات القياس: مجلد المستودع، استيراد app.py معزولا في مجلد مؤقت، والنسب المئوية
+"""
+import os, sys, shutil, logging, tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTENT_FILES = ("content.json", "fadl.json")
+
+# القياس داخل العملية: بدون خيوط خلفية ولا عمال أحداث ولا اتصال بـ LINE
+BENCH_ENV = {
+    "EVENT_WORKERS": "0",
+    "DEFER_BACKGROUND_SERVICES": "true",
+    "LINE_CHANNEL_SECRET": "bench",
+    "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+}
+
+def copy_content(directory, app_dir=REPO):
+    """نسخ ملفات المحتوى إلى مجلد التشغيل (app.py يقرؤها من المجلد الحالي)"""
+    for name in CONTENT_FILES:
+        if os.path.exists(os.path.join(app_dir, name)):
+            shutil.copy(os.path.join(app_dir, name), directory)
+
+def import_app(prefix, app_dir=REPO, content=False, log_level=logging.WARNING, env=None):
+    """استيراد app.py في مجلد مؤقت جديد - يعيد الوحدة
+    app.py يقرأ الإعدادات وينشئ قاعدة البيانات في المجلد الحالي عند الاستيراد
+    env: قيم تفرض قبل الاستيراد (مثل LINE_API_HOST)، و BENCH_ENV قيم افتراضية لما لم يحدد"""
+    directory = tempfile.mkdtemp(prefix=prefix)
+    if content:
+        copy_content(directory, app_dir)
+    os.chdir(directory)
+    sys.path.insert(0, os.path.abspath(app_dir))
+    os.environ.update(env or {})
+    for name, value in BENCH_ENV.items():
+        os.environ.setdefault(name, value)
+    logging.disable(log_level)
+    import app
+    return app
+
+def percentile(samples, pct):
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def children(pid):
+    """العمليات الفرعية المباشرة (عمال gunicorn)"""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return []
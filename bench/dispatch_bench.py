@@ -0,0 +1,90 @@
+"""
+قياس سرعة توجيه الرسائل (رسالة في الثانية) لمحادثة مجموعات مختلطة أغلبها ليس أوامر
+
+الاستخدام:
+    python -m bench.dispatch_bench --messages 20000
+    python -m bench.dispatch_bench --app-dir /path/to/old/tree   # نفس القياس على نسخة أخرى من app.py
+
+handle_message يستدعى مباشرة داخل العملية (بدون HTTP ولا منع التكرار) والردود وطلبات LINE
+مستبدلة بدوال فارغة، فيقاس التوجيه وحده: التطبيع والبحث عن الأمر وتسجيل المستخدم والمجموعة
+كل المستخدمين والمجموعات يسجلون في جولة تحمية قبل القياس (الكتابة الأولى ليست من التوجيه)
+"""
+import time, random, argparse, types
+
+from bench.common import REPO, import_app
+from bench.loadtest import CHATTER_TEXTS, TASBIH_TEXTS, make_event
+
+# محادثة عادية بأطوال مختلفة - لا تطابق أي أمر
+CHATTER = CHATTER_TEXTS + [
+    "ما شاء الله تبارك الله",
+    "الله يجزاكم خير على التذكير",
+    "متى موعد اللقاء القادم يا جماعة؟",
+    "تم بحمد الله",
+    "👍",
+    "شكرا لكم جميعا",
+    "اللهم صل وسلم على نبينا محمد",
+]
+COMMANDS = TASBIH_TEXTS + ["تسبيح", "السلام عليكم"]
+
+def build_trace(args, rng):
+    trace = []
+    for _ in range(args.messages):
+        user_id = f"Ubench{rng.randrange(args.users):08d}"
+        group_id = f"Cbench{rng.randrange(args.groups):08d}"
+        text = rng.choice(COMMANDS) if rng.random() < args.commands else rng.choice(CHATTER)
+        trace.append((user_id, group_id, text))
+    return trace
+
+def stub_line(app):
+    """بدون طلبات LINE: الردود والإرسال ترجع نجاحا والملف الشخصي اسم ثابت"""
+    profile = types.SimpleNamespace(display_name="مستخدم")
+    stubs = {
+        "reply_message": lambda *args, **kwargs: True,
+        "send_message": lambda *args, **kwargs: True,
+        "call_line_api": lambda kind, call: profile,
+    }
+    for name, stub in stubs.items():
+        if hasattr(app, name):
+            setattr(app, name, stub)
+
+def main():
+    parser = argparse.ArgumentParser(description="سرعة توجيه رسائل المجموعات")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--commands", type=float, default=0.04, help="نسبة الرسائل التي هي أوامر")
+    parser.add_argument("--repeat", type=int, default=3, help="عدد مرات القياس (يعرض الأفضل)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--app-dir", default=REPO)
+    args = parser.parse_args()
+
+    # ملفات المحتوى من نفس النسخة المقاسة
+    app = import_app("dispatch_bench_", app_dir=args.app_dir, content=True)
+    from linebot.v3.webhooks import MessageEvent
+
+    stub_line(app)
+    # بدون منع التكرار: كتابة SQLite لكل حدث ليست من التوجيه
+    handle = getattr(app.handle_message, "__wrapped__", app.handle_message)
+    rng = random.Random(args.seed)
+    trace = build_trace(args, rng)
+    events = [MessageEvent.from_dict(make_event(*item)) for item in trace]
+
+    warmup = [MessageEvent.from_dict(make_event(f"Ubench{u:08d}", f"Cbench{u % args.groups:08d}", CHATTER[0]))
+              for u in range(args.users)]
+    warmup += [MessageEvent.from_dict(make_event(f"Ubench{u:08d}", f"Cbench{g:08d}", CHATTER[0]))
+               for u in range(args.users) for g in range(args.groups) if (u + g) % 7 == 0]
+    for event in warmup + events:
+        handle(event)
+
+    commands = sum(text in COMMANDS for _, _, text in trace)
+    results = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        for event in events:
+            handle(event)
+        results.append(len(events) / (time.perf_counter() - started))
+    print(f"{args.app_dir}: {len(events)} رسالة ({commands} أمر، {args.users} مستخدم، {args.groups} مجموعة)")
+    print(f"  أفضل {max(results):,.0f} رسالة/ث - كل المحاولات: {', '.join(f'{r:,.0f}' for r in results)}")
+
+if __name__ == "__main__":
+    main()
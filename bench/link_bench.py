@@ -0,0 +1,95 @@
+"""
+قياس فهرس تكرار الروابط مع ملايين الروابط بساعة افتراضية: الذاكرة (RSS) وسرعة الفحص وحجم القاعدة
+
+الاستخدام:
+    python -m bench.link_bench --links 3000000 --rate 100 --window 3600
+    python -m bench.link_bench --backend sqlite   # الفهرس المشترك في SQLite فقط
+
+memory هو LinkIndex (json، عملية واحدة) و sqlite هو SharedLinkIndex (مشترك بين العمال)
+كل نوع يعمل في عملية منفصلة حتى لا يختلط قياس الذاكرة - RSS يجب أن يثبت بعد امتلاء النافذة
+"""
+import os, sys, time, random, argparse, subprocess
+
+from bench.common import REPO, import_app, rss_mb
+
+class VirtualTime:
+    """بديل وحدة time داخل app.py: time() تعيد الساعة الافتراضية وباقي الدوال كما هي"""
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+def db_size_mb(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix)) / 2**20
+
+def run(args):
+    env = {"LINK_WINDOW_SECONDS": str(args.window)}
+    if args.max_entries:
+        env["LINK_MAX_ENTRIES"] = str(args.max_entries)
+    app = import_app("link_bench_", env=env)
+
+    if args.backend == "memory":
+        index = app.LinkIndex(app.LINK_WINDOW_SECONDS, app.LINK_BUCKETS, app.LINK_MAX_ENTRIES)
+    else:
+        index = app.SharedLinkIndex(app.DB_FILE, app.LINK_WINDOW_SECONDS, app.LINK_MAX_ENTRIES)
+    clock = VirtualTime(1_700_000_000.0)
+    app.time = clock
+
+    rng = random.Random(args.seed)
+    recent = []  # روابط حديثة يعاد نشرها (تكرار متوقع)
+    repeats = 0
+    report_every = max(1, args.links // 10)
+    print(f"[{args.backend}] rss قبل البدء {rss_mb():.1f} MB", flush=True)
+    print(f"{'links':>10} {'virtual h':>9} {'rss MB':>8} {'db MB':>7} {'lookups/s':>10} {'repeats':>8}", flush=True)
+    started = time.perf_counter()
+    for i in range(1, args.links + 1):
+        clock.now += 1 / args.rate
+        if recent and rng.random() < args.repeat:
+            group_id, user_id, link = rng.choice(recent)
+        else:
+            group_id = f"C{rng.randrange(args.groups):032x}"
+            user_id = f"U{rng.randrange(args.users):032x}"
+            link = f"https://example.com/{group_id[-6:]}/{i}"
+            if len(recent) < 1000:
+                recent.append((group_id, user_id, link))
+            else:
+                recent[rng.randrange(1000)] = (group_id, user_id, link)
+        repeats += index.seen_or_add(group_id, user_id, link)
+        if i % report_every == 0:
+            elapsed = time.perf_counter() - started
+            db = db_size_mb(app.DB_FILE) if args.backend == "sqlite" else 0
+            print(f"{i:>10} {i / args.rate / 3600:>9.1f} {rss_mb():>8.1f} {db:>7.1f} "
+                  f"{i / elapsed:>10.0f} {repeats:>8}", flush=True)
+    print(f"[{args.backend}] {index.summary()}", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="ذاكرة وسرعة فهرس تكرار الروابط")
+    parser.add_argument("--links", type=int, default=3_000_000)
+    parser.add_argument("--rate", type=float, default=100, help="روابط في الثانية الافتراضية")
+    parser.add_argument("--window", type=int, default=3600, help="LINK_WINDOW_SECONDS")
+    parser.add_argument("--max-entries", type=int, default=None, help="LINK_MAX_ENTRIES")
+    parser.add_argument("--groups", type=int, default=500)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--repeat", type=float, default=0.05, help="نسبة إعادة نشر رابط حديث")
+    parser.add_argument("--backend", choices=["both", "memory", "sqlite"], default="both")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.backend != "both":
+        run(args)
+        return
+    for backend in ("memory", "sqlite"):
+        command = [sys.executable, "-m", "bench.link_bench", "--backend", backend]
+        for name in ("links", "rate", "window", "max_entries", "groups", "users", "repeat", "seed"):
+            value = getattr(args, name)
+            if value is not None:
+                command += [f"--{name.replace('_', '-')}", str(value)]
+        subprocess.run(command, check=True, cwd=REPO)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,527 @@
+"""
+اختبار حمل لمسار /callback بحركة مختلطة قابلة لإعادة التشغيل وخادم LINE وهمي
+
+الاستخدام:
+    python -m bench.loadtest --events 5000 --concurrency 16
+    python -m bench.loadtest --events 5000 --save-baseline baseline.json   # تسجيل قياس مرجعي
+    python -m bench.loadtest --events 5000 --baseline baseline.json        # المقارنة به بعد أي تعديل
+    python -m bench.loadtest --save-trace trace.jsonl / --trace trace.jsonl   # نفس الحركة في كل تشغيل
+    LINE_CHANNEL_SECRET=... python -m bench.loadtest --url http://localhost:5000
+
+بدون --url يشغل gunicorn (مع gunicorn.conf.py) في مجلد مؤقت و LINE_API_HOST موجه إلى
+خادم وهمي داخل هذه العملية يحاكي زمن الاستجابة وأخطاء 429 ويعد كل طلب صادر
+مع --url يعمل الخادم الوهمي على --mock-port ليوجه إليه البوت القائم إن أردت عد الطلبات الصادرة
+
+الحركة: سلام، دفعات تسبيح متتالية من نفس المستخدم، ذكرني، محادثة مجموعات بروابط (بعضها مكرر)،
+احصائيات - والنسب قابلة للتغيير بـ --mix (مثلا إضافة board=3 لأمر ترتيب المجموعة)
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import os, sys, json, hmac, hashlib, base64, time, random, argparse, uuid, threading
+import shutil, signal, tempfile, subprocess
+import requests
+
+from bench.common import REPO, copy_content, children, percentile
+
+SALAM_TEXTS = ["السلام عليكم", "السلام عليكم ورحمة الله", "السلام عليكم ورحمة الله وبركاته"]
+TASBIH_TEXTS = ["استغفر الله", "سبحان الله", "الحمد لله", "الله أكبر"]
+CHATTER_TEXTS = ["جزاكم الله خيرا", "آمين", "صباح الخير", "بارك الله فيكم"]
+DEFAULT_MIX = "salam=15,tasbih=50,remind=1,links=25,stats=4,status=5"
+
+# ========================================
+# توليد الحركة
+# ========================================
+def parse_mix(value):
+    """"salam=15,tasbih=50,..." -> {النوع: الوزن}"""
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in TRAFFIC:
+            raise argparse.ArgumentTypeError(f"نوع حركة غير معروف: {name}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+def pick_source(args, rng, group_only=False):
+    user_id = f"Uload{rng.randrange(args.users):08d}"
+    group_id = None
+    if args.groups and (group_only or rng.random() < args.group_ratio):
+        group_id = f"Cload{rng.randrange(args.groups):08d}"
+    return user_id, group_id
+
+def salam_events(args, rng):
+    user_id, group_id = pick_source(args, rng)
+    return [(user_id, group_id, rng.choice(SALAM_TEXTS))]
+
+def tasbih_events(args, rng):
+    """دفعة تسبيح: نفس المستخدم يرسل نفس الذكر عدة مرات متتالية"""
+    user_id, group_id = pick_source(args, rng)
+    text = rng.choice(TASBIH_TEXTS)
+    return [(user_id, group_id, text)] * rng.randint(args.burst_min, args.burst_max)
+
+def remind_events(args, rng):
+    user_id, group_id = pick_source(args, rng)
+    return [(user_id, group_id, "ذكرني")]
+
+def link_events(args, rng):
+    """محادثة مجموعة: روابط من مجموعة صغيرة لكل مجموعة فيتكرر بعضها، ورسائل بلا روابط"""
+    user_id, group_id = pick_source(args, rng, group_only=True)
+    if rng.random() < 0.5:
+        return [(user_id, group_id, rng.choice(CHATTER_TEXTS))]
+    link = f"https://example.com/v/{rng.randrange(args.links_per_group)}"
+    return [(user_id, group_id, f"شاهدوا هذا {link}")]
+
+def stats_events(args, rng):
+    user_id, group_id = pick_source(args, rng)
+    return [(user_id, group_id, "احصائيات")]
+
+def status_events(args, rng):
+    user_id, group_id = pick_source(args, rng)
+    return [(user_id, group_id, "تسبيح")]
+
+def board_events(args, rng):
+    user_id, group_id = pick_source(args, rng, group_only=True)
+    return [(user_id, group_id, "ترتيب المجموعة")]
+
+TRAFFIC = {
+    "salam": salam_events,
+    "tasbih": tasbih_events,
+    "remind": remind_events,
+    "links": link_events,
+    "stats": stats_events,
+    "status": status_events,
+    "board": board_events  # ليس في DEFAULT_MIX حتى تبقى المقارنة بالقياسات المسجلة سابقا صحيحة
+}
+
+def generate_trace(args):
+    """قائمة أحداث (user_id, group_id, text) ثابتة لنفس --seed"""
+    rng = random.Random(args.seed)
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    trace = []
+    while len(trace) < args.events:
+        trace.extend(TRAFFIC[rng.choices(names, weights)[0]](args, rng))
+    return trace[:args.events]
+
+def save_trace(path, trace):
+    with open(path, "w", encoding="utf-8") as f:
+        for user_id, group_id, text in trace:
+            f.write(json.dumps({"user": user_id, "group": group_id, "text": text}, ensure_ascii=False) + "\n")
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        return [(item["user"], item.get("group"), item["text"]) for item in map(json.loads, f) if item]
+
+def sign(secret, body):
+    """توقيع X-Line-Signature كما يحسبه LINE"""
+    digest = hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+def make_event(user_id, group_id, text):
+    """حدث رسالة نصية بمعرف حدث ورمز رد جديدين في كل تشغيل"""
+    source = {"type": "group", "groupId": group_id, "userId": user_id} if group_id \
+        else {"type": "user", "userId": user_id}
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": source,
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "message": {"type": "text", "id": str(random.getrandbits(48)), "text": text, "quoteToken": "q"}
+    }
+
+# ========================================
+# خادم LINE الوهمي
+# ========================================
+class MockLineApi:
+    """Messaging API وهمي: زمن استجابة عشوائي حول المتوسط ونسبة 429، ويعد الطلبات حسب النوع"""
+
+    def __init__(self, port, latency_ms, rate_limited, retry_after=None):
+        self.latency = latency_ms / 1000
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.calls = {}  # النوع -> عدد الطلبات (شاملا 429)
+        self.throttled = {}  # النوع -> عدد ردود 429
+        self.replied_at = {}  # رمز الرد -> وقت وصول الرد
+        self.accepted_keys = set()  # X-Line-Retry-Key لطلبات قبلت - تكرارها يرد بـ 409 كما تفعل LINE
+        self.duplicates = 0
+        self.last_call = time.perf_counter()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                mock.handle(self, b"")
+
+            def do_POST(self):
+                mock.handle(self, self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @staticmethod
+    def kind(path):
+        if path.startswith("/v2/bot/message/"):
+            return path.rsplit("/", 1)[-1]
+        if path.startswith("/v2/bot/profile/") or "/member/" in path:
+            return "profile"
+        return "other"
+
+    def handle(self, request, body):
+        received = time.perf_counter()
+        kind = self.kind(request.path)
+        time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        throttled = random.random() < self.rate_limited
+        retry_key = request.headers.get("X-Line-Retry-Key")
+        duplicate = False
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.last_call = time.perf_counter()
+            if throttled:
+                self.throttled[kind] = self.throttled.get(kind, 0) + 1
+            elif retry_key and retry_key in self.accepted_keys:
+                duplicate = True
+                self.duplicates += 1
+            else:
+                if retry_key:
+                    self.accepted_keys.add(retry_key)
+                if kind == "reply":
+                    self.replied_at[json.loads(body)["replyToken"]] = received
+
+        if throttled:
+            status, payload = 429, {"message": "The API rate limit has been exceeded. Try again later."}
+        elif duplicate:
+            status, payload = 409, {"message": "The retry key is already accepted"}
+        elif kind == "profile":
+            user_id = request.path.rsplit("/", 1)[-1]
+            status, payload = 200, {"displayName": f"مستخدم {user_id[-4:]}", "userId": user_id}
+        elif kind in ("reply", "push"):
+            status, payload = 200, {"sentMessages": [{"id": str(random.getrandbits(48)), "quoteToken": "q"}]}
+        else:
+            status, payload = 200, {}
+        data = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        if throttled and self.retry_after is not None:
+            request.send_header("Retry-After", str(self.retry_after))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def wait_idle(self, settle, timeout):
+        """انتظار توقف الطلبات الصادرة (انتهاء المعالجة والإرسال الجماعي) - يعيد False عند انتهاء المهلة"""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            with self.lock:
+                idle = time.perf_counter() - self.last_call
+            if idle >= settle:
+                return True
+            time.sleep(min(0.2, settle))
+        return False
+
+# ========================================
+# تشغيل البوت تحت gunicorn
+# ========================================
+def written_bytes(pids):
+    """مجموع ما كتبته العمليات (wchar: قاعدة البيانات والملفات والسجلات)"""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/io") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("wchar:"))
+        except (FileNotFoundError, PermissionError, StopIteration):
+            pass
+    return total
+
+class BotServer:
+    """gunicorn في مجلد مؤقت ببيانات فارغة، موجه إلى الخادم الوهمي"""
+
+    def __init__(self, args, mock_port):
+        self.args = args
+        self.directory = tempfile.mkdtemp(prefix="loadtest_")
+        copy_content(self.directory, args.app_dir)
+        self.env = dict(os.environ)
+        self.env.update({
+            "PYTHONPATH": args.app_dir,
+            "LINE_CHANNEL_SECRET": args.secret,
+            "LINE_CHANNEL_ACCESS_TOKEN": "loadtest",
+            "LINE_API_HOST": f"http://127.0.0.1:{mock_port}",
+            "STORAGE_BACKEND": args.backend,
+            "HEROKU_URL": ""
+        })
+        self.env.update(item.split("=", 1) for item in args.env)
+        self.url = f"http://127.0.0.1:{args.port}"
+        self.process = None
+
+    def start(self):
+        command = [sys.executable, "-m", "gunicorn", "app:app", f"--workers={self.args.workers}",
+                   f"--bind=127.0.0.1:{self.args.port}", "--log-level=warning", "--timeout=120"]
+        config = os.path.join(self.args.app_dir, "gunicorn.conf.py")
+        if os.path.exists(config):
+            command.append(f"--config={config}")
+        self.process = subprocess.Popen(command, cwd=self.directory, env=self.env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.perf_counter() + 60
+        while time.perf_counter() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"توقف gunicorn برمز {self.process.returncode}")
+            try:
+                if requests.get(f"{self.url}/health", timeout=1).status_code == 200 \
+                        and len(children(self.process.pid)) >= self.args.workers:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.05)
+        raise RuntimeError("لم يبدأ gunicorn خلال 60 ثانية")
+
+    def pids(self):
+        return [self.process.pid, *children(self.process.pid)]
+
+    def data_json_bytes(self):
+        """bot_store_write_bytes_sum من /metrics - صحيح مع عامل واحد فقط (تخزين json)"""
+        try:
+            text = requests.get(f"{self.url}/metrics", timeout=10).text
+        except requests.RequestException:
+            return None
+        for line in text.splitlines():
+            if line.startswith("bot_store_write_bytes_sum"):
+                return float(line.split()[-1])
+        return None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+# ========================================
+# القياس
+# ========================================
+def post_trace(args, url, trace):
+    """إرسال الحركة بالتوازي - يعيد (المدة، أزمنة ack، الحالات، رمز الرد -> وقت الإرسال)"""
+    session = requests.Session()
+    session.mount("http", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+    latencies = []
+    statuses = {}
+    sent_at = {}
+    lock = threading.Lock()
+    batches = [trace[i:i + args.batch] for i in range(0, len(trace), args.batch)]
+
+    def post_one(batch):
+        events = [make_event(*item) for item in batch]
+        body = json.dumps({"destination": "Uloadtest", "events": events}, ensure_ascii=False)
+        headers = {"X-Line-Signature": sign(args.secret, body), "Content-Type": "application/json"}
+        started = time.perf_counter()
+        try:
+            status = session.post(f"{url}/callback", data=body.encode(), headers=headers,
+                                  timeout=30).status_code
+        except requests.RequestException:
+            status = "error"
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            for event in events:
+                sent_at[event["replyToken"]] = started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(post_one, batches))
+    return started, time.perf_counter() - started, latencies, statuses, sent_at
+
+def measure(args, trace):
+    mock = MockLineApi(args.mock_port, args.api_latency_ms, args.api_429, args.retry_after)
+    mock.start()
+    server = None
+    try:
+        url = args.url
+        if url is not None:
+            print(f"الخادم الوهمي: LINE_API_HOST=http://127.0.0.1:{mock.port}")
+        else:
+            server = BotServer(args, mock.port)
+            server.start()
+            url = server.url
+        pids = server.pids() if server else []
+        written_before = written_bytes(pids)
+        # قبل أول حفظ لا يظهر المقياس في /metrics
+        json_before = (server.data_json_bytes() or 0) if server and args.backend == "json" else None
+
+        started, duration, latencies, statuses, sent_at = post_trace(args, url, trace)
+        drained = mock.wait_idle(args.settle, args.drain_timeout)
+
+        with mock.lock:
+            calls = dict(mock.calls)
+            throttled = dict(mock.throttled)
+            replied = [(mock.replied_at[token] - sent) * 1000
+                       for token, sent in sent_at.items() if token in mock.replied_at]
+            last_reply = max((mock.replied_at[token] for token in sent_at if token in mock.replied_at),
+                             default=started)
+        events = len(trace)
+        results = {
+            "events": events,
+            "requests": len(latencies),
+            "statuses": {str(status): count for status, count in statuses.items()},
+            "ack_events_per_sec": round(events / duration, 1),
+            "processed_events_per_sec": round(len(replied) / max(last_reply - started, 1e-9), 1),
+            "ack_ms": {f"p{pct}": round(percentile(latencies, pct), 2) for pct in (50, 90, 99)},
+            "reply_ms": {f"p{pct}": round(percentile(replied, pct), 2) for pct in (50, 90, 99)},
+            "replied_events": len(replied),
+            "outbound_calls": calls,
+            "rate_limited": throttled,
+            "outbound_per_event": round(sum(calls.values()) / events, 3),
+            "drained": drained
+        }
+        if server:
+            results["written_bytes_per_event"] = round((written_bytes(pids) - written_before) / events, 1)
+            if json_before is not None:
+                results["data_json_bytes_per_event"] = round(
+                    ((server.data_json_bytes() or 0) - json_before) / events, 1)
+        try:
+            results["event_pipeline"] = requests.get(f"{url}/stats", timeout=10).json().get("event_pipeline")
+        except (requests.RequestException, ValueError):
+            pass
+        return results
+    finally:
+        if server:
+            server.stop()
+        mock.stop()
+
+# ========================================
+# التقرير والمقارنة
+# ========================================
+# (اسم المقياس، المسار في النتائج، هل الأعلى أفضل)
+REPORT_ROWS = [
+    ("events/sec (ack)", ("ack_events_per_sec",), True),
+    ("events/sec (processed)", ("processed_events_per_sec",), True),
+    ("ack p50 ms", ("ack_ms", "p50"), False),
+    ("ack p99 ms", ("ack_ms", "p99"), False),
+    ("reply p50 ms", ("reply_ms", "p50"), False),
+    ("reply p90 ms", ("reply_ms", "p90"), False),
+    ("reply p99 ms", ("reply_ms", "p99"), False),
+    ("outbound calls/event", ("outbound_per_event",), False),
+    ("bytes written/event", ("written_bytes_per_event",), False),
+    ("data.json bytes/event", ("data_json_bytes_per_event",), False)
+]
+
+def lookup(results, path):
+    for key in path:
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    return results
+
+def report(results, config, baseline=None):
+    print(f"الأحداث: {results['events']} في {results['requests']} طلب - الحالات: {results['statuses']}")
+    print(f"ردود وصلت: {results['replied_events']} - الطلبات الصادرة: {results['outbound_calls']} "
+          f"(429: {results['rate_limited']})")
+    if not results["drained"]:
+        print("تحذير: انتهت مهلة انتظار توقف الطلبات الصادرة - الأرقام جزئية")
+    if results.get("event_pipeline"):
+        print("event_pipeline (عامل واحد):", json.dumps(results["event_pipeline"], ensure_ascii=False))
+
+    base = baseline["results"] if baseline else None
+    if baseline:
+        changed = {key: (baseline["config"].get(key), value) for key, value in config.items()
+                   if baseline["config"].get(key) != value}
+        if changed:
+            print(f"تحذير: إعدادات القياس المرجعي مختلفة: {changed}")
+    print(f"\n{'':24} {'now':>12}" + (f" {'baseline':>12} {'change':>9}" if base else ""))
+    for name, path, higher_is_better in REPORT_ROWS:
+        value = lookup(results, path)
+        if value is None:
+            continue
+        line = f"{name:24} {value:>12}"
+        old = lookup(base, path) if base else None
+        if old is not None:
+            change = (value - old) / old * 100 if old else 0
+            better = change > 0 if higher_is_better else change < 0
+            verdict = ("better" if better else "worse") if abs(change) >= 5 else ""
+            line += f" {old:>12} {change:>+8.1f}% {verdict}"
+        print(line)
+
+def run_config(args):
+    """الإعدادات التي تؤثر على الأرقام - تحفظ مع القياس المرجعي"""
+    return {
+        "events": args.events, "batch": args.batch, "concurrency": args.concurrency,
+        "workers": args.workers, "backend": args.backend, "mix": args.mix, "seed": args.seed,
+        "trace": os.path.basename(args.trace) if args.trace else None,
+        "api_latency_ms": args.api_latency_ms, "api_429": args.api_429, "env": sorted(args.env)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="اختبار حمل webhook")
+    parser.add_argument("--url", help="بوت قائم بدلا من تشغيل gunicorn")
+    parser.add_argument("--secret", default=os.getenv("LINE_CHANNEL_SECRET", "loadtest"))
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=1, help="عدد الأحداث في كل طلب")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--group-ratio", type=float, default=0.5)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--burst-min", type=int, default=3)
+    parser.add_argument("--burst-max", type=int, default=33)
+    parser.add_argument("--links-per-group", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace", help="إعادة تشغيل حركة محفوظة بدلا من توليدها")
+    parser.add_argument("--save-trace", help="حفظ الحركة المولدة (jsonl)")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--backend", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="متغير بيئة إضافي للبوت، مثل WRITE_BEHIND=true")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--app-dir", default=REPO, help="مجلد app.py المراد قياسه (للمقارنة بنسخة سابقة)")
+    parser.add_argument("--mock-port", type=int, default=0)
+    parser.add_argument("--api-latency-ms", type=float, default=30)
+    parser.add_argument("--api-429", type=float, default=0.01, help="نسبة الطلبات التي ترد بـ 429")
+    parser.add_argument("--retry-after", type=int, help="قيمة Retry-After مع 429 (بدونها تراجع أسي)")
+    parser.add_argument("--settle", type=float, default=3, help="ثوان بلا طلبات صادرة لاعتبار المعالجة منتهية")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--baseline", help="ملف قياس مرجعي للمقارنة")
+    parser.add_argument("--save-baseline", help="حفظ نتيجة هذا التشغيل كقياس مرجعي")
+    args = parser.parse_args()
+
+    if args.backend == "json" and args.workers != 1 and args.url is None:
+        # تخزين json لعملية واحدة فقط، و /metrics لا يجمع بين العمال
+        print("تخزين json: استخدام عامل واحد")
+        args.workers = 1
+
+    trace = load_trace(args.trace) if args.trace else generate_trace(args)
+    args.events = len(trace)
+    if args.save_trace:
+        save_trace(args.save_trace, trace)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    config = run_config(args)
+    results = measure(args, trace)
+    report(results, config, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\nتم حفظ القياس المرجعي في {args.save_baseline}")
+
+if __name__ == "__main__":
+    main()
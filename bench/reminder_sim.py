@@ -0,0 +1,136 @@
+"""
+محاكاة مواعيد التذكير بساعة افتراضية: نفس الكومة ودوال الجدولة في app.py بدون LINE ولا انتظار فعلي
+
+الاستخدام:
+    python -m bench.reminder_sim --deliveries 1000000 --targets 100000
+
+تقيس زمن الجدولة لكل إرسال، أعلى عدد إرسالات في الثانية الافتراضية (مع التوزيع وبدونه)،
+تأخر الإرسال عن موعده، ومخالفات ساعات الهدوء (يجب أن تكون صفرا)
+"""
+import os, time, random, argparse, logging
+
+from bench.common import import_app, percentile
+
+# بدون المجدول وطابور المهام وخيوط التذكير (BENCH_ENV): لا تعمل على قاعدة المحاكاة أثناء القياس
+os.environ.setdefault("DB_FILE", "sim.db")
+import_app("reminder_sim_", log_level=logging.INFO)
+from app import ReminderHeap, spread_schedule, next_fixed_time, quiet_end_after, parse_clock
+
+POPULAR_TIMES = [parse_clock(t) for t in ("05:00", "07:00", "21:00")]
+
+def make_targets(args, rng):
+    """مستلمون صناعيون: نسبة بأوقات ثابتة (نصفها في أوقات شائعة) ونسبة بساعات هدوء"""
+    fixed, quiet = {}, {}
+    for i in range(args.targets):
+        target_id = f"U{i:08d}"
+        if rng.random() < args.fixed_ratio:
+            if rng.random() < 0.5:
+                times = {rng.choice(POPULAR_TIMES)}
+            else:
+                times = {rng.randrange(1440) for _ in range(rng.randint(1, 3))}
+            fixed[target_id] = sorted(times)
+        elif rng.random() < args.quiet_ratio:
+            quiet[target_id] = (rng.randrange(21 * 60, 24 * 60), rng.randrange(5 * 60, 8 * 60))
+    return [f"U{i:08d}" for i in range(args.targets)], fixed, quiet
+
+def simulate(args, spread):
+    rng = random.Random(args.seed)
+    targets, fixed, quiet = make_targets(args, rng)
+    random_targets = [target_id for target_id in targets if target_id not in fixed]
+    capacity = min(args.batch, int(args.rate * args.tick))  # ما يرسل فعليا في كل دورة
+
+    now = float(int(time.time()))
+    heap = ReminderHeap()
+    for target_id, times in fixed.items():
+        heap.push((target_id, "fixed"), next_fixed_time(times, now))
+    next_broadcast = now + rng.uniform(args.min_hours, args.max_hours) * 3600
+
+    delivered = 0
+    per_tick = {}
+    demand = {}  # الثانية المجدولة -> عدد المواعيد فيها (قبل حد الإرسال)
+    lateness = {"fixed": [], "broadcast": []}
+    violations = deferred = 0
+    started = time.perf_counter()
+    while delivered < args.deliveries:
+        if now >= next_broadcast:
+            shuffled = random_targets[:]
+            rng.shuffle(shuffled)
+            window = max(args.spread, len(shuffled) / args.rate) if spread else 0
+            for target_id, fire_at in spread_schedule(shuffled, now, window, quiet.get):
+                heap.push((target_id, "broadcast"), fire_at)
+            next_broadcast = now + rng.uniform(args.min_hours, args.max_hours) * 3600
+
+        due = heap.pop_due(now, capacity)
+        if due:
+            per_tick[now] = len(due)
+            for (target_id, kind), fire_at in due:
+                demand[int(fire_at)] = demand.get(int(fire_at), 0) + 1
+                if kind == "fixed":
+                    heap.push((target_id, kind), next_fixed_time(fixed[target_id], now))
+                elif target_id in quiet and (end := quiet_end_after(now, quiet[target_id])) is not None:
+                    # كما في ReminderScheduler._claim: التأخر حتى ساعات الهدوء يؤجل ولا يرسل
+                    if args.recheck_quiet:
+                        heap.push((target_id, kind), end + rng.uniform(0, args.spread))
+                        deferred += 1
+                        continue
+                    violations += 1
+                lateness[kind].append(now - fire_at)
+                delivered += 1
+            now += args.tick
+        else:
+            # لا شيء مستحق: القفز إلى الموعد التالي بدلا من المرور على كل ثانية
+            upcoming = heap.next_fire()
+            target = min(upcoming, next_broadcast) if upcoming is not None else next_broadcast
+            now = max(now + args.tick, float(int(target)))
+    elapsed = time.perf_counter() - started
+
+    ticks = sorted(per_tick.values())
+    return {
+        "elapsed": elapsed,
+        "delivered": delivered,
+        "virtual_days": (now - int(time.time())) / 86400,
+        "peak": ticks[-1],
+        "peak_demand": max(demand.values()),
+        "p99_tick": percentile(ticks, 99),
+        "lateness": {kind: (percentile(values, 50), percentile(values, 99), max(values, default=0))
+                     for kind, values in lateness.items()},
+        "violations": violations,
+        "deferred": deferred,
+        "heap_size": len(heap.heap)
+    }
+
+def report(title, result):
+    print(f"== {title}")
+    print(f"  {result['delivered']} إرسال خلال {result['virtual_days']:.1f} يوم افتراضي "
+          f"في {result['elapsed']:.2f} ث ({result['elapsed'] / result['delivered'] * 1e6:.2f} ميكروثانية/إرسال)")
+    print(f"  أعلى مواعيد في ثانية واحدة: {result['peak_demand']} - "
+          f"أعلى إرسال في دورة: {result['peak']} (p99: {result['p99_tick']})")
+    for kind, (p50, p99, worst) in result["lateness"].items():
+        print(f"  التأخر ({kind}): p50={p50:.0f}ث p99={p99:.0f}ث max={worst:.0f}ث")
+    print(f"  مخالفات ساعات الهدوء: {result['violations']} - مؤجل عند الإرسال: {result['deferred']} "
+          f"- حجم الكومة: {result['heap_size']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="محاكاة مواعيد التذكير بساعة افتراضية")
+    parser.add_argument("--deliveries", type=int, default=1000000)
+    parser.add_argument("--targets", type=int, default=100000)
+    parser.add_argument("--fixed-ratio", type=float, default=0.3)
+    parser.add_argument("--quiet-ratio", type=float, default=0.3)
+    parser.add_argument("--spread", type=float, default=float(os.getenv("REMINDER_SPREAD_SECONDS", 600)))
+    parser.add_argument("--rate", type=float, default=float(os.getenv("PUSH_RATE_LIMIT", 200)))
+    parser.add_argument("--batch", type=int, default=int(os.getenv("REMINDER_BATCH", 500)))
+    parser.add_argument("--tick", type=float, default=1)
+    parser.add_argument("--min-hours", type=float, default=1)
+    parser.add_argument("--max-hours", type=float, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-recheck-quiet", dest="recheck_quiet", action="store_false",
+                        help="إرسال المتأخر حتى لو دخل ساعات الهدوء")
+    parser.add_argument("--no-compare", action="store_true", help="بدون تشغيل المقارنة غير الموزعة")
+    args = parser.parse_args()
+
+    report("موزع على نافذة", simulate(args, spread=True))
+    if not args.no_compare:
+        report("بدون توزيع (دفعة واحدة)", simulate(args, spread=False))
+
+if __name__ == "__main__":
+    main()
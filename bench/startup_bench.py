@@ -0,0 +1,137 @@
+"""
+قياس البدء البارد: الزمن حتى أول 200 من /health والذاكرة لكل عامل gunicorn
+
+الاستخدام:
+    python -m bench.startup_bench --users 10000 100000 1000000
+
+لكل عدد مستخدمين تنشأ بيانات صناعية في مجلد مؤقت ويشغل gunicorn مرتين:
+بدون --preload (كل عامل يستورد التطبيق) ومع gunicorn.conf.py (استيراد واحد ثم fork)
+RSS يشمل الصفحات المشتركة، و PSS يقسمها على العمليات المشتركة فيها (يعمل على Linux فقط)
+"""
+import os, sys, json, time, shutil, signal, sqlite3, argparse, tempfile, subprocess
+import requests
+
+from bench.common import REPO, copy_content, children
+
+def seed(directory, users, backend, app_dir):
+    """بيانات صناعية: كل المستخدمين مسجلون ونصفهم لهم عدادات تسبيح اليوم"""
+    copy_content(directory, app_dir)
+    ids = [f"U{i:032x}" for i in range(users)]
+    if backend == "json":
+        with open(os.path.join(directory, "data.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "users": ids,
+                "groups": [],
+                "tasbih": {uid: {"استغفر الله": 10, "سبحان الله": 5, "الحمد لله": 0, "الله أكبر": 0}
+                           for uid in ids[::2]},
+                "tasbih_day": {uid: 20000 for uid in ids[::2]},
+                "notifications_off": []
+            }, f)
+        return
+    # إنشاء الجداول باستيراد التطبيق نفسه ثم إدخال مباشر
+    subprocess.run([sys.executable, "-c", "import app"], cwd=directory, env=bench_env(app_dir),
+                   check=True, capture_output=True)
+    conn = sqlite3.connect(os.path.join(directory, "data.db"))
+    with conn:
+        conn.executemany("INSERT INTO users (id, last_active) VALUES (?, 20000)", ((uid,) for uid in ids))
+        conn.executemany("INSERT INTO tasbih (user_id, day, c0, c1, c2, c3) VALUES (?, 20000, 10, 5, 0, 0)",
+                         ((uid,) for uid in ids[::2]))
+    conn.close()
+
+def bench_env(app_dir, backend="sqlite"):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": app_dir,
+        "LINE_CHANNEL_SECRET": env.get("LINE_CHANNEL_SECRET", "bench"),
+        "LINE_CHANNEL_ACCESS_TOKEN": env.get("LINE_CHANNEL_ACCESS_TOKEN", "bench"),
+        "STORAGE_BACKEND": backend,
+        "DEFER_BACKGROUND_SERVICES": "true"
+    })
+    return env
+
+def memory_kb(pid):
+    """(RSS، PSS) بالكيلوبايت"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in ("Rss", "Pss"):
+                values[key] = int(rest.split()[0])
+    return values.get("Rss", 0), values.get("Pss", 0)
+
+def run_gunicorn(directory, args, preload, backend):
+    command = [sys.executable, "-m", "gunicorn", "app:app", f"--workers={args.workers}",
+               f"--bind=127.0.0.1:{args.port}", "--log-level=warning"]
+    env = bench_env(args.app_dir, backend)
+    if preload:
+        command.append(f"--config={os.path.join(args.app_dir, 'gunicorn.conf.py')}")
+    else:
+        # بدون ملف الإعدادات: الاستيراد في كل عامل والخيوط تبدأ عند الاستيراد كما في السابق
+        command.append("--config=/dev/null")
+        env["DEFER_BACKGROUND_SERVICES"] = "false"
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=directory, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_ok = None
+    try:
+        while time.perf_counter() - started < args.timeout:
+            try:
+                if requests.get(f"http://127.0.0.1:{args.port}/health", timeout=1).status_code == 200:
+                    first_ok = time.perf_counter() - started
+                    break
+            except requests.RequestException:
+                pass
+            time.sleep(0.01)
+        # انتظار إقلاع كل العمال وتشغيل كل منهم لطلب
+        deadline = time.perf_counter() + args.timeout
+        while len(children(process.pid)) < args.workers and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        for _ in range(args.workers * 4):
+            try:
+                requests.get(f"http://127.0.0.1:{args.port}/", timeout=30)
+            except requests.RequestException:
+                pass
+        time.sleep(1)
+        workers = [memory_kb(pid) for pid in children(process.pid)]
+        master = memory_kb(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return first_ok, master, workers
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس البدء البارد لـ gunicorn")
+    parser.add_argument("--users", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--backend", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--repeat", type=int, default=3, help="الزمن المعروض هو الوسيط")
+    parser.add_argument("--app-dir", default=REPO, help="مجلد app.py المراد قياسه (للمقارنة بنسخة سابقة)")
+    args = parser.parse_args()
+
+    print(f"{'users':>9} {'mode':>10} {'first 200':>10} {'worker RSS':>11} {'worker PSS':>11} {'total PSS':>11}")
+    for users in args.users:
+        directory = tempfile.mkdtemp(prefix="startup_bench_")
+        try:
+            seed(directory, users, args.backend, args.app_dir)
+            for preload in (False, True):
+                if preload and not os.path.exists(os.path.join(args.app_dir, "gunicorn.conf.py")):
+                    continue
+                runs = [run_gunicorn(directory, args, preload, args.backend) for _ in range(args.repeat)]
+                times = sorted(run[0] for run in runs if run[0] is not None)
+                _, master, workers = runs[-1]
+                rss = sum(w[0] for w in workers) / max(1, len(workers)) / 1024
+                pss = sum(w[1] for w in workers) / max(1, len(workers)) / 1024
+                total = (master[1] + sum(w[1] for w in workers)) / 1024
+                first = f"{times[len(times) // 2]:.2f}s" if times else "timeout"
+                print(f"{users:>9} {'preload' if preload else 'per-worker':>10} {first:>10} "
+                      f"{rss:>9.1f}MB {pss:>9.1f}MB {total:>9.1f}MB", flush=True)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
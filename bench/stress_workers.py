@@ -0,0 +1,109 @@
+"""
+اختبار تزاحم: تسبيح متزامن من عدة مستخدمين عبر كل عمال gunicorn ثم التحقق من العدادات النهائية
+
+الاستخدام:
+    python -m bench.stress_workers                          # sqlite مع عاملين
+    python -m bench.stress_workers --env WRITE_BEHIND=true  # نفس الاختبار مع الحفظ المؤجل
+    python -m bench.stress_workers --backend json           # json (عامل واحد وعدة خيوط معالجة)
+
+كل مستخدم يرسل --over تسبيحة زائدة عن الحد لذكر (يجب أن يقف عند 33) و --under لذكر آخر
+بترتيب عشوائي ومن الخاص والمجموعات معا، والطلبات متزامنة فتتوزع على العمال والخيوط
+بعد توقف الردود يوقف gunicorn (SIGTERM يحفظ المؤجل) وتقرأ العدادات من data.db أو data.json
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os, sys, json, time, random, sqlite3, argparse, base64
+from array import array
+import requests
+
+from bench.common import REPO
+from bench.loadtest import MockLineApi, BotServer, make_event, sign
+
+LIMIT = 33
+OVER_TEXT = "سبحان الله"  # c1
+UNDER_TEXT = "الحمد لله"  # c2
+
+def build_events(args, rng):
+    events = []
+    for i in range(args.users):
+        user_id = f"Ustress{i:08d}"
+        group_id = f"Cstress{i % 3:08d}"
+        texts = [OVER_TEXT] * (LIMIT + args.over) + [UNDER_TEXT] * args.under
+        for text in texts:
+            events.append((user_id, group_id if rng.random() < 0.5 else None, text))
+    rng.shuffle(events)
+    return events
+
+def post(server, secret, event):
+    body = json.dumps({"destination": "Ustress", "events": [make_event(*event)]}, ensure_ascii=False)
+    return requests.post(f"{server.url}/callback", data=body.encode(), timeout=30, headers={
+        "Content-Type": "application/json", "X-Line-Signature": sign(secret, body)
+    }).status_code
+
+def read_sqlite(directory):
+    conn = sqlite3.connect(os.path.join(directory, "data.db"))
+    rows = conn.execute("SELECT user_id, c1, c2 FROM tasbih WHERE user_id LIKE 'Ustress%'").fetchall()
+    conn.close()
+    return {user_id: (c1, c2) for user_id, c1, c2 in rows}
+
+def read_json(directory):
+    with open(os.path.join(directory, "data.json"), encoding="utf-8") as f:
+        table = json.load(f)["tasbih_rows"]
+    data = array("H", base64.b64decode(table["rows"]))
+    if sys.byteorder == "big":
+        data.byteswap()
+    width = len(table["keys"]) + 1  # العدادات ثم رقم اليوم
+    return {user_id: (data[row * width + 1], data[row * width + 2])
+            for row, user_id in enumerate(table["ids"]) if user_id.startswith("Ustress")}
+
+def main():
+    parser = argparse.ArgumentParser(description="تسبيح متزامن عبر العمال مع التحقق من العدادات")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--over", type=int, default=7, help=f"رسائل زائدة عن الحد ({LIMIT}) للذكر الأول")
+    parser.add_argument("--under", type=int, default=25, help="رسائل الذكر الثاني (أقل من الحد)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--backend", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--port", type=int, default=8797)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--app-dir", default=REPO)
+    args = parser.parse_args()
+    if args.backend == "json":
+        args.workers = 1  # json لعملية واحدة فقط
+    args.secret = "stress-secret"
+
+    events = build_events(args, random.Random(args.seed))
+    mock = MockLineApi(0, latency_ms=5, rate_limited=0)
+    mock.start()
+    server = BotServer(args, mock.port)
+    server.start()
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            statuses = list(executor.map(lambda event: post(server, args.secret, event), events))
+        mock.wait_idle(settle=2, timeout=120)
+        elapsed = time.perf_counter() - started
+        server.process.terminate()
+        server.process.wait(timeout=60)
+        counts = (read_sqlite if args.backend == "sqlite" else read_json)(server.directory)
+    finally:
+        server.stop()
+        mock.stop()
+
+    expected = (LIMIT, min(args.under, LIMIT))
+    wrong = {user_id: value for user_id, value in counts.items() if value != expected}
+    missing = args.users - len(counts)
+    rejected = sum(status != 200 for status in statuses)
+    print(f"{len(events)} حدث خلال {elapsed:.1f} ث - {args.workers} عامل، {args.backend}، "
+          f"{' '.join(args.env) or 'بدون إعدادات إضافية'}")
+    print(f"ردود {mock.calls.get('reply', 0)}، طلبات مرفوضة {rejected}")
+    print(f"المتوقع لكل مستخدم: {OVER_TEXT}={expected[0]}، {UNDER_TEXT}={expected[1]}")
+    for user_id, value in sorted(wrong.items()):
+        print(f"  ✗ {user_id}: {value}")
+    if wrong or missing or rejected:
+        print(f"✗ فشل: {len(wrong)} عدادات خاطئة، {missing} مستخدمين بلا عدادات")
+        sys.exit(1)
+    print(f"✓ كل العدادات صحيحة ({len(counts)} مستخدم)")
+
+if __name__ == "__main__":
+    main()
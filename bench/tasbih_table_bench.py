@@ -0,0 +1,130 @@
+"""
+TasbihTable (مصفوفة متصلة) مقابل الصيغة القديمة (قاموس عدادات لكل مستخدم): الذاكرة والصحة
+
+الاستخدام:
+    python -m bench.tasbih_table_bench                          # مقارنة RSS لـ 100 ألف و مليون مستخدم
+    python -m bench.tasbih_table_bench --users 100000 --check   # مع فحص الصحة مقابل نموذج مرجعي
+
+الذاكرة: كل صيغة تبنى في عملية منفصلة بنفس العدادات العشوائية ويقاس فرق RSS بعد البناء
+الصحة: عمليات عشوائية على JsonStore (زيادة حتى الحد، تصفير، تغير اليوم، قراءة) تقارن بقاموس
+مرجعي بسيط، ثم الإحصائيات بعد إعادة البناء والحفظ والتحميل والقراءة من الملف القديم ونقله لـ SQLite
+"""
+import gc, sys, json, time, random, argparse, subprocess
+
+from bench.common import REPO, import_app, rss_mb
+
+def measure_layout(layout, users, seed):
+    """بناء صيغة واحدة في هذه العملية وطباعة فرق RSS"""
+    app = import_app("tasbih_table_bench_")
+    rng = random.Random(seed)
+    # المعرفات تنشأ قبل القياس: نفس التكلفة في الصيغتين
+    ids = [f"U{rng.getrandbits(128):032x}" for _ in range(users)]
+    day = app.today_epoch_day()
+    gc.collect()
+    before = rss_mb()
+    started = time.perf_counter()
+    tasbih, days = {}, {}
+    for user_id in ids:
+        tasbih[user_id] = {key: rng.randrange(app.TASBIH_LIMITS + 1) for key in app.TASBIH_KEYS}
+        days[user_id] = day - rng.randrange(3)
+    if layout == "table":
+        built = app.TasbihTable.from_dicts(tasbih, days)
+        del tasbih, days
+    else:
+        built = (tasbih, days)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    print(f"{layout:>6} {users:>9} {rss_mb() - before:>9.1f} {elapsed:>8.2f}", flush=True)
+    return built
+
+def check(users, steps, seed):
+    """مقارنة JsonStore بنموذج مرجعي: user_id -> [اليوم، {الذكر: العدد}]"""
+    app = import_app("tasbih_table_bench_")
+    keys, limit = app.TASBIH_KEYS, app.TASBIH_LIMITS
+    store = app.JsonStore("check.json")
+    store.load()
+    reference = {}
+    rng = random.Random(seed)
+    ids = [f"Ucheck{i:08d}" for i in range(users)]
+    for user_id in ids:
+        store.add_user(user_id)
+    first_day = day = app.today_epoch_day()
+    for step in range(steps):
+        user_id = rng.choice(ids)
+        day = first_day + step * 3 // steps  # ثلاثة أيام: التصفير عند تغير اليوم
+        operation = rng.random()
+        if operation < 0.985:
+            key = rng.choice(keys)
+            counts, added = store.increment(user_id, key, limit, day)
+            expected = reference.get(user_id)
+            if expected is None or expected[0] != day:
+                expected = reference[user_id] = [day, dict.fromkeys(keys, 0)]
+            expected_added = expected[1][key] < limit
+            if expected_added:
+                expected[1][key] += 1
+            assert added == expected_added and counts == expected[1], (user_id, counts, expected)
+        elif operation < 0.987:
+            store.reset_counts(user_id, day)
+            reference[user_id] = [day, dict.fromkeys(keys, 0)]
+        else:
+            expected = reference.get(user_id)
+            current = expected[1] if expected and expected[0] == day else dict.fromkeys(keys, 0)
+            assert store.get_counts(user_id, day) == current, user_id
+            assert store.is_stale(user_id, day) == (expected is not None and expected[0] != day), user_id
+
+    summary = store.summary(day)
+    store._rebuild_aggregates()
+    assert store.summary(day) == summary, "الإحصائيات بعد إعادة البناء"
+    completed = sum(1 for d, counts in reference.values() if d == day and min(counts.values()) >= limit)
+    assert summary["completed_today"] == completed, (summary, completed)
+    assert summary["total_tasbih"] == sum(sum(counts.values()) for _, counts in reference.values())
+
+    store._dump()
+    loaded = app.JsonStore("check.json")
+    loaded.load()
+    assert loaded.summary(day) == summary, "بعد الحفظ والتحميل"
+    assert all(loaded.get_counts(u, day) == store.get_counts(u, day) for u in ids)
+
+    # الملف بالصيغة القديمة (قاموس لكل مستخدم وتاريخ آخر تصفير) يقرأ بنفس النتيجة
+    legacy = {
+        "users": ids, "groups": [], "notifications_off": [],
+        "tasbih": {u: counts for u, (d, counts) in reference.items()},
+        "last_reset": {u: str(app.EPOCH.fromordinal(app.EPOCH.toordinal() + d)) for u, (d, _) in reference.items()},
+    }
+    with open("legacy.json", "w", encoding="utf-8") as f:
+        json.dump(legacy, f, ensure_ascii=False)
+    old = app.JsonStore("legacy.json")
+    old.load()
+    assert old.summary(day) == summary, (old.summary(day), summary)
+
+    # النقل من data.json المضغوط إلى SQLite
+    app.DATA_FILE = "check.json"
+    sqlite_store = app.SqliteStore("check.db")
+    sqlite_store.load()
+    assert all(sqlite_store.get_counts(u, day) == store.get_counts(u, day) for u in ids)
+    print(f"✓ {steps} عملية على {users} مستخدم تطابق النموذج المرجعي - {summary}")
+
+def main():
+    parser = argparse.ArgumentParser(description="ذاكرة وصحة TasbihTable مقابل القواميس")
+    parser.add_argument("--users", type=int, action="append", help="يمكن تكراره (الافتراضي 100000 و 1000000)")
+    parser.add_argument("--layout", choices=["dicts", "table"], help="صيغة واحدة في هذه العملية")
+    parser.add_argument("--check", action="store_true", help="فحص الصحة بعمليات عشوائية")
+    parser.add_argument("--check-users", type=int, default=30)
+    parser.add_argument("--check-steps", type=int, default=60000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    sizes = args.users or [100_000, 1_000_000]
+
+    if args.layout:
+        measure_layout(args.layout, sizes[0], args.seed)
+        return
+    print(f"{'layout':>6} {'users':>9} {'rss MB':>9} {'build s':>8}", flush=True)
+    for users in sizes:
+        for layout in ("dicts", "table"):
+            subprocess.run([sys.executable, "-m", "bench.tasbih_table_bench", "--layout", layout,
+                            "--users", str(users), "--seed", str(args.seed)], check=True, cwd=REPO)
+    if args.check:
+        check(args.check_users, args.check_steps, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+قياس تكلفة الكتابة لكل رسالة تسبيح مع زيادة عدد المستخدمين: json (إعادة كتابة الملف) مقابل sqlite (سطر واحد)
+
+الاستخدام:
+    python -m bench.write_bench --users 1000 10000 100000
+
+لكل عدد مستخدمين تنشأ بيانات صناعية في مجلد مؤقت ثم تقاس زيادات متتالية بدون الحفظ المؤجل
+(كل زيادة تكتب فورا كما في handle_tasbih) - زمن sqlite يجب أن يبقى ثابتا مهما زاد العدد
+"""
+import os, time, random, sqlite3, argparse, tempfile
+
+from bench.common import import_app
+
+import_app("write_bench_")
+from app import JsonStore, SqliteStore, TASBIH_KEYS, TASBIH_LIMITS, today_epoch_day
+
+def user_ids(count):
+    return [f"U{i:032x}" for i in range(count)]
+
+def json_store(directory, ids, day):
+    store = JsonStore(os.path.join(directory, "data.json"))
+    store.users = set(ids)
+    for user_id in ids[::2]:
+        store.tasbih.reset(user_id, day)
+    store._rebuild_aggregates()
+    return store
+
+def sqlite_store(directory, ids, day):
+    path = os.path.join(directory, "data.db")
+    SqliteStore(path).conn.close()  # إنشاء الجداول والـ triggers
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO users (id) VALUES (?)", ((uid,) for uid in ids))
+        conn.executemany("INSERT INTO tasbih (user_id, day) VALUES (?, ?)", ((uid, day) for uid in ids[::2]))
+    conn.close()
+    return SqliteStore(path)
+
+def measure(store, ids, writes, rng, day):
+    """متوسط زمن الزيادة الواحدة بالمللي ثانية"""
+    samples = []
+    for _ in range(writes):
+        user_id = rng.choice(ids)
+        key = rng.choice(TASBIH_KEYS)
+        started = time.perf_counter()
+        store.increment(user_id, key, TASBIH_LIMITS, day)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return sum(samples) / len(samples) * 1000, samples[len(samples) // 2] * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="تكلفة الكتابة لكل رسالة حسب عدد المستخدمين")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--json-writes", type=int, default=20, help="كل كتابة json تعيد كتابة الملف كاملا")
+    parser.add_argument("--sqlite-writes", type=int, default=2000)
+    parser.add_argument("--backend", choices=["both", "json", "sqlite"], default="both")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    day = today_epoch_day()
+    print(f"{'users':>9} {'backend':>8} {'avg ms':>10} {'p50 ms':>10}")
+    for count in args.users:
+        ids = user_ids(count)
+        for backend in ("json", "sqlite"):
+            if args.backend not in ("both", backend):
+                continue
+            directory = tempfile.mkdtemp(prefix=f"{backend}_")
+            if backend == "json":
+                store, writes = json_store(directory, ids, day), args.json_writes
+            else:
+                store, writes = sqlite_store(directory, ids, day), args.sqlite_writes
+            average, median = measure(store, ids, writes, random.Random(args.seed), day)
+            print(f"{count:>9} {backend:>8} {average:>10.3f} {median:>10.3f}", flush=True)
+
+if __name__ == "__main__":
+    main()
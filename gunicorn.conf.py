@@ -0,0 +1,15 @@
+"""
+إعدادات gunicorn: تحميل التطبيق مرة واحدة في العملية الرئيسية (--preload) ثم fork للعمال
+فتشترك العمال في صفحات الذاكرة (نسخ عند الكتابة) ولا يتكرر استيراد المكتبات في كل عامل
+"""
+import os
+
+# الخيوط واتصالات SQLite لا تنتقل عبر fork - تبدأ في كل عامل من post_fork
+os.environ.setdefault("DEFER_BACKGROUND_SERVICES", "true")
+
+preload_app = True
+
+def post_fork(server, worker):
+    from app import start_background_services
+    # حد الإرسال PUSH_RATE_LIMIT للقناة كاملة فيقسم على العمال
+    start_background_services(workers=server.cfg.workers)